@@ -19,12 +19,25 @@ Main PyFat class and support classes and utilities.
 '''
 
 import struct
+import array
+import asyncio
 import collections
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import io
 import os
+import sys
+import threading
 import time
 
-# FIXME: add support for FAT16
-# FIXME: add support for FAT32
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:
+    resource_tracker = None
+    shared_memory = None
+
 # FIXME: add support for editing a filesystem in-place
 
 class PyFatException(Exception):
@@ -61,14 +74,762 @@ def _ceiling_div(numer, denom):
     # See https://stackoverflow.com/questions/14822184/is-there-a-ceiling-equivalent-of-operator-in-python.
     return -(-numer // denom)
 
+def _fat_date_time(seconds):
+    '''
+    A function to convert a time in seconds since the epoch to the date and
+    time encoding used by FAT directory entries.
+
+    Parameters:
+     seconds - The number of seconds since the epoch to convert.
+    Returns:
+     A tuple containing the FAT date and the FAT time.
+    '''
+    local = time.localtime(seconds)
+    year = local.tm_year - 1980
+    if year < 0:
+        # FAT can't represent anything before 1980, so clamp to the start.
+        return ((0 << 9) | (1 << 5) | 1, 0)
+
+    date = (year << 9) | (local.tm_mon << 5) | (local.tm_mday & 0x1f)
+    # FAT only has a 2-second resolution on the time.
+    fattime = (local.tm_hour << 11) | (local.tm_min << 5) | (local.tm_sec // 2)
+
+    return (date, fattime)
+
+def _host_time_from_fat(date, fattime):
+    '''
+    A function to convert the date and time encoding used by FAT directory
+    entries to a time in seconds since the epoch; the reverse of
+    _fat_date_time().
+
+    Parameters:
+     date - The FAT date.
+     fattime - The FAT time.
+    Returns:
+     The number of seconds since the epoch.
+    '''
+    return time.mktime((1980 + (date >> 9), (date >> 5) & 0x0f, date & 0x1f,
+                        fattime >> 11, (fattime >> 5) & 0x3f, (fattime & 0x1f) * 2,
+                        0, 0, -1))
+
+def _cluster_extents(offsets, length, bytes_per_cluster):
+    '''
+    A function to turn a list of cluster offsets into a list of byte extents,
+    merging clusters that directly follow each other.
+
+    Parameters:
+     offsets - The list of byte offsets of the clusters.
+     length - The number of bytes of data in the clusters.
+     bytes_per_cluster - The number of bytes in each cluster.
+    Returns:
+     A list of tuples of the offset and length of each contiguous run of data.
+    '''
+    extents = []
+    left = length
+    for offset in offsets:
+        if left <= 0:
+            break
+
+        thisread = min(left, bytes_per_cluster)
+        if extents and extents[-1][0] + extents[-1][1] == offset:
+            extents[-1] = (extents[-1][0], extents[-1][1] + thisread)
+        else:
+            extents.append((offset, thisread))
+
+        left -= thisread
+
+    return extents
+
+def _count_free(entries):
+    '''
+    A function to count the free entries in a run of FAT entries.
+
+    Parameters:
+     entries - The FAT entries, as an array, a list or a memoryview.
+    Returns:
+     The number of entries that are 0.
+    '''
+    if isinstance(entries, memoryview):
+        # A FAT attached from shared memory.
+        entries = entries.tolist()
+
+    return entries.count(0)
+
+def _find_zero(entries, start, stop, chunk_size=4096):
+    '''
+    A function to find the first free entry in a run of FAT entries.  This
+    searches a chunk at a time, since array.index() only takes a start and
+    stop on Python 3.10 and later, and slicing the rest of a large FAT for
+    every search would copy most of it each time.
+
+    Parameters:
+     entries - The FAT entries, as an array.
+     start - The index to start searching at.
+     stop - The index to stop searching before.
+     chunk_size - The number of entries to search at a time.
+    Returns:
+     The index of the first entry from start that is 0; ValueError is raised if there is none before stop.
+    '''
+    while start < stop:
+        end = min(start + chunk_size, stop)
+        try:
+            return start + entries[start:end].index(0)
+        except ValueError:
+            start = end
+
+    raise ValueError("No free entry found")
+
+def _write_sparse(outfp, offset, data, chunk_size=65536):
+    '''
+    A function to write data to a freshly created file, skipping the chunks
+    that are all zeros so that they are left as holes.
+
+    Parameters:
+     outfp - The file object to write to.
+     offset - The offset in the file to write the data at.
+     data - The string to write.
+     chunk_size - The granularity at which to look for zeros.
+    Returns:
+     Nothing.
+    '''
+    zeros = bytes(chunk_size)
+    for start in range(0, len(data), chunk_size):
+        chunk = data[start:start + chunk_size]
+        if chunk != zeros[:len(chunk)]:
+            outfp.seek(offset + start)
+            outfp.write(chunk)
+
+def _pread(infd, size, offset):
+    '''
+    A function to do a positional read, from either a file descriptor or a
+    _PatchedFile.
+
+    Parameters:
+     infd - The file descriptor or _PatchedFile to read from.
+     size - The number of bytes to read.
+     offset - The offset to read from.
+    Returns:
+     The data that was read.
+    '''
+    if isinstance(infd, _PatchedFile):
+        return infd.pread(size, offset)
+
+    return os.pread(infd, size, offset)
+
+def _pread_copy(infd, src_extents, outfd, dst_extents, chunk_size):
+    '''
+    A function to copy data between two file descriptors using only
+    positional reads and writes, so it can safely run in several threads
+    sharing the same descriptors.  The source and destination extents must
+    cover the same number of bytes, but may be split up differently.
+
+    Parameters:
+     infd - The file descriptor to read from.
+     src_extents - A list of tuples of the offset and length of each run to read.
+     outfd - The file descriptor to write to.
+     dst_extents - A list of tuples of the offset and length of each run to write.
+     chunk_size - The most data to read at once.
+    Returns:
+     Nothing.
+    '''
+    dst_iter = iter(dst_extents)
+    dst_offset, dst_left = 0, 0
+    for src_offset, src_left in src_extents:
+        while src_left > 0:
+            if dst_left == 0:
+                dst_offset, dst_left = next(dst_iter)
+
+            data = _pread(infd, min(src_left, dst_left, chunk_size), src_offset)
+            if not data:
+                raise PyFatException("Unexpected end of data")
+
+            written = 0
+            while written < len(data):
+                written += os.pwrite(outfd, data[written:], dst_offset + written)
+
+            src_offset += len(data)
+            src_left -= len(data)
+            dst_offset += len(data)
+            dst_left -= len(data)
+
+def _seek_copy(infp, src_extents, outfp, dst_extents, chunk_size):
+    '''
+    A function to copy data between two file objects by seeking, for
+    platforms without positional I/O.  The source and destination extents
+    must cover the same number of bytes, but may be split up differently.
+
+    Parameters:
+     infp - The file object to read from.
+     src_extents - A list of tuples of the offset and length of each run to read.
+     outfp - The file object to write to.
+     dst_extents - A list of tuples of the offset and length of each run to write.
+     chunk_size - The most data to read at once.
+    Returns:
+     Nothing.
+    '''
+    dst_iter = iter(dst_extents)
+    dst_offset, dst_left = 0, 0
+    for src_offset, src_left in src_extents:
+        while src_left > 0:
+            if dst_left == 0:
+                dst_offset, dst_left = next(dst_iter)
+
+            infp.seek(src_offset)
+            data = infp.read(min(src_left, dst_left, chunk_size))
+            if not data:
+                raise PyFatException("Unexpected end of data")
+
+            outfp.seek(dst_offset)
+            outfp.write(data)
+
+            src_offset += len(data)
+            src_left -= len(data)
+            dst_offset += len(data)
+            dst_left -= len(data)
+
+def _fat_name_from_host(name):
+    '''
+    A function to convert the name of a file on the host to the name it gets
+    on the FAT filesystem.
+
+    Parameters:
+     name - The name of the file on the host.
+    Returns:
+     A tuple of the FAT filename and extension.
+    '''
+    filename, ext = os.path.splitext(name.upper())
+    if len(ext) > 0 and ext[0] == '.':
+        ext = ext[1:]
+
+    if len(filename) == 0 or len(filename) > 8 or len(ext) > 3 or '.' in filename:
+        raise PyFatException("Cannot represent %s as an 8.3 name" % (name))
+
+    return (filename, ext)
+
+def _check_fat_name(filename, extension):
+    '''
+    A function to make sure a filename and extension can be stored in a FAT
+    directory entry.
+
+    Parameters:
+     filename - The filename to check.
+     extension - The extension to check.
+    Returns:
+     Nothing.
+    '''
+    if len(filename) > 8:
+        raise PyFatException("Filename is too long (must be 8 or shorter)")
+
+    if len(extension) > 3:
+        raise PyFatException("Extension is too long (must be 3 or shorter)")
+
+    try:
+        filename.encode(FATDirectoryEntry.NAME_CODEC)
+        extension.encode(FATDirectoryEntry.NAME_CODEC)
+    except UnicodeEncodeError:
+        raise PyFatException("Name can only contain characters from code page 437")
+
+def _scan_host_dir(localpath):
+    '''
+    A function to list a directory on the host, in sorted order, with the
+    names each entry gets on the FAT filesystem.
+
+    Parameters:
+     localpath - The path to the directory on the host.
+    Returns:
+     An OrderedDict mapping each FAT name to a tuple of the FAT filename, the FAT extension and the os.DirEntry object.
+    '''
+    host = collections.OrderedDict()
+    with os.scandir(localpath) as it:
+        for dirent in sorted(it, key=lambda d: d.name):
+            filename, ext = _fat_name_from_host(dirent.name)
+            fullname = filename
+            if len(ext) > 0:
+                fullname += "." + ext
+            if fullname in host:
+                raise PyFatException("%s and %s in %s both become %s" % (host[fullname][2].name, dirent.name, localpath, fullname))
+            host[fullname] = (filename, ext, dirent)
+
+    return host
+
+class _LazyFile(object):
+    '''
+    An internal class that stands in for a file object on the host, and only
+    opens the file while it is being read.  A limited number of these are open
+    at any time, so that adding thousands of files doesn't run the process out
+    of file descriptors.
+    '''
+    MAX_OPEN = 64
+    _open_files = collections.OrderedDict()
+    _open_files_lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        self.fp = None
+        self.pos = 0
+
+    def _fp(self):
+        '''
+        An internal method to get the underlying file object, opening it (and
+        closing the least recently used one) if necessary.
+
+        Parameters:
+         None.
+        Returns:
+         The underlying file object.
+        '''
+        with self._open_files_lock:
+            if self.fp is None:
+                if len(self._open_files) >= self.MAX_OPEN:
+                    oldest, unused = self._open_files.popitem(last=False)
+                    oldest.fp.close()
+                    oldest.fp = None
+                self.fp = open(self.path, 'rb')
+            else:
+                del self._open_files[self]
+            self._open_files[self] = True
+
+            return self.fp
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        '''
+        A method to seek within the file.
+
+        Parameters:
+         offset - The offset to seek to.
+         whence - Where the offset is relative to.
+        Returns:
+         Nothing.
+        '''
+        if whence == os.SEEK_SET:
+            self.pos = offset
+        else:
+            fp = self._fp()
+            fp.seek(offset, whence)
+            self.pos = fp.tell()
+
+    def read(self, size=-1):
+        '''
+        A method to read from the current position in the file.
+
+        Parameters:
+         size - The number of bytes to read, or -1 to read to the end.
+        Returns:
+         The data that was read.
+        '''
+        fp = self._fp()
+        fp.seek(self.pos)
+        data = fp.read(size)
+        self.pos += len(data)
+
+        return data
+
+    def fileno(self):
+        '''
+        A method to get the file descriptor of the underlying file.
+
+        Parameters:
+         None.
+        Returns:
+         The file descriptor.
+        '''
+        return self._fp().fileno()
+
+    def close(self):
+        '''
+        A method to close the underlying file, if it is open.  The file will
+        be reopened if it is read again.
+
+        Parameters:
+         None.
+        Returns:
+         Nothing.
+        '''
+        with self._open_files_lock:
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
+                self._open_files.pop(self, None)
+
+class _PatchedFile(object):
+    '''
+    An internal class that stands in for the data of a file that has been
+    changed in place.  The clusters that were written to are kept in memory,
+    and the rest are read from wherever the data was before the first change.
+    The data looks like one contiguous file, as for files added from the host.
+    '''
+    def __init__(self, fp, offsets, size, bytes_per_cluster, owns_fp=True):
+        self.fp = fp
+        self.offsets = offsets
+        self.size = size
+        self.bytes_per_cluster = bytes_per_cluster
+        self.owns_fp = owns_fp
+        self.dirty = {}
+        self.pos = 0
+        self._fp_lock = threading.Lock()
+
+    def _read_base(self, offset, size):
+        '''
+        An internal method to read data that has not been changed from the
+        original location, as far as the clusters are contiguous there.
+
+        Parameters:
+         offset - The offset in the file to read from.
+         size - The most data to read.
+        Returns:
+         The data that was read; anything past the original data is zeros.
+        '''
+        index, within = divmod(offset, self.bytes_per_cluster)
+        length = min(size, self.bytes_per_cluster - within)
+        if offset >= self.size or index >= len(self.offsets):
+            return bytes(length)
+
+        # Take in the following clusters too if they are unchanged and follow
+        # on in the original.
+        nextindex = index + 1
+        while (length < size and nextindex < len(self.offsets) and nextindex not in self.dirty and
+               self.offsets[nextindex] == self.offsets[nextindex - 1] + self.bytes_per_cluster):
+            length = min(size, length + self.bytes_per_cluster)
+            nextindex += 1
+
+        length = min(length, self.size - offset)
+        if isinstance(self.fp, _PatchedFile):
+            data = self.fp.pread(length, self.offsets[index] + within)
+        elif hasattr(os, 'pread') and isinstance(self.fp, io.BufferedReader):
+            data = os.pread(self.fp.fileno(), length, self.offsets[index] + within)
+        else:
+            with self._fp_lock:
+                self.fp.seek(self.offsets[index] + within)
+                data = self.fp.read(length)
+
+        return data + bytes(length - len(data))
+
+    def pread(self, size, offset):
+        '''
+        A method to read from a given position in the file, without using or
+        changing the current position.
+
+        Parameters:
+         size - The number of bytes to read.
+         offset - The offset in the file to read from.
+        Returns:
+         The data that was read.
+        '''
+        out = []
+        while size > 0:
+            index, within = divmod(offset, self.bytes_per_cluster)
+            if index in self.dirty:
+                data = self.dirty[index][within:within + size]
+            else:
+                data = self._read_base(offset, size)
+            out.append(data)
+            offset += len(data)
+            size -= len(data)
+
+        return b''.join(out)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        '''
+        A method to seek within the file.
+
+        Parameters:
+         offset - The offset to seek to; only os.SEEK_SET is supported.
+         whence - Where the offset is relative to.
+        Returns:
+         Nothing.
+        '''
+        self.pos = offset
+
+    def read(self, size):
+        '''
+        A method to read from the current position in the file.
+
+        Parameters:
+         size - The number of bytes to read.
+        Returns:
+         The data that was read.
+        '''
+        data = self.pread(size, self.pos)
+        self.pos += len(data)
+
+        return data
+
+    def write(self, offset, data):
+        '''
+        A method to change the data of the file, keeping a copy of each
+        cluster that is touched.
+
+        Parameters:
+         offset - The offset in the file to write at.
+         data - The data to write.
+        Returns:
+         Nothing.
+        '''
+        pos = 0
+        while pos < len(data):
+            index, within = divmod(offset + pos, self.bytes_per_cluster)
+            length = min(len(data) - pos, self.bytes_per_cluster - within)
+            cluster = bytearray(self.pread(self.bytes_per_cluster, index * self.bytes_per_cluster))
+            cluster[within:within + length] = data[pos:pos + length]
+            self.dirty[index] = bytes(cluster)
+            pos += length
+
+    def truncate(self, size):
+        '''
+        A method to throw away the data past a given size, so that it reads
+        back as zeros if the file grows again.
+
+        Parameters:
+         size - The size to cut the file down to.
+        Returns:
+         Nothing.
+        '''
+        index, within = divmod(size, self.bytes_per_cluster)
+        for dirty in [i for i in self.dirty if i >= index]:
+            if dirty == index and within > 0:
+                self.dirty[dirty] = self.dirty[dirty][:within] + bytes(self.bytes_per_cluster - within)
+            else:
+                del self.dirty[dirty]
+
+        self.size = min(self.size, size)
+
+    def copy(self):
+        '''
+        A method to make a new _PatchedFile with the same data as this one,
+        which does not change when this one does.
+
+        Parameters:
+         None.
+        Returns:
+         The new _PatchedFile.
+        '''
+        new = _PatchedFile(self.fp, self.offsets, self.size, self.bytes_per_cluster, False)
+        new.dirty = dict(self.dirty)
+
+        return new
+
+    def close(self):
+        '''
+        A method to close the file that the original data comes from, if it
+        belongs to this object.
+
+        Parameters:
+         None.
+        Returns:
+         Nothing.
+        '''
+        if self.owns_fp:
+            self.fp.close()
+
+class _RWLock(object):
+    '''
+    An internal class implementing a reader/writer lock.  Any number of
+    threads may hold it for reading at once, but a writer holds it alone.
+    Waiting writers keep new readers out, so writers can't be starved.  Both
+    kinds are reentrant, and a thread holding it for writing may also take it
+    for reading.
+    '''
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = {}
+        self._writer = None
+        self._writer_count = 0
+        self._writers_waiting = 0
+
+    def acquire_read(self):
+        '''
+        A method to acquire the lock for reading.
+
+        Parameters:
+         None.
+        Returns:
+         Nothing.
+        '''
+        me = threading.current_thread().ident
+        with self._cond:
+            if self._writer != me and me not in self._readers:
+                while self._writer is not None or self._writers_waiting > 0:
+                    self._cond.wait()
+            self._readers[me] = self._readers.get(me, 0) + 1
+
+    def release_read(self):
+        '''
+        A method to release the lock after reading.
+
+        Parameters:
+         None.
+        Returns:
+         Nothing.
+        '''
+        me = threading.current_thread().ident
+        with self._cond:
+            self._readers[me] -= 1
+            if self._readers[me] == 0:
+                del self._readers[me]
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        '''
+        A method to acquire the lock for writing.
+
+        Parameters:
+         None.
+        Returns:
+         Nothing.
+        '''
+        me = threading.current_thread().ident
+        with self._cond:
+            if self._writer == me:
+                self._writer_count += 1
+                return
+
+            if me in self._readers:
+                raise PyFatException("Cannot modify the filesystem while reading it")
+
+            self._writers_waiting += 1
+            while self._writer is not None or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+
+            self._writer = me
+            self._writer_count = 1
+
+    def release_write(self):
+        '''
+        A method to release the lock after writing.
+
+        Parameters:
+         None.
+        Returns:
+         Nothing.
+        '''
+        with self._cond:
+            self._writer_count -= 1
+            if self._writer_count == 0:
+                self._writer = None
+                self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def read_locked(self):
+        '''
+        A context manager that holds the lock for reading.
+        '''
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextlib.contextmanager
+    def write_locked(self):
+        '''
+        A context manager that holds the lock for writing.
+        '''
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+def _reader(method):
+    '''
+    A decorator for PyFat methods that only read the filesystem; they hold
+    the object's lock for reading while they run.
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock.read_locked():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+def _writer(method):
+    '''
+    A decorator for PyFat methods that modify the filesystem; they hold the
+    object's lock for writing while they run.
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock.write_locked():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+def _mutator(method):
+    '''
+    A decorator for PyFat methods that change the filesystem tree; like
+    _writer, but they are also refused on a read-only object.
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock.write_locked():
+            if self.read_only:
+                raise PyFatException("Cannot modify a read-only PyFat object")
+            return method(self, *args, **kwargs)
+    return wrapper
+
+def _open_shared_memory(name, size=0):
+    '''
+    An internal function to create or attach to a shared memory segment that
+    is left out of the resource tracker.  The PyFat object that creates a
+    segment owns it and unlinks it in close() with _unlink_shared_memory();
+    no other process ever does.
+
+    Parameters:
+     name - The name of the segment; if None, a unique name is picked.
+     size - The size of the segment to create, or 0 to attach to an existing one.
+    Returns:
+     The SharedMemory object for the segment.
+    '''
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, create=size > 0, size=size, track=False)
+
+    # Before Python 3.13 creating or attaching always registers the segment
+    # with the resource tracker, which would unlink it when this process
+    # exits, so take it straight back out.  Every process does both, so this
+    # balances out even when several of them share one tracker.
+    shm = shared_memory.SharedMemory(name=name, create=size > 0, size=size)
+    if os.name == 'posix':
+        resource_tracker.unregister('/' + shm.name, 'shared_memory')
+    return shm
+
+def _unlink_shared_memory(shm):
+    '''
+    An internal function to remove a shared memory segment opened by
+    _open_shared_memory().
+
+    Parameters:
+     shm - The SharedMemory object for the segment.
+    Returns:
+     Nothing.
+    '''
+    if sys.version_info < (3, 13) and os.name == 'posix':
+        # Before Python 3.13 unlink() also unregisters the segment from the
+        # resource tracker, which _open_shared_memory() already did; put it
+        # back so that the tracker has something to remove.
+        resource_tracker.register('/' + shm.name, 'shared_memory')
+    shm.unlink()
+
 class FATDirectoryEntry(object):
     '''
     The class that represents a single FAT Directory Entry.
     '''
     DATA_ON_ORIGINAL_FAT = 1
     DATA_IN_EXTERNAL_FP = 2
+    DATA_RELOCATED = 3
+
+    # Short names are stored in the OEM code page; 437 is what DOS and
+    # mkfs.fat use, and it maps every byte to a character.
+    NAME_CODEC = 'cp437'
 
     def __init__(self):
+        self.max_children = None
+        # A cache of the number of clusters in the chain and the last cluster
+        # of it, so growing the entry doesn't have to walk the chain.  None
+        # means it has to be looked up from the FAT.
+        self.chain_tail = None
+        # Whether the clusters of this entry were read from an image or laid
+        # out by a deterministic write, and haven't changed since; a later
+        # deterministic write leaves these where they are.
+        self.placed = False
         self.initialized = False
 
     def parse(self, instr, parent, data_fp):
@@ -91,12 +852,26 @@ class FATDirectoryEntry(object):
             raise PyFatException("Expected 32 bytes for the directory entry")
 
         (self.filename, self.extension, self.attributes, unused1,
-         self.creation_time, self.creation_date, self.last_access_date, unused2,
-         self.last_write_time, self.last_write_date, self.first_logical_cluster,
+         self.creation_time, self.creation_date, self.last_access_date, cluster_high,
+         self.last_write_time, self.last_write_date, cluster_low,
          self.file_size) = struct.unpack("=8s3sBHHHHHHHHL", instr)
 
+        # The high word of the first cluster is only used on FAT32; it is
+        # always 0 on FAT12 and FAT16.
+        self.first_logical_cluster = (cluster_high << 16) | cluster_low
+
+        # The names are stored as bytes on disk, but we deal with them as
+        # strings everywhere else (see record()).  A name that really starts
+        # with 0xe5 is stored with 0x05 instead, since 0xe5 marks a deleted
+        # entry.
+        if self.filename[0:1] == b'\x05':
+            self.filename = b'\xe5' + self.filename[1:]
+        self.filename = self.filename.decode(self.NAME_CODEC)
+        self.extension = self.extension.decode(self.NAME_CODEC)
+
         self.parent = parent
         self.children = []
+        self.placed = True
 
         if not self.attributes & 0x10:
             # Save the data pointer and original data location only for files
@@ -105,7 +880,7 @@ class FATDirectoryEntry(object):
 
         self.initialized = True
 
-    def _new(self, filename, extension, is_dir, first_logical_cluster, file_size, parent):
+    def _new(self, filename, extension, is_dir, first_logical_cluster, file_size, parent, date_time=None):
         '''
         Internal method to create a new directory entry.
 
@@ -116,22 +891,17 @@ class FATDirectoryEntry(object):
          first_logical_cluster - The first logical cluster in the FAT for this directory entry.
          file_size - The file size of this directory entry.
          parent - The parent of this directory entry.
+         date_time - A tuple of the FAT date and FAT time to stamp on this entry; if None, today's date is used.
         Returns:
          Nothing.
         '''
-        if len(filename) > 8:
-            raise PyFatException("Filename is too long (must be 8 or shorter)")
-
-        if len(extension) > 3:
-            raise PyFatException("Extension is too long (must be 3 or shorter)")
+        _check_fat_name(filename, extension)
 
-        time_since_epoch = time.time()
-        local = time.localtime(time_since_epoch)
-        year = local.tm_year - 1980
-        month = local.tm_mon
-        day = local.tm_mday
-
-        date = (year << 9) | (month << 5) | (day & 0x1f)
+        if date_time is None:
+            date, unused = _fat_date_time(time.time())
+            fattime = 0
+        else:
+            date, fattime = date_time
 
         self.filename = "{:<8}".format(filename)
         self.extension = "{:<3}".format(extension)
@@ -139,16 +909,17 @@ class FATDirectoryEntry(object):
             self.attributes = 0x10
         else:
             self.attributes = 0x20
-        self.creation_time = 0
+        self.creation_time = fattime
         self.creation_date = date
         self.last_access_date = date
-        self.last_write_time = 0
+        self.last_write_time = fattime
         self.last_write_date = date
         self.first_logical_cluster = first_logical_cluster
         self.file_size = file_size
 
         self.parent = parent
         self.children = []
+        self.placed = False
 
         self.initialized = True
 
@@ -166,8 +937,9 @@ class FATDirectoryEntry(object):
             raise PyFatException("This directory entry is already initialized")
 
         self._new('        ', '   ', True, 0, 0, None)
+        self.max_children = 224
 
-    def new_file(self, data_fp, length, parent, filename, extension, first_logical_cluster):
+    def new_file(self, data_fp, length, parent, filename, extension, first_logical_cluster, date_time=None):
         '''
         A method to create a new file.
 
@@ -178,6 +950,7 @@ class FATDirectoryEntry(object):
          filename - The filename to give to this directory entry; it must be 8 characters or less.
          extension - The extension to give to this directory entry; it must be 3 characters or less.
          first_logical_cluster - The first logical cluster in the FAT for this directory entry.
+         date_time - A tuple of the FAT date and FAT time for this entry, or None for today.
         Returns:
          Nothing.
         '''
@@ -186,10 +959,10 @@ class FATDirectoryEntry(object):
 
         self.data_fp = data_fp
         self.original_data_location = self.DATA_IN_EXTERNAL_FP
-        self._new(filename, extension, False, first_logical_cluster, length, parent)
+        self._new(filename, extension, False, first_logical_cluster, length, parent, date_time)
 
 
-    def new_dir(self, parent, filename, extension, first_logical_cluster):
+    def new_dir(self, parent, filename, extension, first_logical_cluster, date_time=None):
         '''
         A method to create a new directory.
 
@@ -198,15 +971,16 @@ class FATDirectoryEntry(object):
          filename - The filename for the new directory.
          extension - The extension for the new directory.
          first_logical_cluster - The first logical cluster for the new directory.
+         date_time - A tuple of the FAT date and FAT time for this entry, or None for today.
         Returns:
          Nothing.
         '''
         if self.initialized:
             raise PyFatException("This directory entry is already initialized")
 
-        self._new(filename, extension, True, first_logical_cluster, 0, parent)
+        self._new(filename, extension, True, first_logical_cluster, 0, parent, date_time)
 
-    def new_dot(self, parent, first_logical_cluster):
+    def new_dot(self, parent, first_logical_cluster, date_time=None):
         '''
         A method to create a new '.' directory.  Every directory must start
         with a '.' and '..' entry.
@@ -214,28 +988,30 @@ class FATDirectoryEntry(object):
         Parameters:
          parent - The parent for the new '.' directory.
          first_logical_cluster - The first logical cluster for the new '.' directory.  Note that this will be the same as the first logical cluster for the parent.
+         date_time - A tuple of the FAT date and FAT time for this entry, or None for today.
         Returns:
          Nothing.
         '''
         if self.initialized:
             raise PyFatException("This directory entry is already initialized")
 
-        self._new('.', '', True, first_logical_cluster, 0, parent)
+        self._new('.', '', True, first_logical_cluster, 0, parent, date_time)
 
-    def new_dotdot(self, parent):
+    def new_dotdot(self, parent, date_time=None):
         '''
         A method to create a new '..' directory.  Every directory must start
         with a '.' and '..' entry.
 
         Parameters:
          parent - The parent for the new '..' directory.
+         date_time - A tuple of the FAT date and FAT time for this entry, or None for today.
         Returns:
          Nothing.
         '''
         if self.initialized:
             raise PyFatException("This directory entry is already initialized")
 
-        self._new('..', '', True, 0, 0, parent)
+        self._new('..', '', True, 0, 0, parent, date_time)
 
     def is_dir(self):
         '''
@@ -279,6 +1055,25 @@ class FATDirectoryEntry(object):
 
         return self.filename == '..      '
 
+    def full_name(self):
+        '''
+        A method to get the name of this entry as it appears in a path; that
+        is, the filename and extension with the padding removed.
+
+        Parameters:
+         None.
+        Returns:
+         A string containing the name of this entry.
+        '''
+        if not self.initialized:
+            raise PyFatException("This directory entry is not yet initialized")
+
+        fullname = self.filename.rstrip()
+        if len(self.extension.rstrip()) > 0:
+            fullname += "." + self.extension.rstrip()
+
+        return fullname
+
     def add_child(self, child):
         '''
         A method to add a new child to this entry.  This is only valid if this
@@ -298,9 +1093,9 @@ class FATDirectoryEntry(object):
         if self.is_dot() or self.is_dotdot():
             raise PyFatException("Cannot add children to dot or dotdot")
 
-        if self.parent is None and len(self.children) == 224:
-            # The root entry has a fixed limit of 224 entries.
-            raise PyFatException("Too many files in the root entry (max is 224)")
+        if self.parent is None and len(self.children) == self.max_children:
+            # The root entry of FAT12 and FAT16 has a fixed number of entries.
+            raise PyFatException("Too many files in the root entry (max is %d)" % (self.max_children))
 
         self.children.append(child)
 
@@ -337,12 +1132,17 @@ class FATDirectoryEntry(object):
         if not self.initialized:
             raise PyFatException("This directory entry is not yet initialized")
 
-        return struct.pack("=8s3sBHHHHHHHHL", bytes("{:<8}".format(self.filename), 'utf-8'),
-                           bytes("{:<3}".format(self.extension), 'utf-8'),
+        filename = "{:<8}".format(self.filename).encode(self.NAME_CODEC)
+        if filename[0:1] == b'\xe5':
+            filename = b'\x05' + filename[1:]
+
+        return struct.pack("=8s3sBHHHHHHHHL", filename,
+                           "{:<3}".format(self.extension).encode(self.NAME_CODEC),
                            self.attributes, 0, self.creation_time,
-                           self.creation_date, self.last_access_date, 0,
+                           self.creation_date, self.last_access_date,
+                           self.first_logical_cluster >> 16,
                            self.last_write_time, self.last_write_date,
-                           self.first_logical_cluster, self.file_size)
+                           self.first_logical_cluster & 0xffff, self.file_size)
 
     def set_hidden(self):
         '''
@@ -456,6 +1256,77 @@ class FATDirectoryEntry(object):
 
         self.attributes &= ~0x01
 
+class _SharedDirectoryEntry(FATDirectoryEntry):
+    '''
+    An internal class that represents a FAT Directory Entry read from the
+    directory table of shared metadata (see PyFat.share_metadata()).  The
+    children of a directory are only read out of the table the first time
+    they are used, so a process that attaches to the metadata only builds the
+    part of the tree that it looks at.
+    '''
+    _load_lock = threading.Lock()
+
+    def __init__(self, table, table_offset, num_records, index, data_fp):
+        FATDirectoryEntry.__init__(self)
+        self._table = table
+        self._table_offset = table_offset
+        self._num_records = num_records
+        self._index = index
+        self._data_fp = data_fp
+        self._children = None
+
+    @property
+    def children(self):
+        if self._children is None:
+            with self._load_lock:
+                if self._children is None:
+                    self._children = self._read_children()
+        return self._children
+
+    @children.setter
+    def children(self, children):
+        self._children = children
+
+    def parse_shared(self, parent):
+        '''
+        Method to parse this directory entry out of the directory table.
+
+        Parameters:
+         parent - The parent of this directory entry.
+        Returns:
+         Nothing.
+        '''
+        record_size = struct.calcsize(PyFat.SHARED_RECORD)
+        (self._first_child, self._num_children,
+         dir_entry) = struct.unpack_from(PyFat.SHARED_RECORD, self._table,
+                                         self._table_offset + self._index * record_size)
+        if self._first_child + self._num_children > self._num_records:
+            raise PyFatException("Corrupt PyFat metadata snapshot")
+
+        self.parse(dir_entry, parent, self._data_fp)
+        # parse() starts the entry off with no children; leave them to be
+        # read out of the table when they are needed.
+        self._children = None
+
+    def _read_children(self):
+        '''
+        An internal method to read the children of this entry out of the
+        directory table.
+
+        Parameters:
+         None.
+        Returns:
+         A list of the children of this entry.
+        '''
+        children = []
+        for index in range(self._first_child, self._first_child + self._num_children):
+            child = _SharedDirectoryEntry(self._table, self._table_offset,
+                                          self._num_records, index, self._data_fp)
+            child.parse_shared(self)
+            children.append(child)
+
+        return children
+
 class FAT12(object):
     '''
     The class that represents the FAT (File Allocation Table) for this
@@ -467,7 +1338,8 @@ class FAT12(object):
     def parse(self, fatstring, bytes_per_sector, sectors_per_fat):
         '''
         Method to parse a FAT out of a string.  The string must be
-        exactly 512*9 bytes long for this to succeed.
+        exactly bytes_per_sector*sectors_per_fat bytes long for this to
+        succeed.
 
         Parameters:
          fatstr - The string to parse.
@@ -482,12 +1354,12 @@ class FAT12(object):
 
         total_entries = bytes_per_sector * sectors_per_fat / 1.5 # Total bytes in FAT (bytes_per_sector*9) / bytes per entry (1.5)
 
-        self.fat = [0x0]*int(total_entries)
+        self.fat = array.array('H', [0x0])*int(total_entries)
         self.fat[0] = 0xff0
         self.fat[1] = 0xfff
 
         curr = 2
-        while curr < total_entries:
+        while curr < len(self.fat):
             offset = int((3*curr)/2)
             low, high = struct.unpack("=BB", fatstring[offset:offset+2])
             if curr % 2 == 0:
@@ -499,6 +1371,28 @@ class FAT12(object):
 
             self.fat[curr] = fat_entry
             curr += 1
+        self.max_cluster = len(self.fat) - 1
+        self.first_free = 2
+
+        self.initialized = True
+
+    def attach(self, entries):
+        '''
+        A method to use an existing sequence of FAT entries, such as a view
+        of shared memory, in place of parsing the FAT.  The sequence is not
+        copied.
+
+        Parameters:
+         entries - The sequence of FAT entries.
+        Returns:
+         Nothing.
+        '''
+        if self.initialized:
+            raise PyFatException("This object is already initialized")
+
+        self.fat = entries
+        self.max_cluster = len(self.fat) - 1
+        self.first_free = 2
 
         self.initialized = True
 
@@ -517,79 +1411,230 @@ class FAT12(object):
 
         total_entries = bytes_per_sector * sectors_per_fat / 1.5 # Total bytes in FAT (bytes_per_sector*9) / bytes per entry (1.5)
 
-        self.fat = [0x0]*int(total_entries)
+        self.fat = array.array('H', [0x0])*int(total_entries)
         self.fat[0] = 0xff0
         self.fat[1] = 0xfff
+        self.max_cluster = len(self.fat) - 1
+        self.first_free = 2
 
         self.initialized = True
 
+    def set_max_cluster(self, max_cluster):
+        '''
+        A method to limit allocation to the clusters that exist on the volume;
+        the FAT itself may have room for more.
+
+        Parameters:
+         max_cluster - The highest valid cluster number on the volume.
+        Returns:
+         Nothing.
+        '''
+        self.max_cluster = min(max_cluster, len(self.fat) - 1)
+
+    def resize(self, bytes_per_sector, sectors_per_fat):
+        '''
+        A method to change the size of the FAT.  Entries past the new end are
+        dropped, and new entries are free.
+
+        Parameters:
+         bytes_per_sector - The number of bytes in each sector.
+         sectors_per_fat - The new number of sectors in the FAT.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        total_entries = int(bytes_per_sector * sectors_per_fat / 1.5)
+        if total_entries < len(self.fat):
+            del self.fat[total_entries:]
+        else:
+            self.fat.extend(array.array('H', [0x0])*(total_entries - len(self.fat)))
+        self.max_cluster = len(self.fat) - 1
+
+    def relocate_entry(self, first_logical_cluster):
+        '''
+        A method to move the clusters of a chain that are above the highest
+        valid cluster into free clusters below it; the rest of the chain
+        stays where it is.
+
+        Parameters:
+         first_logical_cluster - The first logical cluster of the chain.
+        Returns:
+         The new first logical cluster of the chain.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        clusters = self.get_cluster_list(first_logical_cluster)
+        high = [index for index, cluster in enumerate(clusters) if cluster > self.max_cluster]
+        if len(high) == 0:
+            return first_logical_cluster
+
+        for index, cluster in zip(high, self._find_free(len(high))):
+            self.fat[clusters[index]] = 0
+            clusters[index] = cluster
+        self._link(clusters)
+
+        return clusters[0]
+
+    def get_free_count(self):
+        '''
+        A method to count the number of free clusters.
+
+        Parameters:
+         None.
+        Returns:
+         The number of free clusters.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        return _count_free(self.fat[2:self.max_cluster + 1])
+
     def get_cluster_list(self, first_logical_cluster):
         '''
-        A method to get the physical cluster list, given the first logical
-        cluster in a chain.
+        A method to get the list of clusters in a chain, given the first
+        logical cluster in the chain.
 
         Parameters:
          first_logical_cluster - The logical cluster to start with.
         Returns:
-         A list containing all of the physical cluster locations for this chain.
+         A list containing all of the logical clusters in this chain.
         '''
         # FIXME: we should make this a generator
 
         if not self.initialized:
             raise PyFatException("This object is not yet initialized")
 
-        physical_clusters = []
+        clusters = []
         curr = first_logical_cluster
         while True:
-            physical_clusters.append(33 + curr - 2)
+            clusters.append(curr)
             if self.fat[curr] in [0xff8, 0xff9, 0xffa, 0xffb, 0xffc, 0xffd, 0xffe, 0xfff]:
                 # This is the end!
                 break
 
             curr = self.fat[curr]
 
-        return physical_clusters
+        return clusters
+
+    def _find_free(self, num_clusters):
+        '''
+        An internal method to find the lowest numbered free clusters.  The
+        search starts at the lowest cluster that might be free, so it does
+        not rescan the allocated clusters at the start of the FAT each time.
+
+        Parameters:
+         num_clusters - The number of free clusters to find.
+        Returns:
+         A list of the free clusters, in ascending order.
+        '''
+        clusters = []
+        curr = self.first_free
+        while len(clusters) < num_clusters:
+            try:
+                curr = _find_zero(self.fat, curr, self.max_cluster + 1)
+            except ValueError:
+                raise PyFatException("No space left on device")
+            clusters.append(curr)
+            curr += 1
+
+        # Everything below the last cluster found is now in use.
+        self.first_free = curr
+
+        return clusters
+
+    def _link(self, clusters):
+        '''
+        An internal method to link a list of clusters together into a chain.
+
+        Parameters:
+         clusters - The list of clusters, in chain order.
+        Returns:
+         Nothing.
+        '''
+        for curr, nextcluster in zip(clusters, clusters[1:]):
+            self.fat[curr] = nextcluster
+        self.fat[clusters[-1]] = 0xfff
 
-    def add_entry(self, length, bytes_per_sector):
+    def add_entry(self, length, bytes_per_cluster):
         '''
         A method to add a new entry to the FAT.  As many entries as necessary
         to cover the length will be allocated and linked together.
 
         Parameters:
          length - The length of the entry to be allocated.
+         bytes_per_cluster - The number of bytes in each cluster.
         Returns:
-         The first logical cluster.
+         The first logical cluster, or 0 if the length is 0.
         '''
         if not self.initialized:
             raise PyFatException("This object is not yet initialized")
 
+        if length == 0:
+            # Empty files don't get any clusters at all.
+            return 0
+
         # Update the FAT to hold the data for the file
-        num_clusters = _ceiling_div(length, bytes_per_sector)
-        first_cluster = None
+        clusters = self._find_free(_ceiling_div(length, bytes_per_cluster))
+        self._link(clusters)
 
-        last = None
-        curr = 2
-        while curr < len(self.fat) and num_clusters > 0:
-            if self.fat[curr] == 0x0:
-                if first_cluster is None:
-                    first_cluster = curr
+        return clusters[0]
+
+    def add_entries(self, lengths, bytes_per_cluster):
+        '''
+        A method to add many new entries to the FAT at once.  The clusters for
+        all of them are found in a single pass over the FAT, and each entry
+        gets the clusters following the previous one.
 
-                if last is not None:
-                    self.fat[last] = curr
+        Parameters:
+         lengths - A list of the lengths of the entries to be allocated.
+         bytes_per_cluster - The number of bytes in each cluster.
+        Returns:
+         A list of the first logical cluster of each entry, with 0 for any
+         entry with a length of 0.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
 
-                last = curr
+        counts = [_ceiling_div(length, bytes_per_cluster) for length in lengths]
+        total = sum(counts)
+        clusters = []
+        if total > 0:
+            clusters = self._find_free(total)
+
+        firsts = []
+        start = 0
+        for count in counts:
+            if count == 0:
+                firsts.append(0)
+                continue
+            self._link(clusters[start:start + count])
+            firsts.append(clusters[start])
+            start += count
 
-                num_clusters -= 1
+        return firsts
 
-            curr += 1
+    def extend_chain(self, last_logical_cluster, num_clusters):
+        '''
+        A method to add clusters to the end of a chain, given the last
+        cluster of the chain, so the chain does not have to be walked.
 
-        if first_cluster is None or num_clusters != 0:
-            raise PyFatException("No space left on device")
+        Parameters:
+         last_logical_cluster - The last cluster of the chain to extend.
+         num_clusters - The number of clusters to add.
+        Returns:
+         The new last cluster of the chain.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
 
-        # Set the last cluster
-        self.fat[last] = 0xfff
+        clusters = self._find_free(num_clusters)
+        self._link(clusters)
+        self.fat[last_logical_cluster] = clusters[0]
 
-        return first_cluster
+        return clusters[-1]
 
     def expand_entry(self, first_logical_cluster):
         '''
@@ -604,58 +1649,92 @@ class FAT12(object):
         if not self.initialized:
             raise PyFatException("This object is not yet initialized")
 
-        old_last_entry = None
-        curr = first_logical_cluster
-        while True:
-            if self.fat[curr] in [0xff8, 0xff9, 0xffa, 0xffb, 0xffc, 0xffd, 0xffe, 0xfff]:
-                # OK, we've found the last entry for this entry.  Let's save
-                # the offset so we can come back and update it once we've found
-                # the new cluster.
-                old_last_entry = curr
-                break
+        self.extend_chain(self.get_cluster_list(first_logical_cluster)[-1], 1)
 
-            curr = self.fat[curr]
+    def remove_entry(self, first_logical_cluster):
+        '''
+        A method to remove a chain of clusters from the FAT.
+
+        Parameters:
+         first_logical_cluster - The cluster to start from.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
 
-        if old_last_entry is None:
-            raise PyFatException("Old last entry not found!")
+        if first_logical_cluster == 0:
+            # An empty file; there is no chain to remove.
+            return
 
-        # Now that we have the old last entry, let's scan the entire FAT for
-        # a free cluster.
-        curr = 2
-        while curr < len(self.fat):
-            if self.fat[curr] == 0x0:
-                # OK we've found a free entry; update it to be the end, update
-                # the last entry to point to this, and get out of here.
-                self.fat[old_last_entry] = curr
-                self.fat[curr] = 0xfff
-                return
+        clusters = self.get_cluster_list(first_logical_cluster)
+        for curr in clusters:
+            self.fat[curr] = 0
 
-            curr += 1
+        self.first_free = min(self.first_free, min(clusters))
 
-        raise PyFatException("No space left on device")
+    def truncate_entry(self, first_logical_cluster, num_clusters):
+        '''
+        A method to cut a chain of clusters down to a number of clusters,
+        freeing the rest.
 
-    def remove_entry(self, first_logical_cluster):
+        Parameters:
+         first_logical_cluster - The first logical cluster of the chain.
+         num_clusters - The number of clusters to keep.
+        Returns:
+         The first logical cluster of the chain, or 0 if nothing was kept.
         '''
-        A method to remove a chain of clusters from the FAT.
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        if num_clusters == 0:
+            self.remove_entry(first_logical_cluster)
+            return 0
+
+        clusters = self.get_cluster_list(first_logical_cluster)
+        if num_clusters < len(clusters):
+            self.remove_entry(clusters[num_clusters])
+            self._link(clusters[num_clusters - 1:num_clusters])
+
+        return first_logical_cluster
+
+    def remove_entries(self, first_logical_clusters):
+        '''
+        A method to remove many chains of clusters from the FAT at once.
 
         Parameters:
-         first_logical_cluster - The cluster to start from.
+         first_logical_clusters - A list of the clusters each chain starts from; 0 entries are ignored.
         Returns:
          Nothing.
         '''
         if not self.initialized:
             raise PyFatException("This object is not yet initialized")
 
-        curr = first_logical_cluster
-        while True:
-            if self.fat[curr] in [0xff8, 0xff9, 0xffa, 0xffb, 0xffc, 0xffd, 0xffe, 0xfff]:
-                # This is the end!
-                self.fat[curr] = 0
-                break
+        clusters = []
+        for first_logical_cluster in first_logical_clusters:
+            if first_logical_cluster != 0:
+                clusters.extend(self.get_cluster_list(first_logical_cluster))
 
-            nextcluster = self.fat[curr]
+        for curr in clusters:
             self.fat[curr] = 0
-            curr = nextcluster
+
+        if len(clusters) > 0:
+            self.first_free = min(self.first_free, min(clusters))
+
+    def restore_entry(self, clusters):
+        '''
+        A method to put back a chain of clusters that was removed, such as
+        when a change is being undone.  The clusters must all be free.
+
+        Parameters:
+         clusters - The list of clusters in the chain, in chain order.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        self._link(clusters)
 
     def record(self, bytes_per_sector, sectors_per_fat):
         '''
@@ -669,14 +1748,22 @@ class FAT12(object):
         if not self.initialized:
             raise PyFatException("This object is not yet initialized")
 
+        # Entries are packed in pairs into 3 bytes; if the size of the FAT
+        # isn't a multiple of 3, the last pair is cut short.
+        total_bytes = bytes_per_sector * sectors_per_fat
+        fat = self.fat
+        needed = _ceiling_div(total_bytes, 3) * 2
+        if len(fat) < needed:
+            fat = fat + array.array('H', [0x0])*(needed - len(fat))
+
         ret = b''
-        for byte in range(0, bytes_per_sector*sectors_per_fat, 3):
+        for byte in range(0, total_bytes, 3):
             curr = int(byte * 2/3)
-            ret += struct.pack("=B", self.fat[curr] & 0xff)
-            ret += struct.pack("=B", ((self.fat[curr] >> 8) | (self.fat[curr + 1] << 4)) & 0xff)
-            ret += struct.pack("=B", self.fat[curr + 1] & 0xff)
+            ret += struct.pack("=B", fat[curr] & 0xff)
+            ret += struct.pack("=B", ((fat[curr] >> 8) | (fat[curr + 1] << 4)) & 0xff)
+            ret += struct.pack("=B", (fat[curr + 1] >> 4) & 0xff)
 
-        return ret
+        return ret[:total_bytes]
 
 class FAT16(object):
     '''
@@ -689,7 +1776,8 @@ class FAT16(object):
     def parse(self, fatstring, bytes_per_sector, sectors_per_fat):
         '''
         Method to parse a FAT out of a string.  The string must be
-        exactly 512*9 bytes long for this to succeed.
+        exactly bytes_per_sector*sectors_per_fat bytes long for this to
+        succeed.
 
         Parameters:
          fatstr - The string to parse.
@@ -702,18 +1790,34 @@ class FAT16(object):
         if len(fatstring) != bytes_per_sector * sectors_per_fat:
             raise PyFatException("Invalid length on FAT16 string")
 
-        total_entries = bytes_per_sector * 9 / 2 # Total bytes in FAT (bytes_per_sector*9) / bytes per entry (2)
+        # The entries are little-endian 16-bit values, so the whole table can
+        # be loaded in one go.
+        self.fat = array.array('H')
+        self.fat.frombytes(fatstring)
+        if sys.byteorder == 'big':
+            self.fat.byteswap()
+        self.max_cluster = len(self.fat) - 1
+        self.first_free = 2
 
-        self.fat = [0x0]*int(total_entries)
-        self.fat[0] = 0xfff8
-        self.fat[1] = 0xffff
+        self.initialized = True
 
-        curr = 2
-        while curr < total_entries:
-            offset = curr*2
-            (fat_entry) = struct.unpack("=H", fatstring[offset:offset+2])
-            self.fat[curr] = fat_entry
-            curr += 2
+    def attach(self, entries):
+        '''
+        A method to use an existing sequence of FAT entries, such as a view
+        of shared memory, in place of parsing the FAT.  The sequence is not
+        copied.
+
+        Parameters:
+         entries - The sequence of FAT entries.
+        Returns:
+         Nothing.
+        '''
+        if self.initialized:
+            raise PyFatException("This object is already initialized")
+
+        self.fat = entries
+        self.max_cluster = len(self.fat) - 1
+        self.first_free = 2
 
         self.initialized = True
 
@@ -730,957 +1834,4306 @@ class FAT16(object):
         if self.initialized:
             raise PyFatException("This object is already initialized")
 
-        total_entries = bytes_per_sector * sectors_per_fat / 2 # Total bytes in FAT (bytes_per_sector*9) / bytes per entry (2)
+        total_entries = bytes_per_sector * sectors_per_fat // 2 # Total bytes in FAT / bytes per entry (2)
 
-        self.fat = [0x0]*int(total_entries)
+        self.fat = array.array('H', [0x0])*total_entries
         self.fat[0] = 0xfff8
         self.fat[1] = 0xffff
+        self.max_cluster = len(self.fat) - 1
+        self.first_free = 2
 
         self.initialized = True
 
-    def get_cluster_list(self, first_logical_cluster):
+    def set_max_cluster(self, max_cluster):
         '''
-        A method to get the physical cluster list, given the first logical
-        cluster in a chain.
+        A method to limit allocation to the clusters that exist on the volume;
+        the FAT itself may have room for more.
 
         Parameters:
-         first_logical_cluster - The logical cluster to start with.
+         max_cluster - The highest valid cluster number on the volume.
         Returns:
-         A list containing all of the physical cluster locations for this chain.
+         Nothing.
         '''
-        # FIXME: we should make this a generator
+        self.max_cluster = min(max_cluster, len(self.fat) - 1)
 
+    def resize(self, bytes_per_sector, sectors_per_fat):
+        '''
+        A method to change the size of the FAT.  Entries past the new end are
+        dropped, and new entries are free.
+
+        Parameters:
+         bytes_per_sector - The number of bytes in each sector.
+         sectors_per_fat - The new number of sectors in the FAT.
+        Returns:
+         Nothing.
+        '''
         if not self.initialized:
             raise PyFatException("This object is not yet initialized")
 
-        physical_clusters = []
-        curr = first_logical_cluster
-        while True:
-            physical_clusters.append(33 + curr - 2)
-            if self.fat[curr] in [0xfff8, 0xfff9, 0xfffa, 0xfffb, 0xfffc, 0xfffd, 0xfffe, 0xffff]:
-                # This is the end!
-                break
-
-            curr = self.fat[curr]
-
-        return physical_clusters
+        total_entries = bytes_per_sector * sectors_per_fat // 2
+        if total_entries < len(self.fat):
+            del self.fat[total_entries:]
+        else:
+            self.fat.extend(array.array('H', [0x0])*(total_entries - len(self.fat)))
+        self.max_cluster = len(self.fat) - 1
 
-    def add_entry(self, length, bytes_per_sector):
+    def relocate_entry(self, first_logical_cluster):
         '''
-        A method to add a new entry to the FAT.  As many entries as necessary
-        to cover the length will be allocated and linked together.
+        A method to move the clusters of a chain that are above the highest
+        valid cluster into free clusters below it; the rest of the chain
+        stays where it is.
 
         Parameters:
-         length - The length of the entry to be allocated.
+         first_logical_cluster - The first logical cluster of the chain.
         Returns:
-         The first logical cluster.
+         The new first logical cluster of the chain.
         '''
         if not self.initialized:
             raise PyFatException("This object is not yet initialized")
 
-        # Update the FAT to hold the data for the file
-        num_clusters = _ceiling_div(length, bytes_per_sector)
-        first_cluster = None
-
-        last = None
-        curr = 2
-        while curr < len(self.fat) and num_clusters > 0:
-            if self.fat[curr] == 0x0:
-                if first_cluster is None:
-                    first_cluster = curr
-
-                if last is not None:
-                    self.fat[last] = curr
+        clusters = self.get_cluster_list(first_logical_cluster)
+        high = [index for index, cluster in enumerate(clusters) if cluster > self.max_cluster]
+        if len(high) == 0:
+            return first_logical_cluster
 
-                last = curr
+        for index, cluster in zip(high, self._find_free(len(high))):
+            self.fat[clusters[index]] = 0
+            clusters[index] = cluster
+        self._link(clusters)
 
-                num_clusters -= 1
-
-            curr += 1
+        return clusters[0]
 
-        if first_cluster is None or num_clusters != 0:
-            raise PyFatException("No space left on device")
+    def get_free_count(self):
+        '''
+        A method to count the number of free clusters.
 
-        # Set the last cluster
-        self.fat[last] = 0xffff
+        Parameters:
+         None.
+        Returns:
+         The number of free clusters.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
 
-        return first_cluster
+        return _count_free(self.fat[2:self.max_cluster + 1])
 
-    def expand_entry(self, first_logical_cluster):
+    def get_cluster_list(self, first_logical_cluster):
         '''
-        A method to expand the number of clusters assigned to the entry starting
-        at the given logical cluster.
+        A method to get the list of clusters in a chain, given the first
+        logical cluster in the chain.
 
         Parameters:
-         first_logical_cluster - The first logical cluster of the entry to expand.
+         first_logical_cluster - The logical cluster to start with.
         Returns:
-         Nothing.
+         A list containing all of the logical clusters in this chain.
         '''
+        # FIXME: we should make this a generator
+
         if not self.initialized:
             raise PyFatException("This object is not yet initialized")
 
-        old_last_entry = None
+        clusters = []
         curr = first_logical_cluster
         while True:
+            clusters.append(curr)
             if self.fat[curr] in [0xfff8, 0xfff9, 0xfffa, 0xfffb, 0xfffc, 0xfffd, 0xfffe, 0xffff]:
-                # OK, we've found the last entry for this entry.  Let's save
-                # the offset so we can come back and update it once we've found
-                # the new cluster.
-                old_last_entry = curr
+                # This is the end!
                 break
 
             curr = self.fat[curr]
 
-        if old_last_entry is None:
-            raise PyFatException("Old last entry not found!")
+        return clusters
 
-        # Now that we have the old last entry, let's scan the entire FAT for
-        # a free cluster.
-        curr = 2
-        while curr < len(self.fat):
-            if self.fat[curr] == 0x0:
-                # OK we've found a free entry; update it to be the end, update
-                # the last entry to point to this, and get out of here.
-                self.fat[old_last_entry] = curr
-                self.fat[curr] = 0xffff
-                return
+    def _find_free(self, num_clusters):
+        '''
+        An internal method to find the lowest numbered free clusters.  The
+        search starts at the lowest cluster that might be free, so it does
+        not rescan the allocated clusters at the start of the FAT each time.
 
+        Parameters:
+         num_clusters - The number of free clusters to find.
+        Returns:
+         A list of the free clusters, in ascending order.
+        '''
+        clusters = []
+        curr = self.first_free
+        while len(clusters) < num_clusters:
+            try:
+                curr = _find_zero(self.fat, curr, self.max_cluster + 1)
+            except ValueError:
+                raise PyFatException("No space left on device")
+            clusters.append(curr)
             curr += 1
 
-        raise PyFatException("No space left on device")
+        # Everything below the last cluster found is now in use.
+        self.first_free = curr
 
-    def remove_entry(self, first_logical_cluster):
+        return clusters
+
+    def _link(self, clusters):
         '''
-        A method to remove a chain of clusters from the FAT.
+        An internal method to link a list of clusters together into a chain.
 
         Parameters:
-         first_logical_cluster - The cluster to start from.
+         clusters - The list of clusters, in chain order.
         Returns:
          Nothing.
         '''
-        if not self.initialized:
-            raise PyFatException("This object is not yet initialized")
-
-        curr = first_logical_cluster
-        while True:
-            if self.fat[curr] in [0xfff8, 0xfff9, 0xfffa, 0xfffb, 0xfffc, 0xfffd, 0xfffe, 0xffff]:
-                # This is the end!
-                self.fat[curr] = 0
-                break
-
-            nextcluster = self.fat[curr]
-            self.fat[curr] = 0
-            curr = nextcluster
+        for curr, nextcluster in zip(clusters, clusters[1:]):
+            self.fat[curr] = nextcluster
+        self.fat[clusters[-1]] = 0xffff
 
-    def record(self, bytes_per_sector, sectors_per_fat):
+    def add_entry(self, length, bytes_per_cluster):
         '''
-        A method to generate a string representing this File Allocation Table.
+        A method to add a new entry to the FAT.  As many entries as necessary
+        to cover the length will be allocated and linked together.
 
         Parameters:
-         None.
+         length - The length of the entry to be allocated.
+         bytes_per_cluster - The number of bytes in each cluster.
         Returns:
-         A string representing this File Allocation Table.
+         The first logical cluster, or 0 if the length is 0.
         '''
         if not self.initialized:
             raise PyFatException("This object is not yet initialized")
 
-        ret = b''
-        for byte in range(0, bytes_per_sector*sectors_per_fat, 2):
-            curr = int(byte / 2)
-            ret += struct.pack("=H", self.fat[curr])
+        if length == 0:
+            # Empty files don't get any clusters at all.
+            return 0
 
-        return ret
+        # Update the FAT to hold the data for the file
+        clusters = self._find_free(_ceiling_div(length, bytes_per_cluster))
+        self._link(clusters)
 
-class PyFat(object):
-    '''
-    The main class to open or create FAT filesystems.
-    '''
-    FAT12 = 0
-    FAT16 = 1
-    FAT32 = 2
-
-    # This boot code was taken from dosfstools
-    BOOT_CODE = b"\x0e\x1f\xbe\x5b\x7c\xac\x22\xc0\x74\x0b\x56\xb4\x0e\xbb\x07\x00\xcd\x10\x5e\xeb\xf0\x32\xe4\xcd\x16\xcd\x19\xeb\xfeThis is not a bootable disk.  Please insert a bootable floppy and\r\npress any key to try again ... \r\n"
-
-    def __init__(self):
-        self.orig_fp = None
-        self.initialized = False
+        return clusters[0]
 
-    def _determine_fat_type(self):
+    def add_entries(self, lengths, bytes_per_cluster):
         '''
-        An internal method to determine whether this volume is FAT12, FAT16,
-        or FAT32.  Note that this expects to be called *after* the common
-        BPB is parsed on the filesystem.
+        A method to add many new entries to the FAT at once.  The clusters for
+        all of them are found in a single pass over the FAT, and each entry
+        gets the clusters following the previous one.
 
         Parameters:
-         None
+         lengths - A list of the lengths of the entries to be allocated.
+         bytes_per_cluster - The number of bytes in each cluster.
         Returns:
-         A tuple containing the number of root directory sectors and the FAT type that this volume is.
+         A list of the first logical cluster of each entry, with 0 for any
+         entry with a length of 0.
         '''
-        # The following determines whether this is FAT12, FAT16, or FAT32
-        root_dir_sectors = ((self.max_root_dir_entries * 32) + (self.bytes_per_sector - 1)) / self.bytes_per_sector
-        if self.sectors_per_fat != 0:
-            fat_size = self.sectors_per_fat
-        else:
-            raise PyFatException("Only support FAT12 right now!")
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
 
-        if self.sector_count != 0:
-            total_sectors = self.sector_count
-        else:
-            total_sectors = self.total_sector_count_32
+        counts = [_ceiling_div(length, bytes_per_cluster) for length in lengths]
+        total = sum(counts)
+        clusters = []
+        if total > 0:
+            clusters = self._find_free(total)
+
+        firsts = []
+        start = 0
+        for count in counts:
+            if count == 0:
+                firsts.append(0)
+                continue
+            self._link(clusters[start:start + count])
+            firsts.append(clusters[start])
+            start += count
 
-        data_sec = total_sectors - (self.reserved_sectors + (self.num_fats * fat_size) + root_dir_sectors)
-        # FIXME: according to the FAT spec, count_of_clusters + 1 is the maximum
-        # valid cluster number for the volume.  We may want to save that value.
-        count_of_clusters = data_sec / self.sectors_per_cluster
+        return firsts
 
-        if count_of_clusters < 4085:
-            fat_type = self.FAT12
-        elif count_of_clusters < 65525:
-            fat_type = self.FAT16
-        else:
-            fat_type = self.FAT32
+    def extend_chain(self, last_logical_cluster, num_clusters):
+        '''
+        A method to add clusters to the end of a chain, given the last
+        cluster of the chain, so the chain does not have to be walked.
 
-        return (root_dir_sectors, fat_type)
+        Parameters:
+         last_logical_cluster - The last cluster of the chain to extend.
+         num_clusters - The number of clusters to add.
+        Returns:
+         The new last cluster of the chain.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        clusters = self._find_free(num_clusters)
+        self._link(clusters)
+        self.fat[last_logical_cluster] = clusters[0]
 
-    def open(self, filename):
+        return clusters[-1]
+
+    def expand_entry(self, first_logical_cluster):
         '''
-        A method to open up an existing FAT filesystem.
+        A method to expand the number of clusters assigned to the entry starting
+        at the given logical cluster.
 
         Parameters:
-         filename - The filename that contains the FAT filesystem to open.
+         first_logical_cluster - The first logical cluster of the entry to expand.
         Returns:
          Nothing.
         '''
-        if self.initialized:
-            raise PyFatException("This object is already initialized")
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
 
-        self.orig_fp = open(filename, 'rb')
+        self.extend_chain(self.get_cluster_list(first_logical_cluster)[-1], 1)
 
-        self.orig_fp.seek(0, os.SEEK_END)
-        self.size_in_kb = self.orig_fp.tell() / 1024
+    def remove_entry(self, first_logical_cluster):
+        '''
+        A method to remove a chain of clusters from the FAT.
 
-        self.orig_fp.seek(0)
+        Parameters:
+         first_logical_cluster - The cluster to start from.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
 
-        boot_sector = self.orig_fp.read(512)
+        if first_logical_cluster == 0:
+            # An empty file; there is no chain to remove.
+            return
 
-        (self.jmp_boot, self.oem_name, self.bytes_per_sector,
-         self.sectors_per_cluster, self.reserved_sectors, self.num_fats,
-         self.max_root_dir_entries, self.sector_count, self.media,
-         self.sectors_per_fat, self.sectors_per_track, self.num_heads,
-         self.hidden_sectors, self.total_sector_count_32) = struct.unpack("=3s8sHBHBHHBHHHLL", boot_sector[:36])
+        clusters = self.get_cluster_list(first_logical_cluster)
+        for curr in clusters:
+            self.fat[curr] = 0
 
-        if self.jmp_boot[0] == 0xEB:
-            if self.jmp_boot[2] != 0x90:
-                raise PyFatException("Boot code must end with 0x90")
-        elif self.jmp_boot[0] == 0xE9:
-            pass
-        else:
-            raise PyFatException("Boot code must start with 0xEB or 0xE9")
+        self.first_free = min(self.first_free, min(clusters))
 
-        if self.bytes_per_sector not in [512, 1024, 2048, 4096]:
-            raise PyFatException("Expected 512, 1024, 2048, or 4096 bytes per sector")
+    def truncate_entry(self, first_logical_cluster, num_clusters):
+        '''
+        A method to cut a chain of clusters down to a number of clusters,
+        freeing the rest.
 
-        if self.sectors_per_cluster not in [1, 2, 4, 8, 16, 32, 64, 128]:
-            raise PyFatException("Expected 1, 2, 4, 8, 16, 32, 64, or 128 sector per cluster")
+        Parameters:
+         first_logical_cluster - The first logical cluster of the chain.
+         num_clusters - The number of clusters to keep.
+        Returns:
+         The first logical cluster of the chain, or 0 if nothing was kept.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
 
-        if self.reserved_sectors == 0:
-            raise PyFatException("Number of reserved sectors must not be 0")
+        if num_clusters == 0:
+            self.remove_entry(first_logical_cluster)
+            return 0
 
-        if self.media not in [0xf0, 0xf8, 0xf9, 0xfa, 0xfb, 0xfc, 0xfd, 0xfe, 0xff]:
-            raise PyFatException("Invalid media type")
+        clusters = self.get_cluster_list(first_logical_cluster)
+        if num_clusters < len(clusters):
+            self.remove_entry(clusters[num_clusters])
+            self._link(clusters[num_clusters - 1:num_clusters])
 
-        if self.num_fats not in [1, 2]:
-            raise PyFatException("Expected 1 or 2 FATs")
+        return first_logical_cluster
 
-        # FIXME: according to the FAT spec, it looks like this can actually be
-        # non-zero for FAT12 and FAT16 iff the total number of sectors
-        # is >= 0x10000.  We should be able to handle that.
-        if self.total_sector_count_32 != 0:
-            raise PyFatException("Expected the total sector count 32 to be 0:" + hex(self.total_sector_count_32))
+    def remove_entries(self, first_logical_clusters):
+        '''
+        A method to remove many chains of clusters from the FAT at once.
 
-        # FIXME: for FAT32 volumes, self.sectors_per_fat must be 0, so we should
-        # check for that here.
+        Parameters:
+         first_logical_clusters - A list of the clusters each chain starts from; 0 entries are ignored.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
 
-        (self.root_dir_sectors, self.fat_type) = self._determine_fat_type()
+        clusters = []
+        for first_logical_cluster in first_logical_clusters:
+            if first_logical_cluster != 0:
+                clusters.extend(self.get_cluster_list(first_logical_cluster))
 
-        # Now that we know the kind of FAT, we can look at the rest of the
-        # BPB fields.
-        if self.fat_type in [self.FAT12, self.FAT16]:
-            (self.drive_num, unused1, self.boot_sig, self.volume_id,
-             self.volume_label, self.fs_type, self.boot_code,
-             sig) = struct.unpack("=BBBL11s8s448sH", boot_sector[36:])
+        for curr in clusters:
+            self.fat[curr] = 0
 
-            if self.fat_type == self.FAT12 and self.fs_type not in ["FAT12   ", "FAT     "]:
-                raise PyFatException("Invalid filesystem type for FAT12")
-            if self.fat_type == self.FAT16 and self.fs_type not in ["FAT16   ", "FAT     "]:
-                raise PyFatException("Invalid filesystem type for FAT16")
-        else:
-            (self.fat_size_32, self.ext_flags, self.fs_ver, self.root_cluster,
-             self.fsinfo_sector_number, self.backup_boot_sector, unused1,
-             self.drive_num, unused2, self.boot_sig, self.volume_id,
-             self.volume_label, self.fs_type, unused3, sig) = struct.unpack("=LHHLHH12sBBBL11s8s420sH", boot_sector[36:])
+        if len(clusters) > 0:
+            self.first_free = min(self.first_free, min(clusters))
 
-            if self.fs_ver != 0:
-                raise PyFatException("Invalid filesystem version on FAT32")
+    def restore_entry(self, clusters):
+        '''
+        A method to put back a chain of clusters that was removed, such as
+        when a change is being undone.  The clusters must all be free.
 
-            if self.backup_boot_sector not in [0, 6]:
-                raise PyFatException("Invalid number of backup boot sectors")
+        Parameters:
+         clusters - The list of clusters in the chain, in chain order.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
 
-            if self.fs_type != "FAT32   ":
-                raise PyFatException("Invalid filesystem type for FAT32")
+        self._link(clusters)
 
-        if self.drive_num not in [0x00, 0x80]:
-            raise PyFatException("Invalid drive number")
+    def record(self, bytes_per_sector, sectors_per_fat):
+        '''
+        A method to generate a string representing this File Allocation Table.
 
-        if sig != 0xaa55:
-            raise PyFatException("Invalid signature")
+        Parameters:
+         None.
+        Returns:
+         A string representing this File Allocation Table.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
 
-        # Read the first FAT
-        first_fat = self.orig_fp.read(self.bytes_per_sector * self.sectors_per_fat)
+        fat = array.array('H', self.fat[:bytes_per_sector * sectors_per_fat // 2])
+        if sys.byteorder == 'big':
+            fat.byteswap()
 
-        if self.num_fats == 2:
-            # Read the second FAT if it exists
-            second_fat = self.orig_fp.read(self.bytes_per_sector * self.sectors_per_fat)
+        return fat.tobytes()
 
-            if first_fat != second_fat:
-                raise PyFatException("The first FAT and second FAT do not agree; corrupt FAT filesystem")
+class FAT32(object):
+    '''
+    The class that represents the FAT (File Allocation Table) for this
+    filesystem.  This class represents the 32-bit FAT, of which only the low
+    28 bits of each entry are used.  It also keeps the free cluster count and
+    next free cluster hints from the FSInfo sector, so that neither has to
+    scan the whole table.
+    '''
+    def __init__(self):
+        self.initialized = False
 
-        self.bytes_per_cluster = self.bytes_per_sector * self.sectors_per_cluster
+    def parse(self, fatstring, bytes_per_sector, sectors_per_fat):
+        '''
+        Method to parse a FAT out of a string.  The string must be
+        exactly bytes_per_sector*sectors_per_fat bytes long for this to
+        succeed.
+
+        Parameters:
+         fatstr - The string to parse.
+        Returns:
+         Nothing.
+        '''
+        if self.initialized:
+            raise PyFatException("This object is already initialized")
 
-        self.fat = FAT12()
-        self.fat.parse(first_fat, self.bytes_per_sector, self.sectors_per_fat)
+        if len(fatstring) != bytes_per_sector * sectors_per_fat:
+            raise PyFatException("Invalid length on FAT32 string")
 
-        # Now walk the root directory entry
-        self.root = FATDirectoryEntry()
-        self.root.parse(b'           \x10\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00', None, self.orig_fp)
-        root_cluster_list = []
-        # The first root directory sector is preceded by:
-        # BPB consisting of 1 sector
-        # First FAT consisting of self.sectors_per_fat sectors
-        # (Optional) Second FAT consisting of self.sectors_per_fat sectors
-        first_root_dir_sector = 1 + (self.num_fats * self.sectors_per_fat)
-        for i in range(first_root_dir_sector, first_root_dir_sector+self.root_dir_sectors):
-            root_cluster_list.append(i)
-
-        dirs = collections.deque([(self.root, root_cluster_list)])
-        while dirs:
-            currdir, cluster_list = dirs.popleft()
+        self.fat = array.array('I')
+        self.fat.frombytes(fatstring)
+        if sys.byteorder == 'big':
+            self.fat.byteswap()
+        self.max_cluster = len(self.fat) - 1
+        self.free_count = None
+        self.next_free = None
 
-            # Read all of the data for this directory
-            data = ''
-            for cluster in cluster_list:
-                self.orig_fp.seek(cluster * self.bytes_per_cluster)
-                data += self.orig_fp.read(self.bytes_per_cluster)
+        self.initialized = True
 
-            read = 0
-            while read < len(data):
-                dir_entry = data[read:read+32]
-                read += 32
+    def attach(self, entries):
+        '''
+        A method to use an existing sequence of FAT entries, such as a view
+        of shared memory, in place of parsing the FAT.  The sequence is not
+        copied.
 
-                if dir_entry[0] == b'\x00':
-                    # Empty dir entry, done reading
-                    break
-                elif dir_entry[0] == b'\xe5':
-                    # Empty dir entry, skip to next one
-                    continue
+        Parameters:
+         entries - The sequence of FAT entries.
+        Returns:
+         Nothing.
+        '''
+        if self.initialized:
+            raise PyFatException("This object is already initialized")
 
-                ent = FATDirectoryEntry()
-                ent.parse(dir_entry, currdir, self.orig_fp)
-                currdir.add_child(ent)
-                if ent.is_dir() and not (ent.is_dot() or ent.is_dotdot()):
-                    dirs.append((ent, self.fat.get_cluster_list(ent.first_logical_cluster)))
+        self.fat = entries
+        self.max_cluster = len(self.fat) - 1
+        self.free_count = None
+        self.next_free = None
 
         self.initialized = True
 
-    def _find_record(self, path):
+    def new(self, bytes_per_sector, sectors_per_fat):
         '''
-        An internal method to find a FAT directory entry based on a given path.
-        The path should be of the form '/dir1/file'.
+        A method to create a new FAT32.  All entries are initially set to 0
+        (unallocated), except for the first two.
 
         Parameters:
-         path - The path to find in the filesystem.
+         None.
         Returns:
-         A tuple of the FAT directory entry object and index of the object into the parent's child list.
+         Nothing.
         '''
-        if path[0] != '/':
-            raise PyFatException("Must be a path starting with /")
-
-        if path == '/':
-            return self.root, None
-
-       # Split the path along the slashes
-        splitpath = path.split('/')
-        # Skip past the first one, since it is always empty.
-        splitindex = 1
+        if self.initialized:
+            raise PyFatException("This object is already initialized")
 
-        currpath = splitpath[splitindex]
-        splitindex += 1
-        children = self.root.children
-        index = 0
-        while index < len(children):
-            child = children[index]
-            index += 1
+        total_entries = bytes_per_sector * sectors_per_fat // 4 # Total bytes in FAT / bytes per entry (4)
 
-            fullname = child.filename.rstrip()
-            if len(child.extension.rstrip()) > 0:
-                fullname += "." + child.extension.rstrip()
-            if fullname != currpath:
-                continue
+        self.fat = array.array('I', [0x0])*total_entries
+        self.fat[0] = 0x0ffffff8
+        self.fat[1] = 0x0fffffff
+        self.max_cluster = len(self.fat) - 1
+        self.free_count = None
+        self.next_free = None
 
-            if splitindex == len(splitpath):
-                # We have to remove one from the index since we incremented it
-                # above.
-                return child, index-1
-            else:
-                if child.is_dir():
-                    children = child.children
-                    index = 0
-                    currpath = splitpath[splitindex]
-                    splitindex += 1
+        self.initialized = True
 
-        raise PyFatException("Could not find path %s" % (path))
+    def set_max_cluster(self, max_cluster):
+        '''
+        A method to limit allocation to the clusters that exist on the volume;
+        the FAT itself may have room for more.  If the limit changes, the free
+        hints no longer apply and are dropped.
 
-    def get_and_write_file(self, fat_path, local_path):
+        Parameters:
+         max_cluster - The highest valid cluster number on the volume.
+        Returns:
+         Nothing.
         '''
-        A method to get the data from a file on the FAT filesystem.
-        The path should be of the form '/dir1/file'.
+        max_cluster = min(max_cluster, len(self.fat) - 1)
+        if max_cluster != self.max_cluster:
+            self.free_count = None
+            if self.next_free is not None and self.next_free > max_cluster:
+                self.next_free = None
+        self.max_cluster = max_cluster
+
+    def resize(self, bytes_per_sector, sectors_per_fat):
+        '''
+        A method to change the size of the FAT.  Entries past the new end are
+        dropped, and new entries are free.
 
         Parameters:
-         fat_path - The path on the FAT filesystem of the file data to get.
-         local_path - The local_path in which to write the data.
+         bytes_per_sector - The number of bytes in each sector.
+         sectors_per_fat - The new number of sectors in the FAT.
         Returns:
          Nothing.
         '''
         if not self.initialized:
             raise PyFatException("This object is not yet initialized")
 
-        child, index = self._find_record(fat_path)
+        total_entries = bytes_per_sector * sectors_per_fat // 4
+        if total_entries < len(self.fat):
+            del self.fat[total_entries:]
+        else:
+            self.fat.extend(array.array('I', [0x0])*(total_entries - len(self.fat)))
+        self.max_cluster = len(self.fat) - 1
+        self.free_count = None
+        if self.next_free is not None and self.next_free > self.max_cluster:
+            self.next_free = None
 
-        if child.is_dir():
-            raise PyFatException("Cannot get data from a directory")
+    def relocate_entry(self, first_logical_cluster):
+        '''
+        A method to move the clusters of a chain that are above the highest
+        valid cluster into free clusters below it; the rest of the chain
+        stays where it is.
 
-        with open(local_path, 'wb') as outfp:
-            new_cluster_list = self.fat.get_cluster_list(child.first_logical_cluster)
-            if child.original_data_location == child.DATA_ON_ORIGINAL_FAT:
-                # If this is a file that was on the original filesystem,
-                # then we haven't modified the cluster list and the
-                # original is the same as the new.
-                orig_cluster_list = new_cluster_list
-            elif child.original_data_location == child.DATA_IN_EXTERNAL_FP:
-                orig_cluster_list = range(0, _ceiling_div(child.file_size, self.bytes_per_cluster))
+        Parameters:
+         first_logical_cluster - The first logical cluster of the chain.
+        Returns:
+         The new first logical cluster of the chain.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
 
-            left = child.file_size
-            index = 0
-            while index < len(orig_cluster_list) and left > 0:
-                thisread = self.bytes_per_cluster
-                if left < thisread:
-                    thisread = left
+        clusters = self.get_cluster_list(first_logical_cluster)
+        high = [index for index, cluster in enumerate(clusters) if cluster > self.max_cluster]
+        if len(high) == 0:
+            return first_logical_cluster
 
-                child.data_fp.seek(orig_cluster_list[index] * self.bytes_per_cluster)
-                outfp.seek(index * self.bytes_per_cluster)
-                outfp.write(child.data_fp.read(thisread))
+        for index, cluster in zip(high, self._find_free(len(high))):
+            self.fat[clusters[index]] = 0
+            clusters[index] = cluster
+        self._link(clusters)
 
-                left -= thisread
-                index += 1
+        return clusters[0]
 
-    def new(self, size_in_kb=1440, drive_num=0, num_fats=2, hidden_sectors=0,
-            media=0xf0, root_dir_entries=224, reserved_sectors=1,
-            sectors_per_cluster=1, bytes_per_sector=512):
+    def set_hints(self, free_count, next_free):
         '''
-        A method to create a new FAT filesystem.
+        A method to set the free cluster count and next free cluster hints,
+        as read from the FSInfo sector.  Hints that are unknown or out of
+        range are ignored.
 
         Parameters:
-         size_in_kb - The size of the filesystem in kilobytes.
-         drive_num - The drive number to use for the FAT filesystem; this must be 0x0 for floppy devices or 0x80 for hard disks
+         free_count - The number of free clusters, or 0xffffffff if unknown.
+         next_free - The cluster to start looking for free clusters at, or 0xffffffff if unknown.
         Returns:
          Nothing.
         '''
-        if self.initialized:
+        self.free_count = None
+        if free_count <= self.max_cluster - 1:
+            self.free_count = free_count
+
+        self.next_free = None
+        if 2 <= next_free <= self.max_cluster:
+            self.next_free = next_free
+
+    def get_free_count(self):
+        '''
+        A method to get the number of free clusters.  This is only counted
+        the first time, if the FSInfo sector did not already say.
+
+        Parameters:
+         None.
+        Returns:
+         The number of free clusters.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        if self.free_count is None:
+            self.free_count = _count_free(self.fat[2:self.max_cluster + 1])
+
+        return self.free_count
+
+    def get_cluster_list(self, first_logical_cluster):
+        '''
+        A method to get the list of clusters in a chain, given the first
+        logical cluster in the chain.
+
+        Parameters:
+         first_logical_cluster - The logical cluster to start with.
+        Returns:
+         A list containing all of the logical clusters in this chain.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        clusters = []
+        curr = first_logical_cluster
+        while True:
+            clusters.append(curr)
+            if self.fat[curr] & 0x0fffffff >= 0x0ffffff8:
+                # This is the end!
+                break
+
+            curr = self.fat[curr] & 0x0fffffff
+
+        return clusters
+
+    def _find_free(self, num_clusters):
+        '''
+        An internal method to find free clusters and mark them as taken in the
+        free hints.  The search starts at the next free hint and wraps around.
+
+        Parameters:
+         num_clusters - The number of free clusters to find.
+        Returns:
+         A list of the free clusters.
+        '''
+        start = self.next_free
+        if start is None:
+            start = 2
+
+        clusters = []
+        for first, last in [(start, self.max_cluster + 1), (2, start)]:
+            curr = first
+            while curr < last and len(clusters) < num_clusters:
+                try:
+                    curr = _find_zero(self.fat, curr, last)
+                except ValueError:
+                    break
+                clusters.append(curr)
+                curr += 1
+
+        if len(clusters) < num_clusters:
+            raise PyFatException("No space left on device")
+
+        self.next_free = clusters[-1]
+        if self.free_count is not None:
+            self.free_count -= num_clusters
+
+        return clusters
+
+    def _link(self, clusters):
+        '''
+        An internal method to link a list of clusters together into a chain.
+
+        Parameters:
+         clusters - The list of clusters, in chain order.
+        Returns:
+         Nothing.
+        '''
+        for curr, nextcluster in zip(clusters, clusters[1:]):
+            self.fat[curr] = nextcluster
+        self.fat[clusters[-1]] = 0x0fffffff
+
+    def _allocate(self, num_clusters):
+        '''
+        An internal method to allocate and link together a chain of free
+        clusters.
+
+        Parameters:
+         num_clusters - The number of clusters to allocate.
+        Returns:
+         The list of clusters in the new chain.
+        '''
+        clusters = self._find_free(num_clusters)
+        self._link(clusters)
+
+        return clusters
+
+    def add_entry(self, length, bytes_per_cluster):
+        '''
+        A method to add a new entry to the FAT.  As many entries as necessary
+        to cover the length will be allocated and linked together.
+
+        Parameters:
+         length - The length of the entry to be allocated.
+         bytes_per_cluster - The number of bytes in each cluster.
+        Returns:
+         The first logical cluster, or 0 if the length is 0.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        if length == 0:
+            # Empty files don't get any clusters at all.
+            return 0
+
+        return self._allocate(_ceiling_div(length, bytes_per_cluster))[0]
+
+    def add_entries(self, lengths, bytes_per_cluster):
+        '''
+        A method to add many new entries to the FAT at once.  The clusters for
+        all of them are found in a single pass over the FAT, and each entry
+        gets the clusters following the previous one.
+
+        Parameters:
+         lengths - A list of the lengths of the entries to be allocated.
+         bytes_per_cluster - The number of bytes in each cluster.
+        Returns:
+         A list of the first logical cluster of each entry, with 0 for any
+         entry with a length of 0.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        counts = [_ceiling_div(length, bytes_per_cluster) for length in lengths]
+        total = sum(counts)
+        clusters = []
+        if total > 0:
+            clusters = self._find_free(total)
+
+        firsts = []
+        start = 0
+        for count in counts:
+            if count == 0:
+                firsts.append(0)
+                continue
+            self._link(clusters[start:start + count])
+            firsts.append(clusters[start])
+            start += count
+
+        return firsts
+
+    def extend_chain(self, last_logical_cluster, num_clusters):
+        '''
+        A method to add clusters to the end of a chain, given the last
+        cluster of the chain, so the chain does not have to be walked.
+
+        Parameters:
+         last_logical_cluster - The last cluster of the chain to extend.
+         num_clusters - The number of clusters to add.
+        Returns:
+         The new last cluster of the chain.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        clusters = self._allocate(num_clusters)
+        self.fat[last_logical_cluster] = clusters[0]
+
+        return clusters[-1]
+
+    def expand_entry(self, first_logical_cluster):
+        '''
+        A method to expand the number of clusters assigned to the entry starting
+        at the given logical cluster.
+
+        Parameters:
+         first_logical_cluster - The first logical cluster of the entry to expand.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        self.extend_chain(self.get_cluster_list(first_logical_cluster)[-1], 1)
+
+    def remove_entry(self, first_logical_cluster):
+        '''
+        A method to remove a chain of clusters from the FAT.
+
+        Parameters:
+         first_logical_cluster - The cluster to start from.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        if first_logical_cluster == 0:
+            # An empty file; there is no chain to remove.
+            return
+
+        clusters = self.get_cluster_list(first_logical_cluster)
+        for curr in clusters:
+            self.fat[curr] = 0
+
+        if self.free_count is not None:
+            self.free_count += len(clusters)
+
+    def truncate_entry(self, first_logical_cluster, num_clusters):
+        '''
+        A method to cut a chain of clusters down to a number of clusters,
+        freeing the rest.
+
+        Parameters:
+         first_logical_cluster - The first logical cluster of the chain.
+         num_clusters - The number of clusters to keep.
+        Returns:
+         The first logical cluster of the chain, or 0 if nothing was kept.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        if num_clusters == 0:
+            self.remove_entry(first_logical_cluster)
+            return 0
+
+        clusters = self.get_cluster_list(first_logical_cluster)
+        if num_clusters < len(clusters):
+            self.remove_entry(clusters[num_clusters])
+            self._link(clusters[num_clusters - 1:num_clusters])
+
+        return first_logical_cluster
+
+    def remove_entries(self, first_logical_clusters):
+        '''
+        A method to remove many chains of clusters from the FAT at once.
+
+        Parameters:
+         first_logical_clusters - A list of the clusters each chain starts from; 0 entries are ignored.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        clusters = []
+        for first_logical_cluster in first_logical_clusters:
+            if first_logical_cluster != 0:
+                clusters.extend(self.get_cluster_list(first_logical_cluster))
+
+        for curr in clusters:
+            self.fat[curr] = 0
+
+        if self.free_count is not None:
+            self.free_count += len(clusters)
+
+    def restore_entry(self, clusters):
+        '''
+        A method to put back a chain of clusters that was removed, such as
+        when a change is being undone.  The clusters must all be free.
+
+        Parameters:
+         clusters - The list of clusters in the chain, in chain order.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        self._link(clusters)
+
+        if self.free_count is not None:
+            self.free_count -= len(clusters)
+
+    def record(self, bytes_per_sector, sectors_per_fat):
+        '''
+        A method to generate a string representing this File Allocation Table.
+
+        Parameters:
+         None.
+        Returns:
+         A string representing this File Allocation Table.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        fat = array.array('I', self.fat[:bytes_per_sector * sectors_per_fat // 4])
+        if sys.byteorder == 'big':
+            fat.byteswap()
+
+        return fat.tobytes()
+
+class FATLayout(object):
+    '''
+    The class that describes where everything lives on a FAT filesystem: the
+    FATs, the fixed root directory of FAT12 and FAT16, and the data area, and
+    how clusters map to byte offsets in the image.
+    '''
+    def __init__(self, bytes_per_sector, sectors_per_cluster, reserved_sectors,
+                 num_fats, fat_size, root_dir_sectors):
+        self.bytes_per_sector = bytes_per_sector
+        self.bytes_per_cluster = bytes_per_sector * sectors_per_cluster
+        self.fat_bytes = fat_size * bytes_per_sector
+        # The FATs follow the reserved sectors (including the boot sector),
+        # then comes the root directory, which is empty on FAT32, and then the
+        # data area.
+        self.fat_offset = reserved_sectors * bytes_per_sector
+        self.root_dir_offset = self.fat_offset + num_fats * self.fat_bytes
+        self.root_dir_size = root_dir_sectors * bytes_per_sector
+        self.data_offset = self.root_dir_offset + self.root_dir_size
+
+    def fat_copy_offset(self, index):
+        '''
+        A method to find where a copy of the FAT lives in the image.
+
+        Parameters:
+         index - The number of the FAT copy, starting at 0.
+        Returns:
+         The byte offset of the FAT copy in the image.
+        '''
+        return self.fat_offset + index * self.fat_bytes
+
+    def cluster_offset(self, cluster):
+        '''
+        A method to find where a cluster lives in the image.
+
+        Parameters:
+         cluster - The logical cluster number.
+        Returns:
+         The byte offset of the cluster in the image.
+        '''
+        return self.data_offset + (cluster - 2) * self.bytes_per_cluster
+
+    def clusters_for(self, length):
+        '''
+        A method to find how many clusters it takes to hold some data.
+
+        Parameters:
+         length - The number of bytes of data.
+        Returns:
+         The number of clusters needed.
+        '''
+        return _ceiling_div(length, self.bytes_per_cluster)
+
+    def cluster_extents(self, clusters, length):
+        '''
+        A method to turn a list of clusters into a list of byte extents in
+        the image, merging clusters that directly follow each other.
+
+        Parameters:
+         clusters - The list of logical clusters.
+         length - The number of bytes of data in the clusters.
+        Returns:
+         A list of tuples of the offset and length of each contiguous run of data.
+        '''
+        return _cluster_extents([self.cluster_offset(cluster) for cluster in clusters],
+                                length, self.bytes_per_cluster)
+
+class PyFat(object):
+    '''
+    The main class to open or create FAT filesystems.
+
+    A single PyFat object may be shared between threads.  Methods that only
+    read (get_and_write_file, extract_tree, extract_all and list_dir) can run
+    at the same time as each other; they use positional reads only, so they
+    never move a shared file position, and list_dir hands back a snapshot of
+    the directory.  Methods that modify the filesystem, and write() and
+    close(), take a writer lock and so wait for the readers to finish and run
+    alone.  Note that a PyFat must not be modified from inside one of its own
+    read methods.
+    '''
+    FAT12 = 0
+    FAT16 = 1
+    FAT32 = 2
+
+    # The date and time stamped on every new entry in deterministic mode; this
+    # is 1980-01-01 00:00:00, the FAT epoch.
+    DETERMINISTIC_DATE_TIME = ((0 << 9) | (1 << 5) | 1, 0)
+
+    # The most data to read at once when copying a run of clusters.
+    COPY_CHUNK_SIZE = 1024 * 1024
+
+    # The FSInfo sector of a FAT32 filesystem: lead signature, reserved,
+    # structure signature, free cluster count, next free cluster, reserved,
+    # and trail signature.
+    FSINFO_FORMAT = "=L480sLLL12sL"
+
+    # The default cluster sizes from the FAT specification, as tuples of the
+    # largest volume size in 512-byte sectors and the bytes per cluster.
+    FAT16_CLUSTER_SIZES = [(32680, 1024), (262144, 2048), (524288, 4096),
+                           (1048576, 8192), (2097152, 16384), (4194304, 32768)]
+    FAT32_CLUSTER_SIZES = [(532480, 512), (16777216, 4096), (33554432, 8192),
+                           (67108864, 16384), (0xffffffff, 32768)]
+
+    # The sectors per track and number of heads of the standard floppy sizes,
+    # by size in kilobytes; other sizes get a hard disk style geometry.
+    FLOPPY_GEOMETRY = {360: (9, 2), 720: (9, 2), 1200: (15, 2), 1440: (18, 2),
+                       2880: (36, 2)}
+
+    # The layout of a shared metadata segment: a header of magic, version,
+    # FAT type, number of FAT entries and number of directory records, then
+    # the 512-byte boot sector, the FAT as 32-bit entries, and a flat table
+    # of (index of first child, number of children, 32-byte directory record)
+    # in breadth-first order, so that the children of a directory are next to
+    # each other.  The first record is the root.
+    SHARED_MAGIC = b'PYFATSHM'
+    SHARED_VERSION = 2
+    SHARED_HEADER = "=8sLLLL"
+    SHARED_RECORD = "=LL32s"
+
+    # A metadata cache file (see open()) is this key, of the image size,
+    # modification time and a SHA-256 hash of the boot sector, followed by
+    # the metadata in the shared layout above.
+    CACHE_KEY = "=QQ32s"
+
+    # This boot code was taken from dosfstools
+    BOOT_CODE = b"\x0e\x1f\xbe\x5b\x7c\xac\x22\xc0\x74\x0b\x56\xb4\x0e\xbb\x07\x00\xcd\x10\x5e\xeb\xf0\x32\xe4\xcd\x16\xcd\x19\xeb\xfeThis is not a bootable disk.  Please insert a bootable floppy and\r\npress any key to try again ... \r\n"
+
+    def __init__(self):
+        self.orig_fp = None
+        self.deterministic = False
+        self.read_only = False
+        # The minimum number of clusters to add to a directory each time it
+        # runs out of room.
+        self.dir_growth_clusters = 1
+        # While inside of batch(), the entries waiting for clusters, the
+        # clusters waiting to be freed, the directories waiting to grow, and
+        # the saved state of every entry the batch changed.
+        self._pending = None
+        self._pending_frees = None
+        self._pending_dirs = None
+        self._pending_undo = None
+        self._shared_memory = None
+        self._shared_views = []
+        self._lock = _RWLock()
+        self.initialized = False
+
+    def _determine_fat_type(self):
+        '''
+        An internal method to determine whether this volume is FAT12, FAT16,
+        or FAT32.  Note that this expects to be called *after* the common
+        BPB is parsed on the filesystem.
+
+        Parameters:
+         None
+        Returns:
+         A tuple containing the number of root directory sectors and the FAT type that this volume is.
+        '''
+        # The following determines whether this is FAT12, FAT16, or FAT32
+        root_dir_sectors = ((self.max_root_dir_entries * 32) + (self.bytes_per_sector - 1)) // self.bytes_per_sector
+        if self.sectors_per_fat != 0:
+            fat_size = self.sectors_per_fat
+        else:
+            fat_size = self.fat_size_32
+
+        if self.sector_count != 0:
+            total_sectors = self.sector_count
+        else:
+            total_sectors = self.total_sector_count_32
+
+        data_sec = total_sectors - (self.reserved_sectors + (self.num_fats * fat_size) + root_dir_sectors)
+        # According to the FAT spec, count_of_clusters + 1 is the maximum
+        # valid cluster number for the volume.
+        count_of_clusters = data_sec // self.sectors_per_cluster
+        self.count_of_clusters = count_of_clusters
+
+        if count_of_clusters < 4085:
+            fat_type = self.FAT12
+        elif count_of_clusters < 65525:
+            fat_type = self.FAT16
+        else:
+            fat_type = self.FAT32
+
+        return (root_dir_sectors, fat_type)
+
+    def _set_layout(self):
+        '''
+        An internal method to build the layout of the filesystem, once its
+        geometry is known.
+
+        Parameters:
+         None.
+        Returns:
+         Nothing.
+        '''
+        self.layout = FATLayout(self.bytes_per_sector, self.sectors_per_cluster,
+                                self.reserved_sectors, self.num_fats,
+                                self.fat_size, self.root_dir_sectors)
+
+    def _fit_fat_size(self, total_sectors, entry_bits):
+        '''
+        An internal method to work out how big each FAT needs to be on a
+        volume of a given size, with the rest of the geometry as it is now.
+
+        Parameters:
+         total_sectors - The total number of sectors on the volume.
+         entry_bits - The number of bits in each FAT entry.
+        Returns:
+         The number of sectors in each FAT.
+        '''
+        # Make the FATs just big enough for the clusters that are left over
+        # once the FATs themselves are taken out; growing the FATs only ever
+        # shrinks the number of clusters, so this settles.
+        root_dir_sectors = ((self.max_root_dir_entries * 32) + (self.bytes_per_sector - 1)) // self.bytes_per_sector
+        data_sectors = total_sectors - self.reserved_sectors - root_dir_sectors
+        fat_size = 1
+        while True:
+            clusters = (data_sectors - self.num_fats * fat_size) // self.sectors_per_cluster
+            if clusters <= 0:
+                raise PyFatException("Volume is too small")
+            needed = _ceiling_div((clusters + 2) * entry_bits, 8 * self.bytes_per_sector)
+            if needed <= fat_size:
+                return fat_size
+            fat_size = needed
+
+    def _new_fat_table(self):
+        '''
+        An internal method to make an empty FAT object of the right kind for
+        this filesystem.
+
+        Parameters:
+         None.
+        Returns:
+         The new FAT12, FAT16 or FAT32 object.
+        '''
+        if self.fat_type == self.FAT32:
+            return FAT32()
+        elif self.fat_type == self.FAT16:
+            return FAT16()
+        return FAT12()
+
+    def _parse_root(self, root=None):
+        '''
+        An internal method to set up the root directory entry of an existing
+        filesystem.
+
+        Parameters:
+         root - The already parsed root directory entry; if None, an empty one is made.
+        Returns:
+         Nothing.
+        '''
+        if root is None:
+            root = FATDirectoryEntry()
+            root.parse(b'           \x10\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00', None, self.orig_fp)
+        self.root = root
+        if self.fat_type == self.FAT32:
+            # The FAT32 root directory is an ordinary cluster chain, and grows
+            # like any other directory.
+            self.root.first_logical_cluster = self.root_cluster
+        else:
+            self.root.max_children = self.max_root_dir_entries
+
+    def _parse_fsinfo(self):
+        '''
+        An internal method to read the free cluster count and next free
+        cluster hints out of the FSInfo sector of a FAT32 filesystem.  If the
+        sector is not valid the hints are left unknown.
+
+        Parameters:
+         None.
+        Returns:
+         Nothing.
+        '''
+        self.orig_fp.seek(self.fsinfo_sector_number * self.bytes_per_sector)
+        (lead_sig, unused1, struct_sig, free_count, next_free, unused2,
+         trail_sig) = struct.unpack(self.FSINFO_FORMAT, self.orig_fp.read(512))
+        if lead_sig == 0x41615252 and struct_sig == 0x61417272 and trail_sig == 0xaa550000:
+            self.fat.set_hints(free_count, next_free)
+
+    def _parse_boot_sector(self, boot_sector):
+        '''
+        An internal method to parse and check the boot sector, setting up the
+        geometry of the filesystem.
+
+        Parameters:
+         boot_sector - The string containing the boot sector.
+        Returns:
+         Nothing.
+        '''
+        (self.jmp_boot, self.oem_name, self.bytes_per_sector,
+         self.sectors_per_cluster, self.reserved_sectors, self.num_fats,
+         self.max_root_dir_entries, self.sector_count, self.media,
+         self.sectors_per_fat, self.sectors_per_track, self.num_heads,
+         self.hidden_sectors, self.total_sector_count_32) = struct.unpack("=3s8sHBHBHHBHHHLL", boot_sector[:36])
+
+        if self.jmp_boot[0] == 0xEB:
+            if self.jmp_boot[2] != 0x90:
+                raise PyFatException("Boot code must end with 0x90")
+        elif self.jmp_boot[0] == 0xE9:
+            pass
+        else:
+            raise PyFatException("Boot code must start with 0xEB or 0xE9")
+
+        if self.bytes_per_sector not in [512, 1024, 2048, 4096]:
+            raise PyFatException("Expected 512, 1024, 2048, or 4096 bytes per sector")
+
+        if self.sectors_per_cluster not in [1, 2, 4, 8, 16, 32, 64, 128]:
+            raise PyFatException("Expected 1, 2, 4, 8, 16, 32, 64, or 128 sector per cluster")
+
+        if self.reserved_sectors == 0:
+            raise PyFatException("Number of reserved sectors must not be 0")
+
+        if self.media not in [0xf0, 0xf8, 0xf9, 0xfa, 0xfb, 0xfc, 0xfd, 0xfe, 0xff]:
+            raise PyFatException("Invalid media type")
+
+        if self.num_fats not in [1, 2]:
+            raise PyFatException("Expected 1 or 2 FATs")
+
+        # Volumes of 0x10000 sectors or more keep the count in the 32-bit
+        # field instead.
+        if self.sector_count == 0 and self.total_sector_count_32 == 0:
+            raise PyFatException("Expected a non-zero total sector count")
+
+        if self.sectors_per_fat == 0:
+            # Only FAT32 leaves this 0; the size is in the FAT32 part of the BPB.
+            (self.fat_size_32,) = struct.unpack_from("=L", boot_sector, 36)
+            if self.fat_size_32 == 0:
+                raise PyFatException("Expected a non-zero number of sectors per FAT")
+            self.fat_size = self.fat_size_32
+        else:
+            self.fat_size = self.sectors_per_fat
+
+        (self.root_dir_sectors, self.fat_type) = self._determine_fat_type()
+        if self.fat_type == self.FAT32 and (self.sectors_per_fat != 0 or self.max_root_dir_entries != 0):
+            raise PyFatException("FAT32 volumes must have 0 sectors per FAT and root directory entries in the BPB")
+        self._set_layout()
+        self.orig_layout = self.layout
+
+        # Now that we know the kind of FAT, we can look at the rest of the
+        # BPB fields.
+        if self.fat_type in [self.FAT12, self.FAT16]:
+            (self.drive_num, unused1, self.boot_sig, self.volume_id,
+             self.volume_label, self.fs_type, self.boot_code,
+             sig) = struct.unpack("=BBBL11s8s448sH", boot_sector[36:])
+
+            if self.fat_type == self.FAT12 and self.fs_type not in [b"FAT12   ", b"FAT     "]:
+                raise PyFatException("Invalid filesystem type for FAT12")
+            if self.fat_type == self.FAT16 and self.fs_type not in [b"FAT16   ", b"FAT     "]:
+                raise PyFatException("Invalid filesystem type for FAT16")
+        else:
+            (self.fat_size_32, self.ext_flags, self.fs_ver, self.root_cluster,
+             self.fsinfo_sector_number, self.backup_boot_sector, unused1,
+             self.drive_num, unused2, self.boot_sig, self.volume_id,
+             self.volume_label, self.fs_type, self.boot_code, sig) = struct.unpack("=LHHLHH12sBBBL11s8s420sH", boot_sector[36:])
+
+            if self.fs_ver != 0:
+                raise PyFatException("Invalid filesystem version on FAT32")
+
+            if self.backup_boot_sector not in [0, 6]:
+                raise PyFatException("Invalid number of backup boot sectors")
+
+            if self.fs_type != b"FAT32   ":
+                raise PyFatException("Invalid filesystem type for FAT32")
+
+            if self.root_cluster < 2 or self.root_cluster > self.count_of_clusters + 1:
+                raise PyFatException("Invalid root cluster for FAT32")
+
+        if self.drive_num not in [0x00, 0x80]:
+            raise PyFatException("Invalid drive number")
+
+        if sig != 0xaa55:
+            raise PyFatException("Invalid signature")
+
+        self.bytes_per_cluster = self.bytes_per_sector * self.sectors_per_cluster
+        self._boot_sector = boot_sector
+
+    def open(self, filename, deterministic=False, cache_dir=None):
+        '''
+        A method to open up an existing FAT filesystem.
+
+        Parameters:
+         filename - The filename that contains the FAT filesystem to open.
+         deterministic - Whether to write this filesystem out in deterministic mode; see new().
+         cache_dir - If not None, a directory in which to keep a snapshot of
+                     the parsed FAT and directory tree of the image.  A later
+                     open of the same unchanged image loads the snapshot
+                     instead of parsing the image again.
+        Returns:
+         Nothing.
+        '''
+        if self.initialized:
+            raise PyFatException("This object is already initialized")
+
+        self.deterministic = deterministic
+
+        self.orig_fp = open(filename, 'rb')
+
+        self.orig_fp.seek(0, os.SEEK_END)
+        self.size_in_kb = self.orig_fp.tell() // 1024
+
+        self.orig_fp.seek(0)
+
+        boot_sector = self.orig_fp.read(512)
+
+        self._parse_boot_sector(boot_sector)
+
+        if cache_dir is not None:
+            cache_path, cache_key = self._cache_path_and_key(filename, cache_dir)
+            if self._load_cache(cache_path, cache_key):
+                self.initialized = True
+                return
+
+        # Read the first FAT
+        self.orig_fp.seek(self.layout.fat_copy_offset(0))
+        first_fat = self.orig_fp.read(self.bytes_per_sector * self.fat_size)
+
+        if self.num_fats == 2 and not (self.fat_type == self.FAT32 and self.ext_flags & 0x80):
+            # Read the second FAT if it exists and is kept as a mirror
+            second_fat = self.orig_fp.read(self.bytes_per_sector * self.fat_size)
+
+            if first_fat != second_fat:
+                raise PyFatException("The first FAT and second FAT do not agree; corrupt FAT filesystem")
+
+        self.fat = self._new_fat_table()
+        self.fat.parse(first_fat, self.bytes_per_sector, self.fat_size)
+        self.fat.set_max_cluster(self.count_of_clusters + 1)
+        if self.fat_type == self.FAT32:
+            self._parse_fsinfo()
+
+        # Now walk the root directory entry
+        self._parse_root()
+
+        dirs = collections.deque([(self.root, self._dir_extents(self.root))])
+        while dirs:
+            currdir, extents = dirs.popleft()
+
+            # Read all of the data for this directory
+            data = b''
+            for offset, length in extents:
+                self.orig_fp.seek(offset)
+                data += self.orig_fp.read(length)
+
+            read = 0
+            while read < len(data):
+                dir_entry = data[read:read+32]
+                read += 32
+
+                if dir_entry[0:1] == b'\x00':
+                    # Empty dir entry, done reading
+                    break
+                elif dir_entry[0:1] == b'\xe5':
+                    # Empty dir entry, skip to next one
+                    continue
+
+                ent = FATDirectoryEntry()
+                ent.parse(dir_entry, currdir, self.orig_fp)
+                currdir.add_child(ent)
+                if ent.is_dir() and not (ent.is_dot() or ent.is_dotdot()):
+                    dirs.append((ent, self._dir_extents(ent)))
+
+        if cache_dir is not None:
+            self._save_cache(cache_path, cache_key)
+
+        self.initialized = True
+
+    def _snapshot(self):
+        '''
+        An internal method to lay out the parsed metadata of this filesystem
+        as described at SHARED_HEADER.  Only the metadata of an opened
+        filesystem whose files are all still on the original image can be
+        laid out this way.
+
+        Parameters:
+         None.
+        Returns:
+         The string containing the metadata.
+        '''
+        # Queue up the entries in breadth-first order; every directory's
+        # children are queued together, right after the ones already there.
+        ents = [self.root]
+        records = []
+        for ent in ents:
+            if not ent.is_dir():
+                if ent.original_data_location != ent.DATA_ON_ORIGINAL_FAT:
+                    raise PyFatException("Can only share the metadata of files on the original filesystem")
+                records.append(struct.pack(self.SHARED_RECORD, 0, 0, ent.record()))
+            elif ent.is_dot() or ent.is_dotdot():
+                records.append(struct.pack(self.SHARED_RECORD, 0, 0, ent.record()))
+            else:
+                records.append(struct.pack(self.SHARED_RECORD, len(ents),
+                                           len(ent.children), ent.record()))
+                ents.extend(ent.children)
+
+        fat = array.array('I', self.fat.fat)
+
+        return (struct.pack(self.SHARED_HEADER, self.SHARED_MAGIC,
+                            self.SHARED_VERSION, self.fat_type, len(fat), len(records)) +
+                self._boot_sector + fat.tobytes() + b''.join(records))
+
+    def _snapshot_layout(self, buf):
+        '''
+        An internal method to check the header of metadata laid out by
+        _snapshot().
+
+        Parameters:
+         buf - The string or buffer containing the metadata.
+        Returns:
+         A tuple of the FAT type, the boot sector, the offset of the FAT, the
+         offset of the directory table, and the number of directory records.
+        '''
+        header_size = struct.calcsize(self.SHARED_HEADER)
+        if len(buf) < header_size + 512:
+            raise PyFatException("Not a PyFat metadata snapshot")
+
+        (magic, version, fat_type, num_fat_entries,
+         num_records) = struct.unpack_from(self.SHARED_HEADER, buf, 0)
+        if magic != self.SHARED_MAGIC or version != self.SHARED_VERSION:
+            raise PyFatException("Not a PyFat metadata snapshot")
+
+        fat_offset = header_size + 512
+        table_offset = fat_offset + num_fat_entries * 4
+        if len(buf) < table_offset + num_records * struct.calcsize(self.SHARED_RECORD):
+            raise PyFatException("Truncated PyFat metadata snapshot")
+
+        if num_records < 1:
+            raise PyFatException("Corrupt PyFat metadata snapshot")
+
+        return (fat_type, bytes(buf[header_size:fat_offset]), fat_offset,
+                table_offset, num_records)
+
+    def _tree_from_snapshot(self, buf, table_offset, num_records):
+        '''
+        An internal method to rebuild the directory tree from the directory
+        table of metadata laid out by _snapshot().
+
+        Parameters:
+         buf - The string or buffer containing the metadata.
+         table_offset - The offset of the directory table in buf.
+         num_records - The number of records in the directory table.
+        Returns:
+         Nothing.
+        '''
+        record_size = struct.calcsize(self.SHARED_RECORD)
+        # The first record is the root, which has no parent.
+        dirs = collections.deque([(None, 0, 1)])
+        while dirs:
+            parent, first, count = dirs.popleft()
+            if first + count > num_records:
+                raise PyFatException("Corrupt PyFat metadata snapshot")
+
+            for index in range(first, first + count):
+                (child_first, child_count,
+                 dir_entry) = struct.unpack_from(self.SHARED_RECORD, buf,
+                                                 table_offset + index * record_size)
+                ent = FATDirectoryEntry()
+                ent.parse(dir_entry, parent, self.orig_fp)
+                if parent is None:
+                    self._parse_root(ent)
+                else:
+                    parent.add_child(ent)
+                if child_count > 0:
+                    dirs.append((ent, child_first, child_count))
+
+    def _cache_path_and_key(self, filename, cache_dir):
+        '''
+        An internal method to find the metadata cache file for an image, and
+        the key that a cache file must start with to be valid for it.
+
+        Parameters:
+         filename - The filename that contains the FAT filesystem.
+         cache_dir - The directory that holds the cache files.
+        Returns:
+         A tuple of the path to the cache file and the key.
+        '''
+        path = os.path.abspath(filename)
+        st = os.fstat(self.orig_fp.fileno())
+        cache_path = os.path.join(cache_dir, hashlib.sha256(path.encode('utf-8')).hexdigest() + '.pyfat')
+        key = struct.pack(self.CACHE_KEY, st.st_size, st.st_mtime_ns,
+                          hashlib.sha256(self._boot_sector).digest())
+
+        return (cache_path, key)
+
+    def _load_cache(self, cache_path, key):
+        '''
+        An internal method to set up the FAT and directory tree from a
+        metadata cache file.
+
+        Parameters:
+         cache_path - The path to the cache file.
+         key - The key that the cache file must start with.
+        Returns:
+         True if the cache file was valid and used, False otherwise.
+        '''
+        try:
+            with open(cache_path, 'rb') as infp:
+                data = infp.read()
+        except (IOError, OSError):
+            return False
+
+        if data[:len(key)] != key:
+            return False
+
+        snapshot = memoryview(data)[len(key):]
+        try:
+            (fat_type, boot_sector, fat_offset, table_offset,
+             num_records) = self._snapshot_layout(snapshot)
+        except PyFatException:
+            return False
+
+        if boot_sector != self._boot_sector:
+            return False
+
+        if fat_type != self.fat_type:
+            return False
+
+        fat = array.array('I')
+        fat.frombytes(snapshot[fat_offset:table_offset])
+        self.fat = self._new_fat_table()
+        self.fat.attach(fat)
+        self.fat.set_max_cluster(self.count_of_clusters + 1)
+        if self.fat_type == self.FAT32:
+            self._parse_fsinfo()
+
+        self._tree_from_snapshot(snapshot, table_offset, num_records)
+
+        return True
+
+    def _save_cache(self, cache_path, key):
+        '''
+        An internal method to write the metadata cache file for this
+        filesystem.  The cache is only an optimization, so failing to write it
+        is not an error.
+
+        Parameters:
+         cache_path - The path to the cache file.
+         key - The key to start the cache file with.
+        Returns:
+         Nothing.
+        '''
+        tmp_path = '%s.%d.%d.tmp' % (cache_path, os.getpid(), threading.current_thread().ident)
+        try:
+            cache_dir = os.path.dirname(cache_path)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            with open(tmp_path, 'wb') as outfp:
+                outfp.write(key)
+                outfp.write(self._snapshot())
+            # Replace the old cache file in one step, so that a concurrent
+            # open never sees a partly written one.
+            os.replace(tmp_path, cache_path)
+        except (IOError, OSError):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @_writer
+    def share_metadata(self, name=None):
+        '''
+        A method to copy the parsed FAT and directory tree of this filesystem
+        into a shared memory segment, so that other processes can attach()
+        to it instead of parsing the image themselves.  This object owns the
+        segment, which lives until this object is closed.  Only an opened filesystem whose files
+        are all still on the original image can be shared.
+
+        Parameters:
+         name - The name to give the segment; if None, a unique name is picked.
+        Returns:
+         The name of the shared memory segment.
+        '''
+        if not self.initialized:
+            raise PyFatException("Can only call share_metadata on an already open object")
+
+        if shared_memory is None:
+            raise PyFatException("Sharing metadata requires multiprocessing.shared_memory")
+
+        if self._shared_memory is not None:
+            raise PyFatException("The metadata of this object is already shared")
+
+        if self.orig_fp is None:
+            raise PyFatException("Can only share the metadata of an opened filesystem")
+
+        snapshot = self._snapshot()
+
+        shm = _open_shared_memory(name, len(snapshot))
+        shm.buf[:len(snapshot)] = snapshot
+
+        self._shared_memory = shm
+
+        return shm.name
+
+    def attach(self, filename, name):
+        '''
+        A method to open an existing FAT filesystem using metadata that
+        another process published with share_metadata(), rather than parsing
+        it from the image.  The FAT is used in place from shared memory, and
+        directories are only read out of it as they are used, so the object
+        is read-only; file data is still read from the image.  The segment
+        stays owned by the object that shared it.
+
+        Parameters:
+         filename - The filename that contains the FAT filesystem to open.
+         name - The name of the shared memory segment.
+        Returns:
+         Nothing.
+        '''
+        if self.initialized:
+            raise PyFatException("This object is already initialized")
+
+        if shared_memory is None:
+            raise PyFatException("Sharing metadata requires multiprocessing.shared_memory")
+
+        shm = _open_shared_memory(name)
+        try:
+            (fat_type, boot_sector, fat_offset, table_offset,
+             num_records) = self._snapshot_layout(shm.buf)
+        except PyFatException:
+            shm.close()
+            raise
+
+        self.orig_fp = open(filename, 'rb')
+        if self.orig_fp.read(512) != boot_sector:
+            self.orig_fp.close()
+            self.orig_fp = None
+            shm.close()
+            raise PyFatException("The shared metadata does not belong to this filesystem")
+
+        self.orig_fp.seek(0, os.SEEK_END)
+        self.size_in_kb = self.orig_fp.tell() // 1024
+
+        self._parse_boot_sector(boot_sector)
+
+        region = shm.buf[fat_offset:table_offset]
+        entries = region.cast('I')
+        view = entries.toreadonly()
+        self._shared_views = [view, entries, region]
+
+        self.fat = self._new_fat_table()
+        self.fat.attach(view)
+        self.fat.set_max_cluster(self.count_of_clusters + 1)
+        if self.fat_type == self.FAT32:
+            self._parse_fsinfo()
+
+        root = _SharedDirectoryEntry(shm.buf, table_offset, num_records, 0, self.orig_fp)
+        root.parse_shared(None)
+        self._parse_root(root)
+
+        self._shared_memory = shm
+        self.read_only = True
+
+        self.initialized = True
+
+    def _find_record(self, path):
+        '''
+        An internal method to find a FAT directory entry based on a given path.
+        The path should be of the form '/dir1/file'.
+
+        Parameters:
+         path - The path to find in the filesystem.
+        Returns:
+         A tuple of the FAT directory entry object and index of the object into the parent's child list.
+        '''
+        if path[0] != '/':
+            raise PyFatException("Must be a path starting with /")
+
+        if path == '/':
+            return self.root, None
+
+       # Split the path along the slashes
+        splitpath = path.split('/')
+        # Skip past the first one, since it is always empty.
+        splitindex = 1
+
+        currpath = splitpath[splitindex]
+        splitindex += 1
+        children = self.root.children
+        index = 0
+        while index < len(children):
+            child = children[index]
+            index += 1
+
+            if child.full_name() != currpath:
+                continue
+
+            if splitindex == len(splitpath):
+                # We have to remove one from the index since we incremented it
+                # above.
+                return child, index-1
+            else:
+                if child.is_dir():
+                    children = child.children
+                    index = 0
+                    currpath = splitpath[splitindex]
+                    splitindex += 1
+
+        raise PyFatException("Could not find path %s" % (path))
+
+    def _orig_cluster_list(self, child):
+        '''
+        An internal method to get the list of clusters, in the backing file
+        object for the entry, that hold the data for a file entry.
+
+        Parameters:
+         child - The file entry to get the original cluster list for.
+        Returns:
+         A list containing the cluster locations of the data in the entry's data_fp.
+        '''
+        if child.file_size == 0:
+            return []
+
+        if child.original_data_location == child.DATA_ON_ORIGINAL_FAT:
+            # If this is a file that was on the original filesystem, then we
+            # haven't modified the cluster list and the original is the same
+            # as the new.
+            return self.fat.get_cluster_list(child.first_logical_cluster)
+        elif child.original_data_location == child.DATA_RELOCATED:
+            # The FAT was rebuilt after this file was read in, so the
+            # location of the data was saved off at that time.
+            return child.orig_cluster_list
+
+        return range(0, _ceiling_div(child.file_size, self.bytes_per_cluster))
+
+    def _walk(self, top=None):
+        '''
+        An internal generator to walk a directory tree breadth-first.  The '.'
+        and '..' entries are skipped.
+
+        Parameters:
+         top - The directory entry to start from; if None, the root.
+        Yields:
+         A tuple of the path relative to the top and the FAT directory entry object for every entry below the top.
+        '''
+        if top is None:
+            top = self.root
+
+        dirs = collections.deque([('', top)])
+        while dirs:
+            currpath, currdir = dirs.popleft()
+
+            for child in currdir.children:
+                if child.is_dot() or child.is_dotdot():
+                    continue
+
+                path = currpath + '/' + child.full_name()
+                if child.is_dir():
+                    dirs.append((path, child))
+
+                yield path, child
+
+    def _orig_offsets(self, child):
+        '''
+        An internal method to get the byte offsets, in the backing file object
+        for the entry, of the clusters that hold the data for a file entry.
+
+        Parameters:
+         child - The file entry to get the offsets for.
+        Returns:
+         A list containing the byte offset of each cluster in the entry's data_fp.
+        '''
+        clusters = self._orig_cluster_list(child)
+        if child.original_data_location == child.DATA_IN_EXTERNAL_FP:
+            return [cluster * self.bytes_per_cluster for cluster in clusters]
+
+        # Resizing moves the data area; the data that is still on the original
+        # filesystem is where the original layout put it.
+        return [self.orig_layout.cluster_offset(cluster) for cluster in clusters]
+
+    def _dir_extents(self, currdir):
+        '''
+        An internal method to get the location of a directory's entries in
+        the image.
+
+        Parameters:
+         currdir - The directory to get the extents for.
+        Returns:
+         A list of tuples of the offset and length of each run of the directory.
+        '''
+        if currdir.parent is None and self.fat_type != self.FAT32:
+            # The FAT12 and FAT16 root directory is one fixed run of sectors.
+            return [(self.layout.root_dir_offset, self.layout.root_dir_size)]
+
+        return [(self.layout.cluster_offset(cluster), self.bytes_per_cluster)
+                for cluster in self.fat.get_cluster_list(currdir.first_logical_cluster)]
+
+    def _extents(self, child):
+        '''
+        An internal method to get the location of the data for a file entry
+        in its data_fp, with contiguous clusters merged together.
+
+        Parameters:
+         child - The file entry to get the extents for.
+        Returns:
+         A list of tuples of the offset and length of each contiguous run of data.
+        '''
+        return _cluster_extents(self._orig_offsets(child), child.file_size, self.bytes_per_cluster)
+
+    def _data_fd(self, child):
+        '''
+        An internal method to get a file descriptor to do positional reads of
+        the data for a file entry from.
+
+        Parameters:
+         child - The file entry to get the file descriptor for.
+        Returns:
+         A tuple of the file descriptor and whether the caller must close it.
+         For a file changed in place, the _PatchedFile is returned instead of
+         a file descriptor.
+        '''
+        if isinstance(child.data_fp, _PatchedFile):
+            return (child.data_fp, False)
+
+        if isinstance(child.data_fp, _LazyFile):
+            # The lazy file may be closed by another thread at any time, so
+            # use a descriptor of our own.
+            return (os.open(child.data_fp.path, os.O_RDONLY), True)
+
+        return (child.data_fp.fileno(), False)
+
+    def _copy_extents(self, child, outfp):
+        '''
+        An internal method to copy the data for a file entry to a file object,
+        reading each contiguous run of clusters in as few reads as possible.
+
+        Parameters:
+         child - The file entry to copy the data for.
+         outfp - The file object to write the data to.
+        Returns:
+         Nothing.
+        '''
+        if not hasattr(os, 'pread'):
+            for offset, length in self._extents(child):
+                child.data_fp.seek(offset)
+                while length > 0:
+                    data = child.data_fp.read(min(length, self.COPY_CHUNK_SIZE))
+                    if not data:
+                        raise PyFatException("Unexpected end of data for %s" % (child.full_name()))
+                    outfp.write(data)
+                    length -= len(data)
+            return
+
+        infd, owned = self._data_fd(child)
+        try:
+            for offset, length in self._extents(child):
+                while length > 0:
+                    data = _pread(infd, min(length, self.COPY_CHUNK_SIZE), offset)
+                    if not data:
+                        raise PyFatException("Unexpected end of data for %s" % (child.full_name()))
+                    outfp.write(data)
+                    offset += len(data)
+                    length -= len(data)
+        finally:
+            if owned:
+                os.close(infd)
+
+    def _read_data(self, child):
+        '''
+        An internal method to read all of the data for a file entry.
+
+        Parameters:
+         child - The file entry to read the data for.
+        Returns:
+         A string containing the data for the file.
+        '''
+        outfp = io.BytesIO()
+        self._copy_extents(child, outfp)
+
+        return outfp.getvalue()
+
+    @_reader
+    def get_and_write_file(self, fat_path, local_path):
+        '''
+        A method to get the data from a file on the FAT filesystem.
+        The path should be of the form '/dir1/file'.
+
+        Parameters:
+         fat_path - The path on the FAT filesystem of the file data to get.
+         local_path - The local_path in which to write the data.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        child, index = self._find_record(fat_path)
+
+        if child.is_dir():
+            raise PyFatException("Cannot get data from a directory")
+
+        with open(local_path, 'wb') as outfp:
+            self._copy_extents(child, outfp)
+
+    def _copy_file_data(self, child, src_extents, outfd, dst_extents):
+        '''
+        An internal method to copy the data for a file entry to a file
+        descriptor using positional I/O only.  This is safe to call from
+        several threads at once.
+
+        Parameters:
+         child - The file entry to copy the data for.
+         src_extents - The extents of the data for the file, from _extents().
+         outfd - The file descriptor to write the data to.
+         dst_extents - The extents to write the data to.
+        Returns:
+         Nothing.
+        '''
+        infd, owned = self._data_fd(child)
+        try:
+            _pread_copy(infd, src_extents, outfd, dst_extents, self.COPY_CHUNK_SIZE)
+        finally:
+            if owned:
+                os.close(infd)
+
+    def _extract_file(self, child, extents, local_path):
+        '''
+        An internal method to copy the data for a file entry to the host
+        using positional I/O only.  This is safe to call from several threads
+        at once.
+
+        Parameters:
+         child - The file entry to extract.
+         extents - The extents of the data for the file, from _extents().
+         local_path - The local path to write the data to.
+        Returns:
+         Nothing.
+        '''
+        outfd = os.open(local_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            self._copy_file_data(child, extents, outfd, [(0, child.file_size)])
+        finally:
+            os.close(outfd)
+
+        mtime = _host_time_from_fat(child.last_write_date, child.last_write_time)
+        os.utime(local_path, (mtime, mtime))
+
+    def extract_all(self, local_dir, workers=4):
+        '''
+        A method to extract the whole FAT filesystem to the host, copying the
+        files in a pool of threads.
+
+        Parameters:
+         local_dir - The local directory to extract into.
+         workers - The number of threads to copy files with.
+        Returns:
+         Nothing.
+        '''
+        self.extract_tree('/', local_dir, incremental=False, workers=workers)
+
+    @_reader
+    def extract_tree(self, fat_dir, local_dir, incremental=True, workers=1):
+        '''
+        A method to extract a directory on the FAT filesystem, and everything
+        below it, to the host.  The tree is walked once, all of the host
+        directories are created up front, and the files are then copied in
+        the order their data appears on the filesystem.  Extracted files get
+        the modification time of their entry, so that a later incremental
+        extraction can skip them.  With more than one worker, the extents of
+        every file are resolved first and the files are then copied in a pool
+        of threads using positional reads and writes, so no file position is
+        shared between them.
+
+        Parameters:
+         fat_dir - The directory on the FAT filesystem to extract.
+         local_dir - The local directory to extract into.
+         incremental - Whether to skip files whose host copies already match in size and modification time.
+         workers - The number of threads to copy files with.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        top, index = self._find_record(fat_dir)
+        if not top.is_dir():
+            raise PyFatException("Can only extract a directory")
+
+        dirs = [local_dir]
+        files = []
+        for path, child in self._walk(top):
+            localpath = os.path.join(local_dir, *path.split('/')[1:])
+            if child.is_dir():
+                dirs.append(localpath)
+            else:
+                files.append((localpath, child))
+
+        for localpath in dirs:
+            if not os.path.isdir(localpath):
+                os.makedirs(localpath)
+
+        files.sort(key=lambda f: f[1].first_logical_cluster)
+        if incremental:
+            changed = []
+            for localpath, child in files:
+                try:
+                    st = os.stat(localpath)
+                    if st.st_size == child.file_size and _fat_date_time(st.st_mtime) == (child.last_write_date, child.last_write_time):
+                        continue
+                except OSError:
+                    pass
+                changed.append((localpath, child))
+            files = changed
+
+        if workers > 1 and hasattr(os, 'pread'):
+            jobs = [(child, self._extents(child), localpath) for localpath, child in files]
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(self._extract_file, *job) for job in jobs]
+                for future in futures:
+                    future.result()
+            return
+
+        for localpath, child in files:
+            with open(localpath, 'wb') as outfp:
+                self._copy_extents(child, outfp)
+
+            mtime = _host_time_from_fat(child.last_write_date, child.last_write_time)
+            os.utime(localpath, (mtime, mtime))
+
+    def new(self, size_in_kb=1440, drive_num=None, num_fats=2, hidden_sectors=0,
+            media=None, root_dir_entries=None, reserved_sectors=None,
+            sectors_per_cluster=None, bytes_per_sector=512, deterministic=False,
+            fat_type=None):
+        '''
+        A method to create a new FAT filesystem.  Any part of the geometry
+        that is not given is worked out from the size, following the FAT
+        specification: the FAT type and the cluster size come from its tables,
+        and the FATs are made just big enough to cover every cluster.  Only
+        the metadata is kept in memory, and write() only writes the metadata
+        and the file data, so the rest of the image is left sparse.
+
+        Parameters:
+         size_in_kb - The size of the filesystem in kilobytes.
+         drive_num - The drive number to use for the FAT filesystem; this must be 0x0 for floppy devices or 0x80 for hard disks.  If None, 0x0 is used for FAT12 and 0x80 otherwise.
+         num_fats - The number of FATs, 1 or 2.
+         hidden_sectors - The number of sectors before this volume on its disk.
+         media - The media descriptor; if None, 0xf0 is used for FAT12 and 0xf8 otherwise.
+         root_dir_entries - The number of entries in the root directory; if None, 224 for FAT12, 512 for FAT16 and 0 for FAT32.
+         reserved_sectors - The number of reserved sectors; if None, 1 for FAT12 and FAT16 and 32 for FAT32.
+         sectors_per_cluster - The number of sectors per cluster; if None, it is picked from the size.
+         bytes_per_sector - The number of bytes per sector.
+         deterministic - Whether to build the filesystem in deterministic mode.  In this mode every new entry gets a fixed timestamp, and write() lays out everything that was added or changed since the last write in sorted order, regardless of the order things were added, in the free clusters left by the entries that were already there.  The same content built up the same way always produces the same image.  Entries are only kept where they were when the build starts from the previous image, so to get a small delta between two builds, open() the previous image with deterministic=True and make the changes there; a fresh build lays everything out from scratch, and one file added early in the sort order moves most of the data after it.
+         fat_type - PyFat.FAT12, PyFat.FAT16 or PyFat.FAT32; if None, it is picked from the size.
+        Returns:
+         Nothing.
+        '''
+        if self.initialized:
             raise PyFatException("This object is already initialized")
 
-        if drive_num not in [0x0, 0x80]:
-            raise PyFatException("")
+        self.deterministic = deterministic
+
+        if bytes_per_sector not in [512, 1024, 2048, 4096]:
+            raise PyFatException("Expected 512, 1024, 2048, or 4096 bytes per sector")
+
+        # The tables in the FAT specification are in 512-byte sectors.
+        size_in_512 = size_in_kb * 2
+        if fat_type is None:
+            if size_in_512 <= 8400:
+                fat_type = self.FAT12
+            elif size_in_512 <= 1048576:
+                fat_type = self.FAT16
+            else:
+                fat_type = self.FAT32
+
+        if fat_type not in [self.FAT12, self.FAT16, self.FAT32]:
+            raise PyFatException("FAT type must be FAT12, FAT16, or FAT32")
+
+        if drive_num is None:
+            drive_num = 0x0 if fat_type == self.FAT12 else 0x80
+
+        if media is None:
+            media = 0xf0 if fat_type == self.FAT12 else 0xf8
+
+        if root_dir_entries is None:
+            root_dir_entries = {self.FAT12: 224, self.FAT16: 512, self.FAT32: 0}[fat_type]
+
+        if reserved_sectors is None:
+            reserved_sectors = 32 if fat_type == self.FAT32 else 1
+
+        if drive_num not in [0x0, 0x80]:
+            raise PyFatException("Drive number must be 0x00 or 0x80")
+
+        if num_fats not in [1, 2]:
+            raise PyFatException("Number of FATs must be 1 or 2")
+
+        if media not in [0xf0, 0xf8, 0xf9, 0xfa, 0xfb, 0xfc, 0xfd, 0xfe, 0xff]:
+            raise PyFatException("Invalid media type")
+
+        if fat_type == self.FAT32 and root_dir_entries != 0:
+            raise PyFatException("FAT32 has no fixed root directory; root_dir_entries must be 0")
+
+        auto_cluster_size = sectors_per_cluster is None
+        if auto_cluster_size:
+            if fat_type == self.FAT12:
+                cluster_size = 512
+            else:
+                if fat_type == self.FAT16:
+                    table = self.FAT16_CLUSTER_SIZES
+                else:
+                    table = self.FAT32_CLUSTER_SIZES
+                cluster_size = None
+                for max_size, size in table:
+                    if size_in_512 <= max_size:
+                        cluster_size = size
+                        break
+                if cluster_size is None:
+                    raise PyFatException("Volume is too large for FAT16")
+            sectors_per_cluster = max(1, cluster_size // bytes_per_sector)
+
+        if sectors_per_cluster not in [1, 2, 4, 8, 16, 32, 64, 128]:
+            raise PyFatException("Expected 1, 2, 4, 8, 16, 32, 64, or 128 sector per cluster")
+
+        self.jmp_boot = b'\xeb\x3c\x90'
+        self.oem_name = b'pyfat   '
+        self.bytes_per_sector = bytes_per_sector
+        self.reserved_sectors = reserved_sectors
+        self.num_fats = num_fats
+        self.max_root_dir_entries = root_dir_entries
+        self.sector_count = int(size_in_kb*1024 / self.bytes_per_sector)
+        if self.sector_count > 65535 or fat_type == self.FAT32:
+            self.total_sector_count_32 = self.sector_count
+            self.sector_count = 0
+        else:
+            self.total_sector_count_32 = 0
+        self.media = media
+        (self.sectors_per_track, self.num_heads) = self.FLOPPY_GEOMETRY.get(size_in_kb, (32, 64))
+        self.hidden_sectors = hidden_sectors
+        self.drive_num = drive_num
+        self.boot_sig = 41
+        self.volume_id = 4248983325
+        self.volume_label = b"NO NAME    "
+        self.boot_code = self.BOOT_CODE
+
+        entry_bits = {self.FAT12: 12, self.FAT16: 16, self.FAT32: 32}[fat_type]
+        total_sectors = self.sector_count + self.total_sector_count_32
+        while True:
+            self.sectors_per_cluster = sectors_per_cluster
+            self.bytes_per_cluster = self.bytes_per_sector * self.sectors_per_cluster
+
+            fat_size = self._fit_fat_size(total_sectors, entry_bits)
+
+            self.fat_size = fat_size
+            if fat_type == self.FAT32:
+                self.sectors_per_fat = 0
+                self.fat_size_32 = fat_size
+            else:
+                self.sectors_per_fat = fat_size
+
+            # The FAT type is a function of the geometry; make sure the table
+            # we build is the same kind that open() will detect on the way
+            # back in.
+            (self.root_dir_sectors, self.fat_type) = self._determine_fat_type()
+            if self.fat_type == fat_type:
+                break
+            if self.fat_type < fat_type:
+                raise PyFatException("Volume is too small for the requested FAT type")
+            if not auto_cluster_size or sectors_per_cluster == 128:
+                raise PyFatException("Clusters are too small for the requested FAT type")
+            # Too many clusters for the requested type; try bigger ones.
+            sectors_per_cluster *= 2
+
+        if self.fat_type == self.FAT12:
+            self.fs_type = b"FAT12   "
+        elif self.fat_type == self.FAT16:
+            self.fs_type = b"FAT16   "
+        else:
+            self.fs_type = b"FAT32   "
+            self.jmp_boot = b'\xeb\x58\x90'
+            # The FAT32 BPB is longer, so the boot code starts later and the
+            # address of its message moves with it.
+            self.boot_code = self.BOOT_CODE[:3] + struct.pack("=H", 0x7c00 + 0x5a + 0x1d) + self.BOOT_CODE[5:]
+            self.ext_flags = 0
+            self.fs_ver = 0
+            self.fsinfo_sector_number = 1
+            self.backup_boot_sector = 6 if reserved_sectors >= 8 else 0
+        self._set_layout()
+        self.orig_layout = self.layout
+
+        self.fat = self._new_fat_table()
+        self.fat.new(self.bytes_per_sector, self.fat_size)
+        self.fat.set_max_cluster(self.count_of_clusters + 1)
+
+        self.root = FATDirectoryEntry()
+        self.root.new_root()
+        if self.fat_type == self.FAT32:
+            self.fat.set_hints(self.count_of_clusters, 2)
+            self.root_cluster = self.fat.add_entry(self.bytes_per_cluster, self.bytes_per_cluster)
+            self.root.first_logical_cluster = self.root_cluster
+            self.root.max_children = None
+        else:
+            self.root.max_children = self.max_root_dir_entries
+
+        self.size_in_kb = size_in_kb
+
+        self.initialized = True
+
+    def _date_time(self):
+        '''
+        An internal method to get the date and time to stamp on new entries.
+
+        Parameters:
+         None.
+        Returns:
+         A tuple of the FAT date and FAT time, or None to use today's date.
+        '''
+        if self.deterministic:
+            return self.DETERMINISTIC_DATE_TIME
+
+        return None
+
+    def _name_and_parent_from_path(self, path):
+        '''
+        An internal method to get the original name and parent given a pathname.
+
+        Parameters:
+         path - The path to find the parent and name for.
+        Returns:
+         A tuple of the name and the parent.
+        '''
+        if path[0] != '/':
+            raise PyFatException("Must be a path starting with /")
+
+        # First we need to find the parent of this directory, and add this
+        # one as a child.
+        splitpath = path.split('/')
+        # Pop off the front, as it is always blank.
+        splitpath.pop(0)
+        # Now take the name off.
+        name = splitpath.pop()
+        if len(splitpath) == 0:
+            # This is a new directory under the root, add it there
+            parent = self.root
+        else:
+            parent, index = self._find_record('/' + '/'.join(splitpath))
+
+        return (name, parent)
+
+    @_mutator
+    def add_file(self, fat_path, local_path):
+        '''
+        A method to add a new file to the filesystem.
+
+        Parameters:
+         fat_path - The path on the FAT filesystem to add the file.
+         local_path - The local path that the file data should come from.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        infp = open(local_path, 'rb')
+        length = os.fstat(infp.fileno()).st_size
+
+        filename, parent = self._name_and_parent_from_path(fat_path)
+
+        name, ext = os.path.splitext(filename)
+        if len(ext) > 0 and ext[0] == '.':
+            ext = ext[1:]
+
+        first_cluster = 0
+        if self._pending is None:
+            first_cluster = self.fat.add_entry(length, self.bytes_per_cluster)
+
+        child = FATDirectoryEntry()
+        child.new_file(infp, length, parent, name, ext, first_cluster, self._date_time())
+
+        self._journal(parent)
+        parent.add_child(child)
+        if self._pending is not None:
+            self._pending[child] = None
+
+        self._grow_dir(parent)
+
+    @_mutator
+    def add_dir(self, path):
+        '''
+        A method to add a new directory to the FAT filesystem.
+
+        Parameters:
+         path - The path at which to create the new directory.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        filename, parent = self._name_and_parent_from_path(path)
+
+        name, ext = os.path.splitext(filename)
+
+        first_cluster = 0
+        if self._pending is None:
+            first_cluster = self.fat.add_entry(self.bytes_per_cluster, self.bytes_per_cluster)
+
+        child = FATDirectoryEntry()
+        child.new_dir(parent, name, ext, first_cluster, self._date_time())
+
+        self._journal(parent)
+        parent.add_child(child)
+        if self._pending is None:
+            child.chain_tail = (1, first_cluster)
+        else:
+            self._pending[child] = None
+
+        dot = FATDirectoryEntry()
+        dot.new_dot(parent, first_cluster, self._date_time())
+        child.add_child(dot)
+
+        dotdot = FATDirectoryEntry()
+        dotdot.new_dotdot(parent, self._date_time())
+        child.add_child(dotdot)
+
+        self._grow_dir(parent)
+
+    @_mutator
+    def rm_dir(self, path):
+        '''
+        A method to remove a directory from the FAT filesystem.
+
+        Parameters:
+         path - The path to the directory to be removed.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        child, index = self._find_record(path)
+
+        if not child.is_dir():
+            raise PyFatException("Cannot remove file; try rm_file instead")
+
+        if len(child.children) != 2:
+            # If there are more than 2 entries in the directory (. and ..),
+            # then we can't remove
+            raise PyFatException("Cannot remove non-empty directory")
+
+        if child.parent is None:
+            raise PyFatException("Cannot remove the root entry")
+
+        self._release(child)
+
+        self._journal(child.parent)
+        child.parent.remove_child(index)
+
+    @_mutator
+    def rm_file(self, path):
+        '''
+        A method to remove a file from the FAT filesystem.
+
+        Parameters:
+         path - The path to the file to be removed.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        child, index = self._find_record(path)
+
+        if child.is_dir():
+            raise PyFatException("Cannot remove directory; try rm_dir instead")
+
+        self._release(child)
+
+        self._journal(child.parent)
+        child.parent.remove_child(index)
+
+    def _move_entry(self, path, newparent, filename, ext):
+        '''
+        An internal method to move an entry to a new directory and give it a
+        new name.  Only the directory entries change; the data stays where it
+        is.
+
+        Parameters:
+         path - The path to the entry to move.
+         newparent - The directory to move the entry to.
+         filename - The new filename for the entry.
+         ext - The new extension for the entry.
+        Returns:
+         Nothing.
+        '''
+        child, index = self._find_record(path)
+
+        if child.parent is None:
+            raise PyFatException("Cannot move the root entry")
+
+        if child.is_dot() or child.is_dotdot():
+            raise PyFatException("Cannot move dot or dotdot")
+
+        if not newparent.is_dir():
+            raise PyFatException("Can only move into a directory")
+
+        _check_fat_name(filename, ext)
+
+        curr = newparent
+        while curr is not None:
+            if curr is child:
+                raise PyFatException("Cannot move a directory into itself")
+            curr = curr.parent
+
+        fullname = filename
+        if len(ext) > 0:
+            fullname += "." + ext
+        for other in newparent.children:
+            if other is not child and other.full_name() == fullname:
+                raise PyFatException("%s already exists" % (fullname))
+
+        oldparent = child.parent
+        self._journal(child)
+        self._journal(oldparent)
+        self._journal(newparent)
+        if newparent is not oldparent:
+            newparent.add_child(child)
+            try:
+                self._grow_dir(newparent)
+            except PyFatException:
+                newparent.children.pop()
+                raise
+            oldparent.remove_child(index)
+            # If this is a directory, its '..' entry is pointed at the new
+            # parent when it is written out.
+            child.parent = newparent
+
+        child.filename = "{:<8}".format(filename)
+        child.extension = "{:<3}".format(ext)
+
+    @_mutator
+    def rename(self, old_path, new_path):
+        '''
+        A method to rename a file or directory on the FAT filesystem, possibly
+        moving it to another directory at the same time.  The data is not
+        copied.
+
+        Parameters:
+         old_path - The current path to the entry.
+         new_path - The new path for the entry; its parent must already exist.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        filename, newparent = self._name_and_parent_from_path(new_path)
+
+        name, ext = os.path.splitext(filename)
+        if len(ext) > 0 and ext[0] == '.':
+            ext = ext[1:]
+
+        self._move_entry(old_path, newparent, name, ext)
+
+    @_mutator
+    def move(self, src_path, dst_dir):
+        '''
+        A method to move a file or directory on the FAT filesystem into
+        another directory, keeping its name.  The data is not copied.
+
+        Parameters:
+         src_path - The path to the entry to move.
+         dst_dir - The path to the directory to move the entry into.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        child, index = self._find_record(src_path)
+        newparent, index = self._find_record(dst_dir)
+
+        self._move_entry(src_path, newparent, child.filename.rstrip(), child.extension.rstrip())
+
+    def _patched_file(self, path):
+        '''
+        An internal method to find a file entry whose data is about to be
+        changed in place, and switch it over to a _PatchedFile if it isn't
+        already.
+
+        Parameters:
+         path - The path to the file.
+        Returns:
+         The file entry.
+        '''
+        if self._pending is not None:
+            raise PyFatException("Cannot change file data in the middle of a batch")
+
+        child, index = self._find_record(path)
+
+        if child.is_dir():
+            raise PyFatException("Cannot change the data of a directory")
+
+        if not isinstance(child.data_fp, _PatchedFile):
+            child.data_fp = _PatchedFile(child.data_fp, self._orig_offsets(child),
+                                         child.file_size, self.bytes_per_cluster)
+            child.original_data_location = child.DATA_IN_EXTERNAL_FP
+
+        return child
+
+    def _resize_file(self, child, size):
+        '''
+        An internal method to change the size of a file entry, adding clusters
+        to the end of its chain or freeing the ones it no longer needs.
+
+        Parameters:
+         child - The file entry to resize.
+         size - The new size of the file.
+        Returns:
+         Nothing.
+        '''
+        if size > 0xffffffff:
+            raise PyFatException("Files on FAT cannot be 4GB or larger")
+
+        have = _ceiling_div(child.file_size, self.bytes_per_cluster)
+        needed = _ceiling_div(size, self.bytes_per_cluster)
+        if have == 0 and needed > 0:
+            child.first_logical_cluster = self.fat.add_entry(size, self.bytes_per_cluster)
+            child.chain_tail = None
+        elif needed > have:
+            have, last = self._chain_tail(child)
+            last = self.fat.extend_chain(last, needed - have)
+            child.chain_tail = (needed, last)
+        elif needed < have:
+            child.first_logical_cluster = self.fat.truncate_entry(child.first_logical_cluster, needed)
+            child.chain_tail = None
+        if needed != have:
+            child.placed = False
+
+        if size < child.file_size:
+            child.data_fp.truncate(size)
+        child.file_size = size
+
+    def _stamp(self, child):
+        '''
+        An internal method to set the last write time of an entry to now.
+
+        Parameters:
+         child - The entry to stamp.
+        Returns:
+         Nothing.
+        '''
+        date_time = self._date_time()
+        if date_time is None:
+            date_time = _fat_date_time(time.time())
+        child.last_write_date, child.last_write_time = date_time
+
+    @_mutator
+    def write_file(self, path, data, offset=0):
+        '''
+        A method to change the data of an existing file in place.  The file's
+        chain is reused, and extended if the data goes past the end of the
+        file; any gap between the old end and the offset reads as zeros.
+        Only the clusters that are written to are kept in memory until the
+        filesystem is written out.
+
+        Parameters:
+         path - The path to the file to change.
+         data - The data to write.
+         offset - The offset in the file to write the data at.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        child = self._patched_file(path)
+        if offset + len(data) > child.file_size:
+            self._resize_file(child, offset + len(data))
+        child.data_fp.write(offset, data)
+        self._stamp(child)
+
+    @_mutator
+    def append(self, path, data):
+        '''
+        A method to add data to the end of an existing file.
+
+        Parameters:
+         path - The path to the file to add to.
+         data - The data to add.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        child = self._patched_file(path)
+        offset = child.file_size
+        self._resize_file(child, offset + len(data))
+        child.data_fp.write(offset, data)
+        self._stamp(child)
+
+    @_mutator
+    def truncate(self, path, size):
+        '''
+        A method to change the size of an existing file.  A smaller size frees
+        the clusters that are no longer needed; a larger one adds zeros to
+        the end of the file.
+
+        Parameters:
+         path - The path to the file to resize.
+         size - The new size of the file.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        child = self._patched_file(path)
+        self._resize_file(child, size)
+        self._stamp(child)
+
+    @_mutator
+    def rm_tree(self, path):
+        '''
+        A method to remove a file, or a directory and everything below it,
+        from the FAT filesystem.  The entry is taken out of its parent once,
+        and the clusters of everything in it are freed together.
+
+        Parameters:
+         path - The path to the file or directory to be removed.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        child, index = self._find_record(path)
+
+        if child.parent is None:
+            raise PyFatException("Cannot remove the root entry")
+
+        if child.is_dot() or child.is_dotdot():
+            raise PyFatException("Cannot remove dot or dotdot")
+
+        self._journal(child.parent)
+        child.parent.remove_child(index)
+
+        self._free_tree(child)
+
+    def _release(self, entry):
+        '''
+        An internal method to free the clusters of an entry that is being
+        removed.  Inside of a batch the clusters are only freed when the batch
+        ends, and an entry that was added in the same batch never had any.
+
+        Parameters:
+         entry - The entry to free the clusters for.
+        Returns:
+         Nothing.
+        '''
+        if self._pending is None:
+            self.fat.remove_entry(entry.first_logical_cluster)
+            return
+
+        self._pending_dirs.pop(entry, None)
+        if entry in self._pending:
+            del self._pending[entry]
+        else:
+            self._pending_frees.append(entry.first_logical_cluster)
+
+    def _journal(self, entry):
+        '''
+        An internal method to save the state of an entry that is about to be
+        changed inside of a batch, so the batch can be rolled back.  Only the
+        state before the first change in a batch is kept, and entries that
+        were added in the batch are skipped, since rolling back drops them
+        anyway.
+
+        Parameters:
+         entry - The entry that is about to change.
+        Returns:
+         Nothing.
+        '''
+        if self._pending is None or entry in self._pending or entry in self._pending_undo:
+            return
+
+        self._pending_undo[entry] = (entry.parent, list(entry.children), entry.filename,
+                                     entry.extension, entry.attributes)
+
+    def _rollback_batch(self):
+        '''
+        An internal method to put every entry changed in a batch back the way
+        it was before the batch, and throw away the allocation that was put
+        off.
+
+        Parameters:
+         None.
+        Returns:
+         Nothing.
+        '''
+        for entry, state in self._pending_undo.items():
+            (entry.parent, entry.children, entry.filename, entry.extension,
+             entry.attributes) = state
+
+        self._pending = None
+        self._pending_frees = None
+        self._pending_dirs = None
+        self._pending_undo = None
+
+    def _free_tree(self, entry):
+        '''
+        An internal method to free the clusters of an entry and, if it is a
+        directory, of everything below it.  The entries themselves are left
+        alone.
+
+        Parameters:
+         entry - The entry to free the clusters for.
+        Returns:
+         Nothing.
+        '''
+        first_clusters = []
+        entries = collections.deque([entry])
+        while entries:
+            curr = entries.popleft()
+            if self._pending is None:
+                first_clusters.append(curr.first_logical_cluster)
+            else:
+                self._release(curr)
+            if curr.is_dir():
+                for child in curr.children:
+                    if not (child.is_dot() or child.is_dotdot()):
+                        entries.append(child)
+
+        # Free all of the chains in one go.
+        self.fat.remove_entries(first_clusters)
+
+    def _chain_tail(self, entry):
+        '''
+        An internal method to get the number of clusters in the chain for an
+        entry and the last cluster of it, walking the chain only if it isn't
+        cached already.  The entry must have at least one cluster.
+
+        Parameters:
+         entry - The entry to get the chain tail for.
+        Returns:
+         A tuple of the number of clusters and the last cluster.
+        '''
+        if entry.chain_tail is None:
+            clusters = self.fat.get_cluster_list(entry.first_logical_cluster)
+            entry.chain_tail = (len(clusters), clusters[-1])
+
+        return entry.chain_tail
+
+    def _grow_dir(self, currdir):
+        '''
+        An internal method to make sure a directory has enough clusters
+        allocated to hold all of its children.  The FAT12 and FAT16 root
+        directory has a fixed size, so it is never grown.  When a directory
+        does need to grow, it grows by at least dir_growth_clusters clusters.
+
+        Parameters:
+         currdir - The directory to grow.
+        Returns:
+         Nothing.
+        '''
+        if currdir.parent is None and self.fat_type != self.FAT32:
+            return
+
+        if self._pending is not None:
+            # Directories are grown once, when the batch ends; directories
+            # that were added in the batch get all of their clusters then.
+            if currdir not in self._pending:
+                self._pending_dirs[currdir] = None
+            return
+
+        have, last = self._chain_tail(currdir)
+        needed = max(1, self.layout.clusters_for(len(currdir.children) * 32))
+        if needed > have:
+            grow = max(needed - have, self.dir_growth_clusters)
+            last = self.fat.extend_chain(last, grow)
+            currdir.chain_tail = (have + grow, last)
+            currdir.placed = False
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''
+        A context manager to group many changes to the filesystem together.
+        Inside of the batch, add_file and add_dir don't allocate any clusters
+        and rm_file and rm_dir don't free any.  When the batch ends, the
+        clusters are freed, each directory that needs to grow is grown once,
+        and the new entries get their clusters in the order they were added,
+        one after the other, in a single pass over the FAT.  Note that
+        free_space does not reflect the changes until the batch ends, and the
+        filesystem cannot be written in the middle of a batch.  Batches may
+        be nested; only the outermost one does the allocation.  The batch
+        holds the lock for its whole duration, so other threads wait for it.
+        If anything in the batch raises, or there is not enough space at the
+        end, every change made in the batch is rolled back.
+
+        Parameters:
+         None.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        if self.read_only:
+            raise PyFatException("Cannot modify a read-only PyFat object")
+
+        # The batch holds the lock from start to end, so changes made by other
+        # threads wait for it to finish rather than ending up in it.
+        with self._lock.write_locked():
+            if self._pending is not None:
+                yield
+                return
+
+            self._pending = {}
+            self._pending_frees = []
+            self._pending_dirs = {}
+            self._pending_undo = {}
+            try:
+                yield
+            except BaseException:
+                self._rollback_batch()
+                raise
+            self._end_batch()
+
+    def _end_batch(self):
+        '''
+        An internal method to do the allocation that was put off during a
+        batch.  If there is not enough space for it, everything done to the
+        FAT is undone and the batch is rolled back before the exception is
+        raised.
+
+        Parameters:
+         None.
+        Returns:
+         Nothing.
+        '''
+        pending = list(self._pending)
+        frees = self._pending_frees
+        dirs = list(self._pending_dirs)
+        self._pending = None
+
+        lengths = []
+        for entry in pending:
+            if entry.is_dir():
+                lengths.append(max(1, len(entry.children)) * 32)
+            else:
+                lengths.append(entry.file_size)
+
+        freed = []
+        grown = []
+        try:
+            for first_cluster in frees:
+                if first_cluster != 0:
+                    freed.append(self.fat.get_cluster_list(first_cluster))
+                    self.fat.remove_entry(first_cluster)
+            for currdir in dirs:
+                if currdir.parent is not None or self.fat_type == self.FAT32:
+                    grown.append((currdir, self._chain_tail(currdir), currdir.placed))
+                self._grow_dir(currdir)
+            firsts = self.fat.add_entries(lengths, self.bytes_per_cluster)
+        except BaseException:
+            for currdir, (have, last), placed in reversed(grown):
+                self.fat.truncate_entry(currdir.first_logical_cluster, have)
+                currdir.chain_tail = (have, last)
+                currdir.placed = placed
+            for clusters in reversed(freed):
+                self.fat.restore_entry(clusters)
+            self._rollback_batch()
+            raise
+
+        self._pending_frees = None
+        self._pending_dirs = None
+        self._pending_undo = None
+
+        for entry, first_cluster in zip(pending, firsts):
+            entry.first_logical_cluster = first_cluster
+            if entry.is_dir():
+                entry.chain_tail = None
+                for child in entry.children:
+                    if child.is_dot():
+                        child.first_logical_cluster = first_cluster
+
+    def _same_data(self, child, local_path):
+        '''
+        An internal method to compare the data of a file entry with a file on
+        the host.
+
+        Parameters:
+         child - The file entry to compare.
+         local_path - The path to the file on the host.
+        Returns:
+         True if the data is the same, False otherwise.
+        '''
+        with open(local_path, 'rb') as infp:
+            for offset, length in self._extents(child):
+                child.data_fp.seek(offset)
+                if child.data_fp.read(length) != infp.read(length):
+                    return False
+
+            return infp.read(1) == b''
+
+    @_mutator
+    def add_tree(self, local_dir, fat_dir='/'):
+        '''
+        A method to add a whole directory tree from the host to the FAT
+        filesystem.  The host tree is scanned once, breadth-first, before
+        anything is allocated, so each new directory gets all of its clusters
+        at once, and each directory is followed by the data for its files in
+        the order they were scanned.  Host names are upper-cased, must fit in
+        8.3, and must not clash with each other or with what is already in
+        the directory.  If anything doesn't fit, nothing is added.
+
+        Parameters:
+         local_dir - The local directory whose contents should be added.
+         fat_dir - The existing directory on the FAT filesystem to add them to.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        top, index = self._find_record(fat_dir)
+        if not top.is_dir():
+            raise PyFatException("Can only add a tree to a directory")
+
+        names = set([child.full_name() for child in top.children])
+
+        # Build the new entries, without any clusters and without touching
+        # the tree, and note the order to allocate them in.  Every host
+        # directory is checked for names that clash once upper-cased.
+        added = []
+        order = []
+        dirs = collections.deque([(local_dir, top)])
+        while dirs:
+            localpath, currdir = dirs.popleft()
+            if currdir is not top:
+                order.append(currdir)
+
+            for fullname, (filename, ext, dirent) in _scan_host_dir(localpath).items():
+                if currdir is top and fullname in names:
+                    raise PyFatException("%s already exists in %s" % (fullname, fat_dir))
+
+                if dirent.is_dir():
+                    child = FATDirectoryEntry()
+                    child.new_dir(currdir, filename, ext, 0, self._date_time())
+
+                    dot = FATDirectoryEntry()
+                    dot.new_dot(currdir, 0, self._date_time())
+                    child.add_child(dot)
+
+                    dotdot = FATDirectoryEntry()
+                    dotdot.new_dotdot(currdir, self._date_time())
+                    child.add_child(dotdot)
+
+                    dirs.append((dirent.path, child))
+                else:
+                    st = dirent.stat()
+                    date_time = self._date_time()
+                    if date_time is None:
+                        date_time = _fat_date_time(st.st_mtime)
+
+                    child = FATDirectoryEntry()
+                    child.new_file(_LazyFile(dirent.path), st.st_size, currdir, filename, ext, 0, date_time)
+                    order.append(child)
+
+                if currdir is top:
+                    added.append(child)
+                else:
+                    currdir.add_child(child)
+
+        self._place_entries(top, added, order)
+
+    def _place_entries(self, top, added, order):
+        '''
+        An internal method to add new entries, that were built without any
+        clusters, to an existing directory and give them all clusters in one
+        pass over the FAT.  This is done as a batch, so if the entries don't
+        fit, the directory and the FAT are left as they were.
+
+        Parameters:
+         top - The existing directory to add the new entries to.
+         added - The new entries to add directly to top.
+         order - All of the new entries, in the order to lay them out in.
+        Returns:
+         Nothing.
+        '''
+        with self.batch():
+            self._journal(top)
+            for child in added:
+                top.add_child(child)
+            for entry in order:
+                self._pending[entry] = None
+            self._grow_dir(top)
+
+    @_mutator
+    def copy_from(self, other, src_path, dst_path):
+        '''
+        A method to copy a file, or a directory and everything below it, from
+        another PyFat object into this one.  Nothing is staged on the host;
+        the new entries read their data straight from wherever the other
+        object has it when this filesystem is written out, a contiguous run
+        of clusters at a time, so the other object must not be closed or
+        changed until then.
+
+        Parameters:
+         other - The PyFat object to copy from.
+         src_path - The path to the file or directory in the other object.
+         dst_path - The path in this object to copy it to; its parent must already exist.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        if not other.initialized:
+            raise PyFatException("The object to copy from is not yet initialized")
+
+        with other._lock.read_locked():
+            src, index = other._find_record(src_path)
+
+            if src.parent is None:
+                raise PyFatException("Cannot copy the root entry")
+
+            if src.is_dot() or src.is_dotdot():
+                raise PyFatException("Cannot copy dot or dotdot")
+
+            filename, top = self._name_and_parent_from_path(dst_path)
+            if not top.is_dir():
+                raise PyFatException("Can only copy into a directory")
+
+            curr = top
+            while curr is not None:
+                if curr is src:
+                    raise PyFatException("Cannot copy a directory into itself")
+                curr = curr.parent
+
+            name, ext = os.path.splitext(filename)
+            if len(ext) > 0 and ext[0] == '.':
+                ext = ext[1:]
+
+            for child in top.children:
+                if child.full_name() == filename:
+                    raise PyFatException("%s already exists" % (filename))
+
+            added = []
+            order = []
+            entries = collections.deque([(src, top, name, ext)])
+            while entries:
+                srcent, currdir, name, ext = entries.popleft()
+
+                child = FATDirectoryEntry()
+                if srcent.is_dir():
+                    child.new_dir(currdir, name, ext, 0, self._date_time())
+
+                    dot = FATDirectoryEntry()
+                    dot.new_dot(currdir, 0, self._date_time())
+                    child.add_child(dot)
+
+                    dotdot = FATDirectoryEntry()
+                    dotdot.new_dotdot(currdir, self._date_time())
+                    child.add_child(dotdot)
+
+                    for sub in srcent.children:
+                        if not (sub.is_dot() or sub.is_dotdot()):
+                            entries.append((sub, child, sub.filename.rstrip(), sub.extension.rstrip()))
+                else:
+                    if isinstance(srcent.data_fp, _PatchedFile):
+                        data_fp = srcent.data_fp.copy()
+                    else:
+                        data_fp = _PatchedFile(srcent.data_fp, other._orig_offsets(srcent),
+                                               srcent.file_size, other.bytes_per_cluster, False)
+                    child.new_file(data_fp, srcent.file_size, currdir, name, ext, 0, self._date_time())
+
+                child.attributes = srcent.attributes
+                if not self.deterministic:
+                    child.creation_time = srcent.creation_time
+                    child.creation_date = srcent.creation_date
+                    child.last_access_date = srcent.last_access_date
+                    child.last_write_time = srcent.last_write_time
+                    child.last_write_date = srcent.last_write_date
+
+                if currdir is top:
+                    added.append(child)
+                else:
+                    currdir.add_child(child)
+                order.append(child)
+
+        self._place_entries(top, added, order)
+
+    @_mutator
+    def sync_from(self, local_dir, fat_dir='/', checksum=False):
+        '''
+        A method to make a directory on the FAT filesystem match a directory
+        on the host.  Both trees are walked together once, and everything that
+        has to change is worked out before anything is touched, so a host
+        name that doesn't fit in 8.3, two host names that become the same 8.3
+        name, or a full root directory leave the filesystem alone.  Files
+        whose size and modification time match are left alone, and only the
+        entries that differ are added, replaced, or removed, all in one
+        batch.  Host names are upper-cased.  In deterministic mode entries
+        carry a fixed timestamp, so the modification time is not compared.
+
+        Parameters:
+         local_dir - The local directory to sync from.
+         fat_dir - The directory on the FAT filesystem to sync into.
+         checksum - Whether to also compare the contents of files whose size and modification time match.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        top, index = self._find_record(fat_dir)
+        if not top.is_dir():
+            raise PyFatException("Can only sync into a directory")
+
+        # The plan has, for each existing directory that changes, its new
+        # list of children and the entries to free.  New directories are
+        # filled in as they are built, since they aren't in the tree yet.
+        plan = []
+        added = []
+        dirs = collections.deque([(local_dir, top, True)])
+        while dirs:
+            localpath, currdir, existing_dir = dirs.popleft()
+
+            host = _scan_host_dir(localpath)
+
+            # Drop everything that is gone from the host, or has changed
+            # between a file and a directory.
+            existing = {}
+            children = []
+            freed = []
+            for child in currdir.children:
+                if child.is_dot() or child.is_dotdot():
+                    children.append(child)
+                    continue
+
+                fullname = child.full_name()
+                if fullname not in host or bool(child.is_dir()) != host[fullname][2].is_dir():
+                    freed.append(child)
+                    continue
+
+                existing[fullname] = len(children)
+                children.append(child)
+
+            for fullname, (filename, ext, dirent) in host.items():
+                if dirent.is_dir():
+                    if fullname in existing:
+                        dirs.append((dirent.path, children[existing[fullname]], True))
+                        continue
+
+                    child = FATDirectoryEntry()
+                    child.new_dir(currdir, filename, ext, 0, self._date_time())
+
+                    dot = FATDirectoryEntry()
+                    dot.new_dot(currdir, 0, self._date_time())
+                    child.add_child(dot)
+
+                    dotdot = FATDirectoryEntry()
+                    dotdot.new_dotdot(currdir, self._date_time())
+                    child.add_child(dotdot)
+
+                    children.append(child)
+                    added.append(child)
+                    dirs.append((dirent.path, child, False))
+                    continue
+
+                st = dirent.stat()
+                date_time = self._date_time()
+                if date_time is None:
+                    date_time = _fat_date_time(st.st_mtime)
+
+                if fullname in existing:
+                    old = children[existing[fullname]]
+                    if old.file_size == st.st_size and (self.deterministic or (old.last_write_date, old.last_write_time) == date_time):
+                        if not checksum or self._same_data(old, dirent.path):
+                            continue
+
+                child = FATDirectoryEntry()
+                child.new_file(_LazyFile(dirent.path), st.st_size, currdir, filename, ext, 0, date_time)
+                if fullname in existing:
+                    child.attributes = old.attributes
+                    children[existing[fullname]] = child
+                    freed.append(old)
+                else:
+                    children.append(child)
+                added.append(child)
+
+            if not existing_dir:
+                currdir.children = children
+            elif len(freed) > 0 or children != currdir.children:
+                if currdir.parent is None and currdir.max_children is not None and len(children) > currdir.max_children:
+                    raise PyFatException("Too many files in the root entry (max is %d)" % (currdir.max_children))
+                plan.append((currdir, children, freed))
+
+        # Everything fits; make the changes in one batch, so the new entries
+        # are allocated together, and a lack of space undoes all of it.
+        with self.batch():
+            for currdir, children, freed in plan:
+                self._journal(currdir)
+                for old in freed:
+                    self._free_tree(old)
+                currdir.children = children
+            for child in added:
+                self._pending[child] = None
+            for currdir, children, freed in plan:
+                self._grow_dir(currdir)
+
+    @_mutator
+    def set_hidden(self, path):
+        '''
+        A method to set the hidden attribute on a FAT entry.
+
+        Parameters:
+         path - The path to the FAT entry to set the hidden attribute for.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        child, index = self._find_record(path)
+
+        self._journal(child)
+        child.set_hidden()
+
+    @_mutator
+    def set_archive(self, path):
+        '''
+        A method to set the archive attribute on a FAT entry.
+
+        Parameters:
+         path - The path to the FAT entry to set the archive attribute for.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        child, index = self._find_record(path)
+
+        self._journal(child)
+        child.set_archive()
+
+    @_mutator
+    def set_read_only(self, path):
+        '''
+        A method to set the read only attribute on a FAT entry.
+
+        Parameters:
+         path - The path to the FAT entry to set the read only attribute for.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        child, index = self._find_record(path)
+
+        self._journal(child)
+        child.set_read_only()
+
+    @_mutator
+    def set_system(self, path):
+        '''
+        A method to set the system attribute on a FAT entry.
+
+        Parameters:
+         path - The path to the FAT entry to set the system attribute for.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        child, index = self._find_record(path)
 
-        if num_fats not in [1, 2]:
-            raise PyFatException("Number of FATs must be 1 or 2")
+        self._journal(child)
+        child.set_system()
 
-        if media not in [0xf0, 0xf8, 0xf9, 0xfa, 0xfb, 0xfc, 0xfd, 0xfe, 0xff]:
-            raise PyFatException("Invalid media type")
+    @_mutator
+    def clear_hidden(self, path):
+        '''
+        A method to clear the hidden attribute on a FAT entry.
 
-        if bytes_per_sector not in [512, 1024, 2048, 4096]:
-            raise PyFatException("Expected 512, 1024, 2048, or 4096 bytes per sector")
+        Parameters:
+         path - The path to the FAT entry to clear the hidden attribute for.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
 
-        if sectors_per_cluster not in [1, 2, 4, 8, 16, 32, 64, 128]:
-            raise PyFatException("Expected 1, 2, 4, 8, 16, 32, 64, or 128 sector per cluster")
+        child, index = self._find_record(path)
 
-        self.jmp_boot = b'\xeb\x3c\x90'
-        self.oem_name = b'pyfat   '
-        self.bytes_per_sector = bytes_per_sector
-        self.sectors_per_cluster = sectors_per_cluster
-        self.reserved_sectors = reserved_sectors
-        self.num_fats = num_fats
-        self.max_root_dir_entries = root_dir_entries
-        self.sector_count = int(size_in_kb*1024 / self.bytes_per_sector)
-        if self.sector_count > 65535:
-            self.total_sector_count_32 = self.sector_count
-            self.sector_count = 0
+        self._journal(child)
+        child.clear_hidden()
+
+    @_mutator
+    def clear_archive(self, path):
+        '''
+        A method to clear the archive attribute on a FAT entry.
+
+        Parameters:
+         path - The path to the FAT entry to clear the archive attribute for.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        child, index = self._find_record(path)
+
+        self._journal(child)
+        child.clear_archive()
+
+    @_mutator
+    def clear_read_only(self, path):
+        '''
+        A method to clear the read only attribute on a FAT entry.
+
+        Parameters:
+         path - The path to the FAT entry to clear the read only attribute for.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        child, index = self._find_record(path)
+
+        self._journal(child)
+        child.clear_read_only()
+
+    @_mutator
+    def clear_system(self, path):
+        '''
+        A method to clear the system attribute on a FAT entry.
+
+        Parameters:
+         path - The path to the FAT entry to clear the system attribute for.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        child, index = self._find_record(path)
+
+        self._journal(child)
+        child.clear_system()
+
+    @_mutator
+    def resize(self, new_size_kb=None):
+        '''
+        A method to change the size of the filesystem.  The FAT type and the
+        cluster size stay the same, and the data area grows or shrinks at the
+        end.  When growing, the FATs keep their size as long as they can map
+        every cluster, so the data stays where it is; if they have to grow,
+        the data area starts later and every cluster moves along with it.
+        When shrinking, the FATs are cut down to fit, and only the clusters
+        past the new end are moved, into free clusters below it, and the
+        entries that used them are updated.
+
+        Parameters:
+         new_size_kb - The new size of the filesystem in kilobytes; if None, the smallest size that holds everything on it now.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        if self._pending is not None:
+            raise PyFatException("Cannot resize in the middle of a batch")
+
+        entry_bits = {self.FAT12: 12, self.FAT16: 16, self.FAT32: 32}[self.fat_type]
+
+        if new_size_kb is None:
+            used = self.count_of_clusters - self.fat.get_free_count()
+            # Keep enough clusters that the FAT type doesn't change.
+            clusters = max(used, {self.FAT12: 1, self.FAT16: 4085, self.FAT32: 65525}[self.fat_type])
+            fat_size = _ceiling_div((clusters + 2) * entry_bits, 8 * self.bytes_per_sector)
+            total_sectors = (self.reserved_sectors + self.root_dir_sectors + self.num_fats * fat_size +
+                             clusters * self.sectors_per_cluster)
+            # The FATs that _fit_fat_size picks may be a little bigger than
+            # the estimate; add clusters until there are enough left.
+            while True:
+                fat_size = self._fit_fat_size(total_sectors, entry_bits)
+                data_sectors = total_sectors - self.reserved_sectors - self.root_dir_sectors - self.num_fats * fat_size
+                if data_sectors // self.sectors_per_cluster >= clusters:
+                    break
+                total_sectors += self.sectors_per_cluster
+            new_size_kb = _ceiling_div(total_sectors * self.bytes_per_sector, 1024)
+
+        total_sectors = new_size_kb * 1024 // self.bytes_per_sector
+        fat_size = self._fit_fat_size(total_sectors, entry_bits)
+        if new_size_kb >= self.size_in_kb:
+            # Growing; if the FATs as they are can still map every cluster,
+            # leave them alone so that the data area doesn't move.
+            data_sectors = total_sectors - self.reserved_sectors - self.root_dir_sectors - self.num_fats * self.fat_size
+            if (data_sectors // self.sectors_per_cluster + 2) * entry_bits <= self.fat_size * self.bytes_per_sector * 8:
+                fat_size = self.fat_size
+        data_sectors = total_sectors - self.reserved_sectors - self.root_dir_sectors - self.num_fats * fat_size
+        count_of_clusters = data_sectors // self.sectors_per_cluster
+        if count_of_clusters < 4085:
+            fat_type = self.FAT12
+        elif count_of_clusters < 65525:
+            fat_type = self.FAT16
         else:
-            self.total_sector_count_32 = 0
-        self.media = media
-        self.sectors_per_fat = 9
-        self.sectors_per_track = 18
-        self.num_heads = 2
-        self.hidden_sectors = hidden_sectors
-        self.drive_num = drive_num
-        self.boot_sig = 41
-        self.volume_id = 4248983325
-        self.volume_label = b"NO NAME    "
-        self.fs_type = b"FAT16   "
-        self.boot_code = self.BOOT_CODE
-        self.bytes_per_cluster = self.bytes_per_sector * self.sectors_per_cluster
-        self.root_dir_sectors = int(((self.max_root_dir_entries * 32) + (self.bytes_per_sector - 1)) / self.bytes_per_sector)
+            fat_type = self.FAT32
+        if fat_type != self.fat_type:
+            raise PyFatException("Cannot resize to %d KB without changing the FAT type" % (new_size_kb))
+
+        max_cluster = count_of_clusters + 1
+        if max_cluster < self.fat.max_cluster:
+            used_above = self.fat.max_cluster - max_cluster - _count_free(self.fat.fat[max_cluster + 1:self.fat.max_cluster + 1])
+            free_below = _count_free(self.fat.fat[2:max_cluster + 1])
+            if used_above > free_below:
+                raise PyFatException("Cannot shrink to %d KB; there is not enough free space" % (new_size_kb))
+
+            # From here on, new clusters only come from below the new end.
+            self.fat.set_max_cluster(max_cluster)
+
+            entries = [self.root] if self.fat_type == self.FAT32 else []
+            entries.extend([child for path, child in self._walk()])
+            for entry in entries:
+                if entry.first_logical_cluster == 0:
+                    continue
 
-        self.root = FATDirectoryEntry()
-        self.root.new_root()
+                clusters = self.fat.get_cluster_list(entry.first_logical_cluster)
+                if max(clusters) <= max_cluster:
+                    continue
 
-        self.fat = FAT16()
-        self.fat.new(self.bytes_per_sector, self.sectors_per_fat)
+                if not entry.is_dir() and entry.original_data_location == entry.DATA_ON_ORIGINAL_FAT:
+                    # The data is found through the chain, which is about to
+                    # change; save off where it lives first.
+                    entry.orig_cluster_list = clusters
+                    entry.original_data_location = entry.DATA_RELOCATED
+
+                entry.first_logical_cluster = self.fat.relocate_entry(entry.first_logical_cluster)
+                entry.chain_tail = None
+                if entry.is_dir():
+                    for child in entry.children:
+                        if child.is_dot():
+                            child.first_logical_cluster = entry.first_logical_cluster
+
+            if self.fat_type == self.FAT32:
+                self.root_cluster = self.root.first_logical_cluster
+
+        self.fat.resize(self.bytes_per_sector, fat_size)
+        self.fat.set_max_cluster(max_cluster)
+
+        self.fat_size = fat_size
+        if self.fat_type == self.FAT32:
+            self.fat_size_32 = fat_size
+            self.total_sector_count_32 = total_sectors
+        else:
+            self.sectors_per_fat = fat_size
+            if total_sectors > 65535:
+                self.sector_count = 0
+                self.total_sector_count_32 = total_sectors
+            else:
+                self.sector_count = total_sectors
+                self.total_sector_count_32 = 0
+        (self.root_dir_sectors, self.fat_type) = self._determine_fat_type()
+        self._set_layout()
+        self.size_in_kb = new_size_kb
 
-        self.size_in_kb = size_in_kb
+    def _relayout(self, keep_placed=False):
+        '''
+        An internal method to lay the filesystem out in breadth-first order,
+        with each directory's clusters followed by the data for its files.  In
+        deterministic mode the children of every directory are sorted by name
+        first, so the result depends only on the content and not on the order
+        it was added in.
 
-        self.initialized = True
+        Parameters:
+         keep_placed - Whether to leave the entries that are already placed where they are and only lay out the rest in the free clusters; otherwise the current cluster allocation is thrown away and everything is laid out again.
+        Returns:
+         Nothing.
+        '''
+        fat32_root = [self.root] if self.fat_type == self.FAT32 else []
+
+        # The data for files that came from the original filesystem is found
+        # through the current FAT, which we are about to change; save off
+        # where it lives first.
+        moving = []
+        for entry in fat32_root + [child for path, child in self._walk()]:
+            if keep_placed and entry.placed:
+                continue
 
-    def _name_and_parent_from_path(self, path):
+            if not entry.is_dir() and entry.original_data_location == entry.DATA_ON_ORIGINAL_FAT:
+                entry.orig_cluster_list = self._orig_cluster_list(entry)
+                entry.original_data_location = entry.DATA_RELOCATED
+            moving.append(entry.first_logical_cluster)
+
+        if keep_placed:
+            # Everything that is about to be laid out again is freed first, so
+            # where it ends up only depends on the entries that stay put.
+            fat = self.fat
+            fat.remove_entries(moving)
+            if self.fat_type == self.FAT32:
+                fat.set_hints(fat.get_free_count(), 2)
+        else:
+            fat = self._new_fat_table()
+            fat.new(self.bytes_per_sector, self.fat_size)
+            fat.set_max_cluster(self.count_of_clusters + 1)
+            if self.fat_type == self.FAT32:
+                fat.set_hints(self.count_of_clusters, 2)
+
+        dirs = collections.deque([self.root])
+        while dirs:
+            currdir = dirs.popleft()
+
+            if self.deterministic:
+                dots = [c for c in currdir.children if c.is_dot() or c.is_dotdot()]
+                others = [c for c in currdir.children if not (c.is_dot() or c.is_dotdot())]
+                others.sort(key=lambda c: (c.filename, c.extension))
+                currdir.children = dots + others
+
+            if (currdir.parent is not None or self.fat_type == self.FAT32) and not (keep_placed and currdir.placed):
+                # The FAT12 and FAT16 root directory lives in its own fixed
+                # region; everything else gets enough clusters to hold all of
+                # its entries.
+                currdir.first_logical_cluster = fat.add_entry(max(1, len(currdir.children)) * 32, self.bytes_per_cluster)
+                currdir.chain_tail = None
+            currdir.placed = True
+
+            for child in currdir.children:
+                if child.is_dot():
+                    child.first_logical_cluster = currdir.first_logical_cluster
+                elif child.is_dotdot():
+                    continue
+                elif child.is_dir():
+                    dirs.append(child)
+                elif keep_placed and child.placed:
+                    continue
+                else:
+                    child.first_logical_cluster = fat.add_entry(child.file_size, self.bytes_per_cluster)
+                    child.chain_tail = None
+                    child.placed = True
+
+        self.fat = fat
+        if self.fat_type == self.FAT32:
+            self.root_cluster = self.root.first_logical_cluster
+
+    def _write_files(self, outfp, workers):
         '''
-        An internal method to get the original name and parent given a pathname.
+        An internal method to copy the data for every file into the output,
+        one contiguous run of clusters at a time on both sides.  With more
+        than one worker the files are copied in a pool of threads; by the
+        time this is called every file's destination clusters are known and
+        do not overlap, so each thread copies one file with positional reads
+        and writes.
 
         Parameters:
-         path - The path to find the parent and name for.
+         outfp - The file object being written to.
+         workers - The number of threads to copy files with.
         Returns:
-         A tuple of the name and the parent.
+         Nothing.
         '''
-        if path[0] != '/':
-            raise PyFatException("Must be a path starting with /")
+        jobs = []
+        for path, child in self._walk():
+            if child.is_dir() or child.file_size == 0:
+                continue
 
-        # First we need to find the parent of this directory, and add this
-        # one as a child.
-        splitpath = path.split('/')
-        # Pop off the front, as it is always blank.
-        splitpath.pop(0)
-        # Now take the name off.
-        name = splitpath.pop()
-        if len(splitpath) == 0:
-            # This is a new directory under the root, add it there
-            parent = self.root
+            dst_extents = self.layout.cluster_extents(self.fat.get_cluster_list(child.first_logical_cluster),
+                                                      child.file_size)
+            jobs.append((child, self._extents(child), dst_extents))
+
+        if not hasattr(os, 'pread'):
+            for child, src_extents, dst_extents in jobs:
+                _seek_copy(child.data_fp, src_extents, outfp, dst_extents, self.COPY_CHUNK_SIZE)
+            return
+
+        # Everything written so far went through the buffered file object;
+        # get it out to the descriptor before writing around it.
+        outfp.flush()
+        outfd = outfp.fileno()
+
+        if workers <= 1:
+            for child, src_extents, dst_extents in jobs:
+                self._copy_file_data(child, src_extents, outfd, dst_extents)
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self._copy_file_data, child, src_extents, outfd, dst_extents)
+                       for child, src_extents, dst_extents in jobs]
+            for future in futures:
+                future.result()
+
+    @_writer
+    def write(self, local_path, workers=1, defragment=False):
+        '''
+        A method to write this FAT filesystem out to a file.
+
+        Parameters:
+         local_path - The local file to write this FAT filesystem to.
+         workers - The number of threads to copy file data with.  The output is the same regardless of the number of workers.
+         defragment - Whether to lay the filesystem out again before writing it, breadth-first with each directory followed by the data for its files, every chain contiguous, and all of the free space at the end.  The object keeps the new layout afterwards.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
+
+        if self._pending is not None:
+            raise PyFatException("Cannot write in the middle of a batch")
+
+        if defragment:
+            self._relayout()
+        elif self.deterministic:
+            self._relayout(keep_placed=True)
+
+        with open(local_path, 'wb') as outfp:
+            # First write out the boot entry
+            boot_sector = struct.pack("=3s8sHBHBHHBHHHLL",
+                                      self.jmp_boot, self.oem_name,
+                                      self.bytes_per_sector,
+                                      self.sectors_per_cluster,
+                                      self.reserved_sectors,
+                                      self.num_fats, self.max_root_dir_entries,
+                                      self.sector_count, self.media,
+                                      self.sectors_per_fat,
+                                      self.sectors_per_track, self.num_heads,
+                                      self.hidden_sectors,
+                                      self.total_sector_count_32)
+            if self.fat_type == self.FAT32:
+                boot_sector += struct.pack("=LHHLHH12sBBBL11s8s420sH",
+                                           self.fat_size_32, self.ext_flags,
+                                           self.fs_ver, self.root_cluster,
+                                           self.fsinfo_sector_number,
+                                           self.backup_boot_sector, b'',
+                                           self.drive_num, 0, self.boot_sig,
+                                           self.volume_id, self.volume_label,
+                                           self.fs_type, self.boot_code, 0xaa55)
+            else:
+                boot_sector += struct.pack("=BBBL11s8s448sH", self.drive_num,
+                                           0, self.boot_sig, self.volume_id,
+                                           self.volume_label, self.fs_type,
+                                           self.boot_code, 0xaa55)
+            outfp.seek(0 * self.bytes_per_sector)
+            outfp.write(boot_sector)
+
+            if self.fat_type == self.FAT32:
+                # Save the hints, so the next open need not scan the FAT.
+                free_count = self.fat.get_free_count()
+                next_free = self.fat.next_free
+                if next_free is None:
+                    next_free = 0xffffffff
+                fsinfo = struct.pack(self.FSINFO_FORMAT, 0x41615252, b'',
+                                     0x61417272, free_count, next_free, b'',
+                                     0xaa550000)
+                outfp.seek(self.fsinfo_sector_number * self.bytes_per_sector)
+                outfp.write(fsinfo)
+                if self.backup_boot_sector != 0:
+                    outfp.seek(self.backup_boot_sector * self.bytes_per_sector)
+                    outfp.write(boot_sector)
+                    outfp.seek((self.backup_boot_sector + self.fsinfo_sector_number) * self.bytes_per_sector)
+                    outfp.write(fsinfo)
+
+            # Now write out the FATs
+            fat_record = self.fat.record(self.bytes_per_sector, self.fat_size)
+            for i in range(0, self.num_fats):
+                _write_sparse(outfp, self.layout.fat_copy_offset(i), fat_record)
+
+            # Now write out the directory entries
+            dirs = collections.deque([self.root])
+            while dirs:
+                currdir = dirs.popleft()
+
+                extent_iter = iter(self._dir_extents(currdir))
+                offset, left = next(extent_iter)
+                outfp.seek(offset)
+                for child in currdir.children:
+                    if left < 32:
+                        offset, left = next(extent_iter)
+                        outfp.seek(offset)
+
+                    if child.is_dotdot():
+                        # '..' points at the parent directory, or is 0 if the
+                        # parent is the root; the directory may have moved.
+                        child.first_logical_cluster = 0
+                        if currdir.parent.parent is not None:
+                            child.first_logical_cluster = currdir.parent.first_logical_cluster
+
+                    outfp.write(child.record())
+                    left -= 32
+
+                    if child.is_dir() and not (child.is_dot() or child.is_dotdot()):
+                        dirs.append(child)
+
+            # Now write out the files
+            self._write_files(outfp, workers)
+
+            # Finally, extend the file out to its final size; the parts that
+            # were never written are left as holes.
+            outfp.truncate(self.size_in_kb * 1024)
+
+    def list_dir(self, path):
+        '''
+        A method to list all of the children of this particular path.  Note that
+        the specified path must be a directory.
+
+        Parameters:
+         path - The fully qualified path to the record, of the form "/FOO/BAR".
+        Returns:
+         An iterator over a snapshot of the children of the directory.
+        '''
+        if not self.initialized:
+            raise PyFatException("Can only call list_dir on an already open object")
+
+        with self._lock.read_locked():
+            rec, index = self._find_record(path)
+
+            if not rec.is_dir():
+                raise PyFatException("Record is not a directory!")
+
+            return iter(list(rec.children))
+
+    @_reader
+    def free_space(self):
+        '''
+        A method to get the amount of free space on the filesystem.  On FAT32
+        this comes from the FSInfo sector when it is valid, rather than from
+        counting the free clusters in the FAT.
+
+        Parameters:
+         None.
+        Returns:
+         The number of free bytes.
+        '''
+        if not self.initialized:
+            raise PyFatException("Can only call free_space on an already open object")
+
+        return self.fat.get_free_count() * self.bytes_per_cluster
+
+    @_writer
+    def close(self):
+        '''
+        A method to close out this object.  Once this is called, the object is
+        no longer valid.
+
+        Parameters:
+         None.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("Can only call close on an already open object")
+
+        # Walk the entire directory tree, closing out file object as necessary.
+        # An attached object only has files on the image, so skip reading the
+        # rest of its directories out of shared memory just to close that.
+        if self._shared_memory is not None and self.read_only:
+            dirs = collections.deque()
         else:
-            parent, index = self._find_record('/' + '/'.join(splitpath))
+            dirs = collections.deque([self.root])
+        while dirs:
+            currdir = dirs.popleft()
 
-        return (name, parent)
+            for child in currdir.children:
+                if child.is_dir():
+                    dirs.append(child)
+                else:
+                    child.data_fp.close()
 
-    def add_file(self, fat_path, local_path):
+        if self.orig_fp is not None:
+            self.orig_fp.close()
+            self.orig_fp = None
+
+        if self._shared_memory is not None:
+            # The FAT views must be released before the segment can close.
+            self.fat = None
+            for view in self._shared_views:
+                view.release()
+            self._shared_views = []
+            self._shared_memory.close()
+            if not self.read_only:
+                # Only the object that shared the segment owns it.
+                _unlink_shared_memory(self._shared_memory)
+            self._shared_memory = None
+        self.read_only = False
+
+        self.initialized = False
+
+class FATDiff(object):
+    '''
+    The class that represents the differences between two FAT filesystems, as
+    computed by diff(), along with the data needed to patch one into the other.
+    '''
+    PATCH_MAGIC = b'PYFATPCH'
+    PATCH_VERSION = 1
+
+    def __init__(self):
+        self.initialized = False
+
+    def new(self, size):
         '''
-        A method to add a new file to the filesystem.
+        A method to create a new, empty FAT diff.
 
         Parameters:
-         fat_path - The path on the FAT filesystem to add the file.
-         local_path - The local path that the file data should come from.
+         size - The size in bytes of the image the patch produces.
         Returns:
          Nothing.
         '''
-        if not self.initialized:
-            raise PyFatException("This object is not yet initialized")
+        if self.initialized:
+            raise PyFatException("This object is already initialized")
 
-        infp = open(local_path, 'rb')
-        length = os.fstat(infp.fileno()).st_size
+        self.size = size
+        self.added_files = []
+        self.removed_files = []
+        self.changed_files = []
+        self.moved_files = []
+        self.changed_metadata_sectors = []
+        self.ranges = []
 
-        filename, parent = self._name_and_parent_from_path(fat_path)
+        self.initialized = True
 
-        name, ext = os.path.splitext(filename)
-        if len(ext) > 0 and ext[0] == '.':
-            ext = ext[1:]
+    def parse(self, patch):
+        '''
+        A method to parse a patch generated by record().  Only the data ranges
+        are stored in a patch, so the lists of changed paths will be empty.
 
-        first_cluster = self.fat.add_entry(length, self.bytes_per_sector)
+        Parameters:
+         patch - The string containing the patch.
+        Returns:
+         Nothing.
+        '''
+        if self.initialized:
+            raise PyFatException("This object is already initialized")
 
-        child = FATDirectoryEntry()
-        child.new_file(infp, length, parent, name, ext, first_cluster)
+        (magic, version, size, num_ranges) = struct.unpack("=8sBQL", patch[:21])
+        if magic != self.PATCH_MAGIC:
+            raise PyFatException("Not a pyfat patch")
+        if version != self.PATCH_VERSION:
+            raise PyFatException("Unsupported pyfat patch version %d" % (version))
+
+        self.new(size)
+
+        read = 21
+        for unused in range(0, num_ranges):
+            (offset, length) = struct.unpack("=QL", patch[read:read+12])
+            read += 12
+            data = patch[read:read+length]
+            if len(data) != length:
+                raise PyFatException("Truncated pyfat patch")
+            read += length
+            self.ranges.append((offset, data))
+
+    def add_range(self, offset, data):
+        '''
+        A method to add a range of bytes that differ to this diff.
 
-        parent.add_child(child)
+        Parameters:
+         offset - The offset of the range in the image.
+         data - The new data for the range.
+        Returns:
+         Nothing.
+        '''
+        if not self.initialized:
+            raise PyFatException("This object is not yet initialized")
 
-        # We only try to expand directories that are not the root.
-        if parent.parent is not None:
-            if len(parent.children) > 1 and (len(parent.children) % (self.bytes_per_sector/32)) == 1:
-                # Here, we need to add another entry to the FAT filesystem.
-                self.fat.expand_entry(parent.first_logical_cluster)
+        self.ranges.append((offset, data))
 
-    def add_dir(self, path):
+    def record(self):
         '''
-        A method to add a new directory to the FAT filesystem.
+        A method to generate a string representing the patch for this diff.
+        Ranges that touch each other are coalesced into one.
 
         Parameters:
-         path - The path at which to create the new directory.
+         None.
         Returns:
-         Nothing.
+         A string representing the patch for this diff.
         '''
         if not self.initialized:
             raise PyFatException("This object is not yet initialized")
 
-        filename, parent = self._name_and_parent_from_path(path)
+        coalesced = []
+        for offset, data in sorted(self.ranges, key=lambda r: r[0]):
+            if coalesced and coalesced[-1][0] + len(coalesced[-1][1]) == offset:
+                coalesced[-1][1].extend(data)
+            else:
+                coalesced.append((offset, bytearray(data)))
 
-        name, ext = os.path.splitext(filename)
+        ret = [struct.pack("=8sBQL", self.PATCH_MAGIC, self.PATCH_VERSION,
+                           self.size, len(coalesced))]
+        for offset, data in coalesced:
+            ret.append(struct.pack("=QL", offset, len(data)))
+            ret.append(bytes(data))
 
-        first_cluster = self.fat.add_entry(self.bytes_per_cluster, self.bytes_per_sector)
+        return b''.join(ret)
 
-        child = FATDirectoryEntry()
-        child.new_dir(parent, name, ext, first_cluster)
+def _diff_extents(fp_a, fp_b, offsets, unit):
+    '''
+    An internal generator to compare two files in units at the given offsets.
+    Offsets that directly follow each other are read together, so a
+    contiguous chain costs one read per file rather than one per unit.
 
-        parent.add_child(child)
+    Parameters:
+     fp_a - The original file object.
+     fp_b - The updated file object.
+     offsets - The list of offsets to compare.
+     unit - The number of bytes to compare at each offset.
+    Yields:
+     A tuple of the offset and the updated data for each unit that differs.
+    '''
+    # Don't hold more than 1MB of a run in memory at once.
+    max_run = max(1, (1024 * 1024) // unit)
+
+    index = 0
+    while index < len(offsets):
+        start = index
+        index += 1
+        while index < len(offsets) and index - start < max_run and offsets[index] == offsets[index-1] + unit:
+            index += 1
 
-        dot = FATDirectoryEntry()
-        dot.new_dot(parent, first_cluster)
-        child.add_child(dot)
+        fp_a.seek(offsets[start])
+        data_a = fp_a.read((index - start) * unit)
+        fp_b.seek(offsets[start])
+        data_b = fp_b.read((index - start) * unit)
 
-        dotdot = FATDirectoryEntry()
-        dotdot.new_dotdot(parent)
-        child.add_child(dotdot)
+        for i in range(0, index - start):
+            chunk = data_b[i*unit:(i+1)*unit]
+            if data_a[i*unit:(i+1)*unit] != chunk:
+                yield offsets[start + i], chunk
 
-        # We only try to expand directories that are not the root.
-        if parent.parent is not None:
-            if len(parent.children) > 1 and (len(parent.children) % (self.bytes_per_sector/32)) == 1:
-                # Here, we need to add another entry to the FAT filesystem.
-                self.fat.expand_entry(parent.first_logical_cluster)
+def _ranges_equal(fp_a, offsets_a, fp_b, offsets_b, size, unit):
+    '''
+    An internal function to compare the data of a file in one image with the
+    data of a file in another, where the two may live in different clusters.
 
-    def rm_dir(self, path):
-        '''
-        A method to remove a directory from the FAT filesystem.
+    Parameters:
+     fp_a - The file object for the first image.
+     offsets_a - The list of offsets of the file's clusters in the first image.
+     fp_b - The file object for the second image.
+     offsets_b - The list of offsets of the file's clusters in the second image.
+     size - The size of the file in bytes.
+     unit - The number of bytes in a cluster.
+    Returns:
+     True if the data is the same, False otherwise.
+    '''
+    if len(offsets_a) != len(offsets_b):
+        return False
+
+    left = size
+    for offset_a, offset_b in zip(offsets_a, offsets_b):
+        # Only compare the part of the last cluster that is in the file.
+        length = min(left, unit)
+        fp_a.seek(offset_a)
+        fp_b.seek(offset_b)
+        if fp_a.read(length) != fp_b.read(length):
+            return False
+        left -= length
+
+    return True
+
+def diff(image_a, image_b):
+    '''
+    A function to compare two FAT filesystem images with the same geometry.
+    Rather than comparing every byte, this compares the metadata regions and
+    then walks the directory trees, comparing the data of each file at the
+    clusters it occupies in image_b.  Free clusters are never compared, so
+    applying the patch gives a filesystem with the same content as image_b,
+    not necessarily an identical image.
 
-        Parameters:
-         path - The path to the directory to be removed.
-        Returns:
-         Nothing.
-        '''
-        if not self.initialized:
-            raise PyFatException("This object is not yet initialized")
+    Parameters:
+     image_a - The filename of the original FAT filesystem image.
+     image_b - The filename of the updated FAT filesystem image.
+    Returns:
+     A FATDiff object describing the differences; its record() method generates the patch that apply_patch() uses to turn image_a into image_b.
+    '''
+    fat_a = PyFat()
+    fat_a.open(image_a)
+    fat_b = PyFat()
+    fat_b.open(image_b)
+
+    try:
+        for attr in ['bytes_per_sector', 'sectors_per_cluster', 'reserved_sectors',
+                     'num_fats', 'fat_size', 'max_root_dir_entries']:
+            if getattr(fat_a, attr) != getattr(fat_b, attr):
+                raise PyFatException("Can only diff images with the same geometry (%s differs)" % (attr))
+
+        fatdiff = FATDiff()
+        fatdiff.new(os.path.getsize(image_b))
+
+        bytes_per_sector = fat_b.bytes_per_sector
+        bytes_per_cluster = fat_b.bytes_per_cluster
+
+        # The boot sector, the FATs and the root directory.
+        metadata_offsets = list(range(0, fat_b.layout.root_dir_offset, bytes_per_sector))
+        for offset, length in fat_b._dir_extents(fat_b.root):
+            metadata_offsets.extend(range(offset, offset + length, bytes_per_sector))
+
+        entries_a = dict(fat_a._walk())
+        for path, entry_b in fat_b._walk():
+            chain_b = []
+            if entry_b.is_dir() or entry_b.file_size > 0:
+                chain_b = fat_b.fat.get_cluster_list(entry_b.first_logical_cluster)
+
+            if entry_b.is_dir():
+                # Directory clusters are metadata, and small; always compare.
+                for cluster in chain_b:
+                    for sector in range(0, bytes_per_cluster, bytes_per_sector):
+                        metadata_offsets.append(fat_b.layout.cluster_offset(cluster) + sector)
+                if path not in entries_a:
+                    fatdiff.added_files.append(path)
+                continue
 
-        child, index = self._find_record(path)
+            offsets = [fat_b.layout.cluster_offset(cluster) for cluster in chain_b]
 
-        if not child.is_dir():
-            raise PyFatException("Cannot remove file; try rm_file instead")
+            entry_a = entries_a.get(path)
+            if entry_a is None or entry_a.is_dir():
+                fatdiff.added_files.append(path)
+                for offset, data in _diff_extents(fat_a.orig_fp, fat_b.orig_fp, offsets, bytes_per_cluster):
+                    fatdiff.add_range(offset, data)
+                continue
 
-        if len(child.children) != 2:
-            # If there are more than 2 entries in the directory (. and ..),
-            # then we can't remove
-            raise PyFatException("Cannot remove non-empty directory")
+            chain_a = []
+            if entry_a.file_size > 0:
+                chain_a = fat_a.fat.get_cluster_list(entry_a.first_logical_cluster)
+
+            # Leave out both words of the first cluster; where the data lives
+            # is covered by comparing the chains.
+            record_a = entry_a.record()
+            record_b = entry_b.record()
+            same_entry = record_a[:20] + record_a[22:26] + record_a[28:] == record_b[:20] + record_b[22:26] + record_b[28:]
+
+            # A file can change without its entry changing at all, so the
+            # data always has to be compared.
+            data_changed = False
+            for offset, data in _diff_extents(fat_a.orig_fp, fat_b.orig_fp, offsets, bytes_per_cluster):
+                fatdiff.add_range(offset, data)
+                data_changed = True
+
+            if chain_a != chain_b:
+                fatdiff.moved_files.append(path)
+                # The clusters the file moved to held something else in
+                # image_a, so whether the file itself changed has to be
+                # decided by comparing it with where it used to be.
+                if same_entry:
+                    offsets_a = [fat_a.layout.cluster_offset(cluster) for cluster in chain_a]
+                    data_changed = not _ranges_equal(fat_a.orig_fp, offsets_a, fat_b.orig_fp,
+                                                    offsets, entry_b.file_size, bytes_per_cluster)
+
+            if not same_entry or data_changed:
+                fatdiff.changed_files.append(path)
+
+        entries_b = set(path for path, entry in fat_b._walk())
+        for path in entries_a:
+            if path not in entries_b:
+                fatdiff.removed_files.append(path)
+
+        for offset, data in _diff_extents(fat_a.orig_fp, fat_b.orig_fp, metadata_offsets, bytes_per_sector):
+            fatdiff.changed_metadata_sectors.append(offset // bytes_per_sector)
+            fatdiff.add_range(offset, data)
+    finally:
+        fat_a.close()
+        fat_b.close()
+
+    return fatdiff
+
+def apply_patch(image, patch):
+    '''
+    A function to apply a patch generated by FATDiff.record() to an image in
+    place.
 
-        if child.parent is None:
-            raise PyFatException("Cannot remove the root entry")
+    Parameters:
+     image - The filename of the FAT filesystem image to patch.
+     patch - The string containing the patch.
+    Returns:
+     Nothing.
+    '''
+    fatdiff = FATDiff()
+    fatdiff.parse(patch)
 
-        self.fat.remove_entry(child.first_logical_cluster)
+    with open(image, 'r+b') as outfp:
+        for offset, data in fatdiff.ranges:
+            outfp.seek(offset)
+            outfp.write(data)
 
-        child.parent.remove_child(index)
+        outfp.truncate(fatdiff.size)
 
-    def rm_file(self, path):
-        '''
-        A method to remove a file from the FAT filesystem.
+def convert(src_image, dst_path, fat_type=None, cluster_size=None, size=None):
+    '''
+    A function to copy a FAT filesystem image into a new one with a different
+    FAT type or geometry.  The files are never staged on the host; the new
+    image is formatted, every entry is copied across with its data read
+    straight from the source image, and the whole tree is laid out in one
+    pass, breadth-first, with each directory followed by its files.  The
+    volume label and serial number are carried over.
 
-        Parameters:
-         path - The path to the file to be removed.
-        Returns:
-         Nothing.
-        '''
-        if not self.initialized:
-            raise PyFatException("This object is not yet initialized")
+    Parameters:
+     src_image - The filename of the FAT filesystem image to convert.
+     dst_path - The filename to write the new FAT filesystem image to.
+     fat_type - PyFat.FAT12, PyFat.FAT16 or PyFat.FAT32; if None, it is picked from the size.
+     cluster_size - The number of bytes per cluster; if None, it is picked from the size.
+     size - The size of the new filesystem in kilobytes; if None, the size of the source.
+    Returns:
+     Nothing.
+    '''
+    src = PyFat()
+    src.open(src_image)
+    try:
+        if size is None:
+            total_sectors = src.sector_count
+            if total_sectors == 0:
+                total_sectors = src.total_sector_count_32
+            size = total_sectors * src.bytes_per_sector // 1024
+
+        sectors_per_cluster = None
+        if cluster_size is not None:
+            if cluster_size % src.bytes_per_sector != 0:
+                raise PyFatException("The cluster size must be a multiple of %d" % (src.bytes_per_sector))
+            sectors_per_cluster = cluster_size // src.bytes_per_sector
+
+        dst = PyFat()
+        dst.new(size_in_kb=size, sectors_per_cluster=sectors_per_cluster,
+                bytes_per_sector=src.bytes_per_sector, fat_type=fat_type)
+        try:
+            dst.volume_id = src.volume_id
+            dst.volume_label = src.volume_label
+
+            with dst.batch():
+                for child in src.root.children:
+                    if child.is_dot() or child.is_dotdot():
+                        continue
+                    name = child.full_name()
+                    dst.copy_from(src, '/' + name, '/' + name)
+
+            dst.write(dst_path)
+        finally:
+            dst.close()
+    finally:
+        src.close()
+
+def _build_one(manifest):
+    '''
+    An internal function to build a single FAT filesystem image from a
+    manifest; see build_many().
 
-        child, index = self._find_record(path)
+    Parameters:
+     manifest - The manifest describing the image to build.
+    Returns:
+     A tuple of the output filename and the number of seconds it took to build.
+    '''
+    for key in manifest:
+        if key not in ['output', 'new', 'dirs', 'files', 'attributes']:
+            raise PyFatException("Unknown manifest key %s" % (key))
 
-        if child.is_dir():
-            raise PyFatException("Cannot remove directory; try rm_dir instead")
+    if 'output' not in manifest:
+        raise PyFatException("The manifest must have an output")
 
-        self.fat.remove_entry(child.first_logical_cluster)
+    start = time.time()
 
-        child.parent.remove_child(index)
+    fat = PyFat()
+    fat.new(**manifest.get('new', {}))
+    try:
+        for path in manifest.get('dirs', []):
+            fat.add_dir(path)
 
-    def set_hidden(self, path):
-        '''
-        A method to set the hidden attribute on a FAT entry.
+        for fat_path, local_path in manifest.get('files', []):
+            fat.add_file(fat_path, local_path)
 
-        Parameters:
-         path - The path to the FAT entry to set the hidden attribute for.
-        Returns:
-         Nothing.
-        '''
-        if not self.initialized:
-            raise PyFatException("This object is not yet initialized")
+        for path, attributes in manifest.get('attributes', {}).items():
+            for attribute in attributes:
+                if attribute not in ['hidden', 'archive', 'system', 'read_only']:
+                    raise PyFatException("Unknown attribute %s" % (attribute))
+                getattr(fat, 'set_' + attribute)(path)
 
-        child, index = self._find_record(path)
+        fat.write(manifest['output'])
+    finally:
+        fat.close()
 
-        child.set_hidden()
+    return (manifest['output'], time.time() - start)
 
-    def set_archive(self, path):
-        '''
-        A method to set the archive attribute on a FAT entry.
+def build_many(manifests, processes=None):
+    '''
+    A function to build many FAT filesystem images at once, in a pool of
+    processes.  Each manifest is a dictionary with the following keys:
 
-        Parameters:
-         path - The path to the FAT entry to set the archive attribute for.
-        Returns:
-         Nothing.
-        '''
-        if not self.initialized:
-            raise PyFatException("This object is not yet initialized")
+     output - The filename to write the image to (required).
+     new - A dictionary of keyword arguments for PyFat.new().
+     dirs - A list of directories to add, parents first.
+     files - A list of tuples of the path on the FAT filesystem and the local path of each file to add.
+     attributes - A dictionary mapping paths on the FAT filesystem to a list of the attributes to set on them; any of 'hidden', 'archive', 'system' and 'read_only'.
 
-        child, index = self._find_record(path)
+    The source files are only ever read, so manifests may freely share them.
 
-        child.set_archive()
+    Parameters:
+     manifests - The list of manifests to build.
+     processes - The number of processes to build with; if None, the number of CPUs.  With 1, the images are built in this process.
+    Returns:
+     A list of tuples of the output filename and the number of seconds it took to build, in the same order as the manifests.
+    '''
+    if processes == 1:
+        return [_build_one(manifest) for manifest in manifests]
 
-    def set_read_only(self, path):
-        '''
-        A method to set the read only attribute on a FAT entry.
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(_build_one, manifests))
 
-        Parameters:
-         path - The path to the FAT entry to set the read only attribute for.
-        Returns:
-         Nothing.
-        '''
-        if not self.initialized:
-            raise PyFatException("This object is not yet initialized")
+class AsyncPyFat(object):
+    '''
+    A class that wraps PyFat for use from asyncio.  The blocking I/O is done
+    in a bounded executor, which by default is shared by every AsyncPyFat.
+    Reads against an image are queued, and everything that queues up while
+    the previous batch is being serviced is read in one executor job, in
+    on-disk order.  That keeps the event loop responsive under many
+    concurrent requests, and means an image is never read from two threads
+    at once.
+    '''
+    MAX_WORKERS = 8
+    _shared_executor = None
 
-        child, index = self._find_record(path)
+    def __init__(self, executor=None):
+        if executor is None:
+            if AsyncPyFat._shared_executor is None:
+                AsyncPyFat._shared_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.MAX_WORKERS)
+            executor = AsyncPyFat._shared_executor
 
-        child.set_read_only()
+        self.fat = PyFat()
+        self.executor = executor
+        self._pending = []
+        self._batch = None
 
-    def set_system(self, path):
+    async def open(self, filename):
         '''
-        A method to set the system attribute on a FAT entry.
+        A method to open up an existing FAT filesystem.
 
         Parameters:
-         path - The path to the FAT entry to set the system attribute for.
+         filename - The filename that contains the FAT filesystem to open.
         Returns:
          Nothing.
         '''
-        if not self.initialized:
-            raise PyFatException("This object is not yet initialized")
-
-        child, index = self._find_record(path)
-
-        child.set_system()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.fat.open, filename)
 
-    def clear_hidden(self, path):
+    async def list_dir(self, path):
         '''
-        A method to clear the hidden attribute on a FAT entry.
+        A method to list all of the children of a directory.  The directory
+        tree is kept in memory, so this does no I/O.
 
         Parameters:
-         path - The path to the FAT entry to clear the hidden attribute for.
+         path - The fully qualified path to the directory, of the form "/FOO/BAR".
         Returns:
-         Nothing.
+         A list of the FAT directory entry objects in the directory.
         '''
-        if not self.initialized:
-            raise PyFatException("This object is not yet initialized")
+        return list(self.fat.list_dir(path))
 
-        child, index = self._find_record(path)
+    async def read_file(self, path):
+        '''
+        A method to read the data for a file on the FAT filesystem.
 
-        child.clear_hidden()
+        Parameters:
+         path - The path on the FAT filesystem of the file to read.
+        Returns:
+         A string containing the data for the file.
+        '''
+        return await self._submit(path, None)
 
-    def clear_archive(self, path):
+    async def extract(self, fat_path, local_path):
         '''
-        A method to clear the archive attribute on a FAT entry.
+        A method to write the data for a file on the FAT filesystem to the
+        host.
 
         Parameters:
-         path - The path to the FAT entry to clear the archive attribute for.
+         fat_path - The path on the FAT filesystem of the file to extract.
+         local_path - The local path in which to write the data.
         Returns:
          Nothing.
         '''
-        if not self.initialized:
-            raise PyFatException("This object is not yet initialized")
-
-        child, index = self._find_record(path)
+        await self._submit(fat_path, local_path)
 
-        child.clear_archive()
-
-    def clear_read_only(self, path):
+    async def close(self):
         '''
-        A method to clear the read only attribute on a FAT entry.
+        A method to close out this object once all queued reads are done.
 
         Parameters:
-         path - The path to the FAT entry to clear the read only attribute for.
+         None.
         Returns:
          Nothing.
         '''
-        if not self.initialized:
-            raise PyFatException("This object is not yet initialized")
+        if self._batch is not None:
+            await self._batch
 
-        child, index = self._find_record(path)
-
-        child.clear_read_only()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.fat.close)
 
-    def clear_system(self, path):
+    def _submit(self, path, local_path):
         '''
-        A method to clear the system attribute on a FAT entry.
+        An internal method to queue up a read, starting a batch if one isn't
+        already running.
 
         Parameters:
-         path - The path to the FAT entry to clear the system attribute for.
+         path - The path on the FAT filesystem of the file to read.
+         local_path - The local path to write the data to, or None to return it.
         Returns:
-         Nothing.
+         A future for the result of the read.
         '''
-        if not self.initialized:
-            raise PyFatException("This object is not yet initialized")
-
-        child, index = self._find_record(path)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((path, local_path, future))
+        if self._batch is None:
+            self._batch = asyncio.ensure_future(self._run_batches())
 
-        child.clear_system()
+        return future
 
-    def write(self, local_path):
+    async def _run_batches(self):
         '''
-        A method to write this FAT filesystem out to a file.
+        An internal coroutine to service queued reads, one batch at a time,
+        until there are none left.
 
         Parameters:
-         local_path - The local file to write this FAT filesystem to.
+         None.
         Returns:
          Nothing.
         '''
-        if not self.initialized:
-            raise PyFatException("This object is not yet initialized")
-
-        with open(local_path, 'wb') as outfp:
-            # First write out the boot entry
-            outfp.seek(0 * self.bytes_per_sector)
-            outfp.write(struct.pack("=3s8sHBHBHHBHHHLLBBBL11s8s448sH",
-                                    self.jmp_boot, self.oem_name,
-                                    self.bytes_per_sector,
-                                    self.sectors_per_cluster,
-                                    self.reserved_sectors,
-                                    self.num_fats, self.max_root_dir_entries,
-                                    self.sector_count, self.media,
-                                    self.sectors_per_fat,
-                                    self.sectors_per_track, self.num_heads,
-                                    self.hidden_sectors,
-                                    self.total_sector_count_32, self.drive_num,
-                                    0, self.boot_sig, self.volume_id,
-                                    self.volume_label, self.fs_type,
-                                    self.boot_code, 0xaa55))
-
-            # Now write out the first FAT
-            outfp.seek(1 * self.bytes_per_sector)
-            outfp.write(self.fat.record(self.bytes_per_sector, self.sectors_per_fat))
-
-            if self.num_fats == 2:
-                # Now write out the second FAT
-                outfp.seek((1+self.sectors_per_fat) * self.bytes_per_sector)
-                outfp.write(self.fat.record(self.bytes_per_sector, self.sectors_per_fat))
-
-            # Now write out the directory entries
-            # The first root directory sector is preceded by:
-            # BPB consisting of 1 sector
-            # First FAT consisting of self.sectors_per_fat sectors
-            # (Optional) Second FAT consisting of self.sectors_per_fat sectors
-            first_root_dir_sector = 1 + (self.num_fats * self.sectors_per_fat)
-            root_cluster_list = []
-            for i in range(first_root_dir_sector, first_root_dir_sector+self.root_dir_sectors):
-                root_cluster_list.append(i)
-
-            dirs = collections.deque([(self.root, root_cluster_list)])
-            while dirs:
-                currdir, physical_clusters = dirs.popleft()
-
-                cluster_iter = iter(physical_clusters)
-                outfp.seek(cluster_iter.__next__() * self.bytes_per_cluster)
-                cluster_offset = 0
-                for child in currdir.children:
-                    if cluster_offset + 32 > 512:
-                        cluster_offset = 0
-                        outfp.seek(cluster_iter.__next__() * self.bytes_per_cluster)
-
-                    outfp.write(child.record())
-                    cluster_offset += 32
-
-                    if child.is_dir() and not (child.is_dot() or child.is_dotdot()):
-                        dirs.append((child, self.fat.get_cluster_list(child.first_logical_cluster)))
-
-            # Now write out the files
-            dirs = collections.deque([self.root])
-            while dirs:
-                currdir = dirs.popleft()
-
-                for child in currdir.children:
-                    if child.is_dir():
-                        dirs.append(child)
+        loop = asyncio.get_running_loop()
+        requests = []
+        try:
+            while self._pending:
+                requests, self._pending = self._pending, []
+                try:
+                    results = await loop.run_in_executor(self.executor, self._do_batch, requests)
+                except Exception as exc:
+                    # The batch failed as a whole rather than one read in it;
+                    # fail every read in it and go on to the next batch.
+                    results = [(None, exc)] * len(requests)
+
+                for (path, local_path, future), (result, exc) in zip(requests, results):
+                    if future.done():
+                        continue
+                    if exc is not None:
+                        future.set_exception(exc)
                     else:
-                        new_cluster_list = self.fat.get_cluster_list(child.first_logical_cluster)
-                        if child.original_data_location == child.DATA_ON_ORIGINAL_FAT:
-                            # If this is a file that was on the original
-                            # filesystem, then we haven't modified the cluster
-                            # list and the original is the same as the new.
-                            orig_cluster_list = new_cluster_list
-                        elif child.original_data_location == child.DATA_IN_EXTERNAL_FP:
-                            orig_cluster_list = range(0, _ceiling_div(child.file_size, 512))
-
-                        left = child.file_size
-                        index = 0
-                        while index < len(orig_cluster_list) and left > 0:
-                            thisread = self.bytes_per_cluster
-                            if left < thisread:
-                                thisread = left
-
-                            child.data_fp.seek(orig_cluster_list[index] * self.bytes_per_cluster)
-                            outfp.seek(new_cluster_list[index] * self.bytes_per_cluster)
-                            outfp.write(child.data_fp.read(thisread))
-
-                            left -= thisread
-                            index += 1
-
-            # Finally, truncate the file out to its final size
-            outfp.truncate(self.size_in_kb * 1024)
-            outfp.seek(-1, os.SEEK_END)
-            # FIXME: this could possibly overwrite the last byte on the volume.
-            # We should only do this if we aren't already at the end.
-            outfp.write(b"\x00")
+                        future.set_result(result)
+                requests = []
+        except BaseException as exc:
+            # We were cancelled or interrupted, and nothing else will resolve
+            # these futures; hand the error to every caller still waiting
+            # before passing it on.
+            for path, local_path, future in requests + self._pending:
+                if future.done():
+                    continue
+                if isinstance(exc, asyncio.CancelledError):
+                    future.cancel()
+                else:
+                    future.set_exception(exc)
+            self._pending = []
+            raise
+        finally:
+            self._batch = None
 
-    def list_dir(self, path):
+    def _do_batch(self, requests):
         '''
-        A method to list all of the children of this particular path.  Note that
-        the specified path must be a directory.
+        An internal method, run in the executor, to service a batch of reads
+        in the order their data appears on the filesystem.
 
         Parameters:
-         path - The fully qualified path to the record, of the form "/FOO/BAR".
+         requests - The list of queued reads.
         Returns:
-         Nothing.
+         A list of tuples of the result and the exception (if any) for each read.
         '''
-        if not self.initialized:
-            raise PyFatException("Can only call list_dir on an already open object")
+        with self.fat._lock.read_locked():
+            return self._do_batch_locked(requests)
 
-        rec, index = self._find_record(path)
-
-        if not rec.is_dir():
-            raise PyFatException("Record is not a directory!")
-
-        for child in rec.children:
-            yield child
-
-    def close(self):
+    def _do_batch_locked(self, requests):
         '''
-        A method to close out this object.  Once this is called, the object is
-        no longer valid.
+        An internal method to service a batch of reads with the PyFat lock
+        held; see _do_batch().
 
         Parameters:
-         None.
+         requests - The list of queued reads.
         Returns:
-         Nothing.
+         A list of tuples of the result and the exception (if any) for each read.
         '''
-        if not self.initialized:
-            raise PyFatException("Can only call close on an already open object")
-
-        # Walk the entire directory tree, closing out file object as necessary.
-        dirs = collections.deque([self.root])
-        while dirs:
-            currdir = dirs.popleft()
-
-            for child in currdir.children:
+        results = [(None, None)] * len(requests)
+        order = []
+        for index, (path, local_path, future) in enumerate(requests):
+            try:
+                child, unused = self.fat._find_record(path)
                 if child.is_dir():
-                    dirs.append(child)
+                    raise PyFatException("Cannot get data from a directory")
+                order.append((child.first_logical_cluster, index, child))
+            except Exception as exc:
+                results[index] = (None, exc)
+
+        order.sort(key=lambda o: (o[0], o[1]))
+        for cluster, index, child in order:
+            local_path = requests[index][1]
+            try:
+                if local_path is None:
+                    results[index] = (self.fat._read_data(child), None)
                 else:
-                    child.data_fp.close()
-
-        if self.orig_fp is not None:
-            self.orig_fp.close()
-            self.orig_fp = None
+                    with open(local_path, 'wb') as outfp:
+                        self.fat._copy_extents(child, outfp)
+            except Exception as exc:
+                # Whatever goes wrong with one read only fails that read.
+                results[index] = (None, exc)
 
-        self.initialized = False
+        return results
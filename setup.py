@@ -1,5 +1,5 @@
-import distutils.core
-from distutils.command.sdist import sdist as _sdist
+import setuptools
+from setuptools.command.sdist import sdist as _sdist
 import subprocess
 import time
 
@@ -16,14 +16,14 @@ class sdist(_sdist):
         # Create a development release string for later use
         git_head = subprocess.Popen("git log -1 --pretty=format:%h",
                                     shell=True,
-                                    stdout=subprocess.PIPE).communicate()[0].strip()
+                                    stdout=subprocess.PIPE).communicate()[0].strip().decode('utf-8')
         date = time.strftime("%Y%m%d%H%M%S", time.gmtime())
         git_release = "%sgit%s" % (date, git_head)
 
         # Expand macros in pyfat.spec.in and create pyfat.spec
         spec_in = open('pyfat.spec.in', 'r')
         spec = open('pyfat.spec', 'w')
-        for line in spec_in.xreadlines():
+        for line in spec_in:
             if "@VERSION@" in line:
                 line = line.replace("@VERSION@", VERSION)
             elif "@RELEASE@" in line:
@@ -38,20 +38,22 @@ class sdist(_sdist):
         # Run parent constructor
         _sdist.run(self)
 
-distutils.core.setup(name='pyfat',
-                     version=VERSION,
-                     description='Pure python FAT manipulation library',
-                     url='http://github.com/clalancette/pyfat',
-                     author='Chris Lalancette',
-                     author_email='clalancette@gmail.com',
-                     license='LGPLv2',
-                     classifiers=['Development Status :: 4 - Beta',
-                                  'Intended Audience :: Developers',
-                                  'License :: OSI Approved :: GNU Lesser General Public License v2 (LGPLv2)',
-                                  'Natural Language :: English',
-                                  'Programming Language :: Python :: 2',
-                     ],
-                     keywords='FAT FAT12 FAT16 FAT32',
-                     py_modules=['pyfat'],
-                     cmdclass={'sdist': sdist},
+setuptools.setup(name='pyfat',
+                 version=VERSION,
+                 description='Pure python FAT manipulation library',
+                 url='http://github.com/clalancette/pyfat',
+                 author='Chris Lalancette',
+                 author_email='clalancette@gmail.com',
+                 license='LGPLv2',
+                 classifiers=['Development Status :: 4 - Beta',
+                              'Intended Audience :: Developers',
+                              'License :: OSI Approved :: GNU Lesser General Public License v2 (LGPLv2)',
+                              'Natural Language :: English',
+                              'Programming Language :: Python :: 3',
+                              'Programming Language :: Python :: 3 :: Only',
+                 ],
+                 python_requires='>=3.8',
+                 keywords='FAT FAT12 FAT16 FAT32',
+                 py_modules=['pyfat'],
+                 cmdclass={'sdist': sdist},
 )
@@ -1,4 +1,3 @@
-import StringIO
 
 def internal_check_boot_sector(fat):
     assert(fat.bytes_per_sector == 512)
@@ -61,7 +60,7 @@ def check_onefile(fat, tmpdir, filesize):
     for i in range(3, int(512*9 / 1.5)):
         assert(fat.fat.fat[i] == 0x00)
 
-    foo = tmpdir.join("foo")
+    foo = tmpdir.join("commonfoo")
     fat.get_and_write_file("/FOO", str(foo))
     assert(foo.read() == "foo\n")
 
@@ -106,7 +105,7 @@ def check_onefile_system(fat, tmpdir, filesize):
     for i in range(3, int(512*9 / 1.5)):
         assert(fat.fat.fat[i] == 0x00)
 
-    foo = tmpdir.join("foo")
+    foo = tmpdir.join("commonfoo")
     fat.get_and_write_file("/FOO", str(foo))
     assert(foo.read() == "foo\n")
 
@@ -128,7 +127,7 @@ def check_onefile_archive(fat, tmpdir, filesize):
     for i in range(3, int(512*9 / 1.5)):
         assert(fat.fat.fat[i] == 0x00)
 
-    foo = tmpdir.join("foo")
+    foo = tmpdir.join("commonfoo")
     fat.get_and_write_file("/FOO", str(foo))
     assert(foo.read() == "foo\n")
 
@@ -150,7 +149,7 @@ def check_onefile_hidden(fat, tmpdir, filesize):
     for i in range(3, int(512*9 / 1.5)):
         assert(fat.fat.fat[i] == 0x00)
 
-    foo = tmpdir.join("foo")
+    foo = tmpdir.join("commonfoo")
     fat.get_and_write_file("/FOO", str(foo))
     assert(foo.read() == "foo\n")
 
@@ -172,7 +171,7 @@ def check_onefile_read_only(fat, tmpdir, filesize):
     for i in range(3, int(512*9 / 1.5)):
         assert(fat.fat.fat[i] == 0x00)
 
-    foo = tmpdir.join("foo")
+    foo = tmpdir.join("commonfoo")
     fat.get_and_write_file("/FOO", str(foo))
     assert(foo.read() == "foo\n")
 
@@ -194,7 +193,7 @@ def check_onefile_all_attr(fat, tmpdir, filesize):
     for i in range(3, int(512*9 / 1.5)):
         assert(fat.fat.fat[i] == 0x00)
 
-    foo = tmpdir.join("foo")
+    foo = tmpdir.join("commonfoo")
     fat.get_and_write_file("/FOO", str(foo))
     assert(foo.read() == "foo\n")
 
@@ -216,7 +215,7 @@ def check_onefile_no_attr(fat, tmpdir, filesize):
     for i in range(3, int(512*9 / 1.5)):
         assert(fat.fat.fat[i] == 0x00)
 
-    foo = tmpdir.join("foo")
+    foo = tmpdir.join("commonfoo")
     fat.get_and_write_file("/FOO", str(foo))
     assert(foo.read() == "foo\n")
 
@@ -402,6 +401,6 @@ def check_deep_subdir(fat, tmpdir, filesize):
     for i in range(5, int(512*9 / 1.5)):
         assert(fat.fat.fat[i] == 0x00)
 
-    foo = tmpdir.join("foo")
+    foo = tmpdir.join("commonfoo")
     fat.get_and_write_file("/DIR1/DIR2/FOO", str(foo))
     assert(foo.read() == "foo\n")
@@ -2,7 +2,6 @@ import pytest
 import subprocess
 import os
 import sys
-import StringIO
 import shutil
 
 prefix = '.'
@@ -34,7 +33,7 @@ def test_hybrid_rmfile(tmpdir):
     outfile = str(indir) + ".img"
     subprocess.call(["mkfs.msdos", "-C", str(outfile), "1440"])
     foofile = os.path.join(str(indir), "foo")
-    with open(foofile, "wb") as outfp:
+    with open(foofile, "w") as outfp:
         outfp.write("foo\n")
     subprocess.call(["mcopy", "-n", "-o", "-i", str(outfile), foofile, "::FOO"])
 
@@ -102,7 +101,7 @@ def test_hybrid_set_system_file(tmpdir):
     outfile = str(indir) + ".img"
     subprocess.call(["mkfs.msdos", "-C", str(outfile), "1440"])
     foofile = os.path.join(str(indir), "foo")
-    with open(foofile, "wb") as outfp:
+    with open(foofile, "w") as outfp:
         outfp.write("foo\n")
     subprocess.call(["mcopy", "-n", "-o", "-i", str(outfile), foofile, "::FOO"])
 
@@ -121,7 +120,7 @@ def test_hybrid_set_archive_file(tmpdir):
     outfile = str(indir) + ".img"
     subprocess.call(["mkfs.msdos", "-C", str(outfile), "1440"])
     foofile = os.path.join(str(indir), "foo")
-    with open(foofile, "wb") as outfp:
+    with open(foofile, "w") as outfp:
         outfp.write("foo\n")
     subprocess.call(["mcopy", "-n", "-o", "-i", str(outfile), foofile, "::FOO"])
 
@@ -140,7 +139,7 @@ def test_hybrid_set_hidden_file(tmpdir):
     outfile = str(indir) + ".img"
     subprocess.call(["mkfs.msdos", "-C", str(outfile), "1440"])
     foofile = os.path.join(str(indir), "foo")
-    with open(foofile, "wb") as outfp:
+    with open(foofile, "w") as outfp:
         outfp.write("foo\n")
     subprocess.call(["mcopy", "-n", "-o", "-i", str(outfile), foofile, "::FOO"])
 
@@ -159,7 +158,7 @@ def test_hybrid_set_read_only_file(tmpdir):
     outfile = str(indir) + ".img"
     subprocess.call(["mkfs.msdos", "-C", str(outfile), "1440"])
     foofile = os.path.join(str(indir), "foo")
-    with open(foofile, "wb") as outfp:
+    with open(foofile, "w") as outfp:
         outfp.write("foo\n")
     subprocess.call(["mcopy", "-n", "-o", "-i", str(outfile), foofile, "::FOO"])
 
@@ -178,7 +177,7 @@ def test_hybrid_set_all_attr_file(tmpdir):
     outfile = str(indir) + ".img"
     subprocess.call(["mkfs.msdos", "-C", str(outfile), "1440"])
     foofile = os.path.join(str(indir), "foo")
-    with open(foofile, "wb") as outfp:
+    with open(foofile, "w") as outfp:
         outfp.write("foo\n")
     subprocess.call(["mcopy", "-n", "-o", "-i", str(outfile), foofile, "::FOO"])
 
@@ -200,7 +199,7 @@ def test_hybrid_set_no_attr_file(tmpdir):
     outfile = str(indir) + ".img"
     subprocess.call(["mkfs.msdos", "-C", str(outfile), "1440"])
     foofile = os.path.join(str(indir), "foo")
-    with open(foofile, "wb") as outfp:
+    with open(foofile, "w") as outfp:
         outfp.write("foo\n")
     subprocess.call(["mcopy", "-n", "-o", "-i", str(outfile), foofile, "::FOO"])
 
@@ -224,7 +223,7 @@ def test_hybrid_manyfiles(tmpdir):
     for i in range(1, 9):
         num = "{:0>2}".format(str(i))
         numfile = os.path.join(str(indir), "file"+num)
-        with open(numfile, "wb") as outfp:
+        with open(numfile, "w") as outfp:
             outfp.write("file" + num + "\n")
         subprocess.call(["mcopy", "-n", "-o", "-i", str(outfile), numfile, "::FILE"+num])
 
@@ -235,9 +234,9 @@ def test_hybrid_manyfiles(tmpdir):
     for i in range(9, 18):
         num = "{:0>2}".format(str(i))
         numfile = os.path.join(str(indir), "file"+num)
-        with open(numfile, "wb") as outfp:
+        with open(numfile, "w") as outfp:
             outfp.write("file" + num + "\n")
-        print "adding " + str(i)
+        print("adding " + str(i))
         fat.add_file("/FILE" + num, numfile)
 
     do_a_test(fat, tmpdir, check_manyfiles)
@@ -252,7 +251,7 @@ def test_hybrid_manyfiles_subdir(tmpdir):
     for i in range(1, 9):
         num = "{:0>2}".format(str(i))
         numfile = os.path.join(str(indir), "file"+num)
-        with open(numfile, "wb") as outfp:
+        with open(numfile, "w") as outfp:
             outfp.write("file" + num + "\n")
         subprocess.call(["mcopy", "-n", "-o", "-i", str(outfile), numfile, "::DIR1/FILE"+num])
 
@@ -263,7 +262,7 @@ def test_hybrid_manyfiles_subdir(tmpdir):
     for i in range(9, 18):
         num = "{:0>2}".format(str(i))
         numfile = os.path.join(str(indir), "file"+num)
-        with open(numfile, "wb") as outfp:
+        with open(numfile, "w") as outfp:
             outfp.write("file" + num + "\n")
         fat.add_file("/DIR1/FILE" + num, numfile)
 
@@ -320,7 +319,7 @@ def test_hybrid_manyfiles2_subdir(tmpdir):
     for i in range(1, 9):
         num = "{:0>2}".format(str(i))
         numfile = os.path.join(str(indir), "file"+num)
-        with open(numfile, "wb") as outfp:
+        with open(numfile, "w") as outfp:
             outfp.write("file" + num + "\n")
         subprocess.call(["mcopy", "-n", "-o", "-i", str(outfile), numfile, "::DIR1/FILE"+num])
 
@@ -331,7 +330,7 @@ def test_hybrid_manyfiles2_subdir(tmpdir):
     for i in range(9, 32):
         num = "{:0>2}".format(str(i))
         numfile = os.path.join(str(indir), "file"+num)
-        with open(numfile, "wb") as outfp:
+        with open(numfile, "w") as outfp:
             outfp.write("file" + num + "\n")
         fat.add_file("/DIR1/FILE" + num, numfile)
 
@@ -344,7 +343,7 @@ def test_hybrid_rmfile_large(tmpdir):
     outfile = str(indir) + ".img"
     subprocess.call(["mkfs.msdos", "-C", str(outfile), "1440"])
     foofile = os.path.join(str(indir), "foo")
-    with open(foofile, "wb") as outfp:
+    with open(foofile, "w") as outfp:
         outfp.write("0"*513)
     subprocess.call(["mcopy", "-n", "-o", "-i", str(outfile), foofile, "::FOO"])
 
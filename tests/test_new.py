@@ -2,7 +2,9 @@ import pytest
 import subprocess
 import os
 import sys
-import StringIO
+import asyncio
+import struct
+import threading
 
 prefix = '.'
 for i in range(0,3):
@@ -179,7 +181,7 @@ def test_new_manyfiles(tmpdir):
     for i in range(1, 18):
         num = "{:0>2}".format(str(i))
         numfile = os.path.join(str(indir), "file"+num)
-        with open(numfile, "wb") as outfp:
+        with open(numfile, "w") as outfp:
             outfp.write("file" + num + "\n")
         fat.add_file("/FILE" + num, numfile)
 
@@ -199,7 +201,7 @@ def test_new_manyfiles_subdir(tmpdir):
     for i in range(1, 18):
         num = "{:0>2}".format(str(i))
         numfile = os.path.join(str(indir), "file"+num)
-        with open(numfile, "wb") as outfp:
+        with open(numfile, "w") as outfp:
             outfp.write("file" + num + "\n")
         fat.add_file("/DIR1/FILE" + num, numfile)
 
@@ -261,7 +263,7 @@ def test_new_manyfiles2_subdir(tmpdir):
     for i in range(1, 32):
         num = "{:0>2}".format(str(i))
         numfile = os.path.join(str(indir), "file"+num)
-        with open(numfile, "wb") as outfp:
+        with open(numfile, "w") as outfp:
             outfp.write("file" + num + "\n")
         fat.add_file("/DIR1/FILE" + num, numfile)
 
@@ -298,3 +300,1323 @@ def test_new_deep_subdir(tmpdir):
     do_a_test(fat, tmpdir, check_deep_subdir)
 
     fat.close()
+
+def test_new_oem_names(tmpdir):
+    for name in [b'CAF\x82    TXT', b'\x05BC     TXT']:
+        record = name + b'\x20' + b'\x00'*20
+        ent = pyfat.FATDirectoryEntry()
+        ent.parse(record, None, None)
+        assert(ent.record() == record)
+
+    indir = tmpdir.mkdir("oemnames")
+    indir.join("foo").write("foo\n")
+
+    fat = pyfat.PyFat()
+    fat.new()
+    fat.add_file("/CAF\u00c9.TXT", str(indir.join("foo")))
+    with pytest.raises(pyfat.PyFatException):
+        fat.add_file("/\u4e2d.TXT", str(indir.join("foo")))
+    testout = tmpdir.join("oemnames.img")
+    fat.write(str(testout))
+    fat.close()
+
+    fat2 = pyfat.PyFat()
+    fat2.open(str(testout))
+    assert([child.full_name() for child in fat2.list_dir('/')] == ["CAF\u00c9.TXT"])
+    fat2.close()
+
+def test_new_deterministic(tmpdir):
+    indir = tmpdir.mkdir("deterministic")
+    for name in ["foo", "bar", "baz"]:
+        indir.join(name).write(name*300)
+
+    outs = []
+    for order in [["foo", "bar", "baz"], ["baz", "foo", "bar"]]:
+        fat = pyfat.PyFat()
+        fat.new(deterministic=True)
+        fat.add_dir("/DIR1")
+        for name in order:
+            fat.add_file("/DIR1/" + name.upper() + ".TXT", str(indir.join(name)))
+            fat.add_file("/" + name.upper(), str(indir.join(name)))
+
+        testout = tmpdir.join("deterministic%d.img" % (len(outs)))
+        fat.write(str(testout))
+        fat.close()
+        outs.append(testout.read_binary())
+
+    assert(outs[0] == outs[1])
+
+    fat2 = pyfat.PyFat()
+    fat2.open(str(tmpdir.join("deterministic0.img")))
+    internal_check_directory_entry(fat2.root.children[0], "BAR     ", "   ", 2, 900, 0x20)
+    assert(fat2.root.children[0].creation_date == 0x21)
+    assert(fat2.root.children[0].last_write_time == 0)
+    dir1 = fat2.root.children[2]
+    internal_check_directory_entry(dir1, "DIR1    ", "   ", 8, 0, 0x10)
+    internal_check_directory_entry(dir1.children[2], "BAR     ", "TXT", 9, 900, 0x20)
+    out = tmpdir.join("out")
+    fat2.get_and_write_file("/DIR1/FOO.TXT", str(out))
+    assert(out.read() == "foo"*300)
+    fat2.close()
+
+def test_new_deterministic_add_one(tmpdir):
+    indir = tmpdir.mkdir("deterministicaddone")
+    for i in range(1, 10):
+        indir.join("file%d" % (i)).write(str(i)*1000)
+
+    outs = []
+    for count in [8, 9]:
+        fat = pyfat.PyFat()
+        fat.new(deterministic=True)
+        for i in range(1, count+1):
+            fat.add_file("/FILE%d" % (i), str(indir.join("file%d" % (i))))
+
+        testout = tmpdir.join("addone%d.img" % (count))
+        fat.write(str(testout))
+        fat.close()
+        outs.append(testout.read_binary())
+
+    # The new file sorts last, so only the FATs, the root directory, and the
+    # new file's data should differ.
+    changed = 0
+    for offset in range(0, len(outs[0]), 512):
+        if outs[0][offset:offset+512] != outs[1][offset:offset+512]:
+            changed += 1
+    assert(changed <= 6)
+
+def test_new_deterministic_insert_first(tmpdir):
+    indir = tmpdir.mkdir("deterministicinsertfirst")
+    for i in range(0, 9):
+        indir.join("file%d" % (i)).write(str(i)*1000)
+
+    fat = pyfat.PyFat()
+    fat.new(deterministic=True)
+    for i in range(1, 9):
+        fat.add_file("/FILE%d" % (i), str(indir.join("file%d" % (i))))
+    first = tmpdir.join("first.img")
+    fat.write(str(first))
+    fat.close()
+
+    fat = pyfat.PyFat()
+    fat.open(str(first), deterministic=True)
+    clusters = [child.first_logical_cluster for child in fat.list_dir('/')]
+    fat.add_file("/FILE0", str(indir.join("file0")))
+    second = tmpdir.join("second.img")
+    fat.write(str(second))
+    fat.close()
+
+    # The new file sorts first, but the files that were already there keep
+    # their clusters; only the FATs, the root directory, and the new file's
+    # data should differ.
+    before = first.read_binary()
+    after = second.read_binary()
+    changed = 0
+    for offset in range(0, len(before), 512):
+        if before[offset:offset+512] != after[offset:offset+512]:
+            changed += 1
+    assert(changed <= 6)
+
+    fat2 = pyfat.PyFat()
+    fat2.open(str(second))
+    children = list(fat2.list_dir('/'))
+    assert(children[0].full_name() == "FILE0")
+    assert([child.first_logical_cluster for child in children[1:]] == clusters)
+    out = tmpdir.join("out")
+    fat2.get_and_write_file("/FILE0", str(out))
+    assert(out.read() == "0"*1000)
+    fat2.close()
+
+def test_new_diff(tmpdir):
+    indir = tmpdir.mkdir("diff")
+    for name in ["foo", "bar", "baz"]:
+        indir.join(name).write(name*600)
+
+    fat = pyfat.PyFat()
+    fat.new(deterministic=True)
+    fat.add_dir("/DIR1")
+    fat.add_file("/DIR1/FOO", str(indir.join("foo")))
+    fat.add_file("/BAR", str(indir.join("bar")))
+    fat.add_file("/BAZ", str(indir.join("baz")))
+    first = tmpdir.join("first.img")
+    fat.write(str(first))
+    fat.close()
+
+    fat = pyfat.PyFat()
+    fat.new(deterministic=True)
+    fat.add_dir("/DIR1")
+    fat.add_file("/DIR1/FOO", str(indir.join("foo")))
+    fat.add_file("/DIR1/BAR", str(indir.join("bar")))
+    fat.add_file("/BAZ", str(indir.join("bar")))
+    fat.set_hidden("/BAZ")
+    second = tmpdir.join("second.img")
+    fat.write(str(second))
+    fat.close()
+
+    fatdiff = pyfat.diff(str(first), str(second))
+    assert(fatdiff.added_files == ["/DIR1/BAR"])
+    assert(fatdiff.removed_files == ["/BAR"])
+    assert(fatdiff.changed_files == ["/BAZ"])
+    assert(fatdiff.moved_files == ["/BAZ"])
+    assert(1 in fatdiff.changed_metadata_sectors)
+
+    patch = fatdiff.record()
+    assert(len(patch) < 16*512)
+
+    pyfat.apply_patch(str(first), patch)
+    assert(first.read_binary() == second.read_binary())
+
+def test_new_diff_same_size(tmpdir):
+    indir = tmpdir.mkdir("diffsamesize")
+    indir.join("foo").write("foo"*600)
+    indir.join("fox").write("foo"*599 + "fox")
+
+    outs = []
+    for name in ["foo", "fox"]:
+        fat = pyfat.PyFat()
+        fat.new(deterministic=True)
+        fat.add_file("/FOO", str(indir.join(name)))
+        testout = tmpdir.join("%s.img" % (name))
+        fat.write(str(testout))
+        fat.close()
+        outs.append(testout)
+
+    # Only one byte of the data differs; the directory entries and the FATs
+    # are the same in both images.
+    fatdiff = pyfat.diff(str(outs[0]), str(outs[1]))
+    assert(fatdiff.changed_files == ["/FOO"])
+    assert(fatdiff.moved_files == [])
+    assert(fatdiff.changed_metadata_sectors == [])
+
+    pyfat.apply_patch(str(outs[0]), fatdiff.record())
+    assert(outs[0].read_binary() == outs[1].read_binary())
+
+def test_new_diff_identical(tmpdir):
+    fat = pyfat.PyFat()
+    fat.new(deterministic=True)
+    fat.add_dir("/DIR1")
+    testout = tmpdir.join("identical.img")
+    fat.write(str(testout))
+    fat.close()
+
+    fatdiff = pyfat.diff(str(testout), str(testout))
+    assert(fatdiff.added_files == [])
+    assert(fatdiff.removed_files == [])
+    assert(fatdiff.changed_files == [])
+    assert(fatdiff.moved_files == [])
+    assert(fatdiff.changed_metadata_sectors == [])
+    assert(fatdiff.ranges == [])
+
+def test_new_sync_from(tmpdir):
+    indir = tmpdir.mkdir("syncfrom")
+    indir.join("foo").write("foo\n")
+    indir.join("bar.txt").write("bar"*200)
+    indir.mkdir("dir1").join("baz").write("baz\n")
+
+    fat = pyfat.PyFat()
+    fat.new()
+    fat.sync_from(str(indir))
+
+    names = [child.full_name() for child in fat.list_dir('/')]
+    assert(names == ["BAR.TXT", "DIR1", "FOO"])
+    names = [child.full_name() for child in fat.list_dir('/DIR1')]
+    assert(names == [".", "..", "BAZ"])
+
+    # A second sync with nothing changed should leave everything alone.
+    entries = [child for path, child in fat._walk()]
+    fat.sync_from(str(indir))
+    assert(entries == [child for path, child in fat._walk()])
+
+    indir.join("foo").write("changed\n")
+    indir.join("bar.txt").remove()
+    indir.join("dir1").join("new").write("new\n")
+    fat.sync_from(str(indir))
+
+    testout = tmpdir.join("syncfrom.img")
+    fat.write(str(testout))
+    fat.close()
+
+    fat2 = pyfat.PyFat()
+    fat2.open(str(testout))
+    names = [child.full_name() for child in fat2.list_dir('/')]
+    assert(names == ["DIR1", "FOO"])
+    out = tmpdir.join("out")
+    fat2.get_and_write_file("/FOO", str(out))
+    assert(out.read() == "changed\n")
+    fat2.get_and_write_file("/DIR1/NEW", str(out))
+    assert(out.read() == "new\n")
+    fat2.close()
+
+def test_new_sync_from_bad_name(tmpdir):
+    indir = tmpdir.mkdir("syncfrombadname")
+    indir.join("foo").write("foo\n")
+    indir.mkdir("dir1").join("toolongname.txt").write("foo\n")
+
+    fat = pyfat.PyFat()
+    fat.new()
+    free = fat.free_space()
+
+    # The bad name is deep in the tree, but nothing is synced at all.
+    with pytest.raises(pyfat.PyFatException):
+        fat.sync_from(str(indir))
+    assert(list(fat.list_dir('/')) == [])
+    assert(fat.free_space() == free)
+
+def test_new_sync_from_name_clash(tmpdir):
+    indir = tmpdir.mkdir("syncfromnameclash")
+    indir.join("a.txt").write("foo\n")
+    indir.join("A.TXT").write("bar\n")
+
+    fat = pyfat.PyFat()
+    fat.new()
+
+    with pytest.raises(pyfat.PyFatException):
+        fat.sync_from(str(indir))
+    assert(list(fat.list_dir('/')) == [])
+
+def test_new_sync_from_full_root(tmpdir):
+    indir = tmpdir.mkdir("syncfromfullroot")
+    for i in range(0, 225):
+        indir.join("f%d" % (i)).write("")
+
+    fat = pyfat.PyFat()
+    fat.new()
+
+    with pytest.raises(pyfat.PyFatException):
+        fat.sync_from(str(indir))
+    assert(list(fat.list_dir('/')) == [])
+
+def test_new_extract_tree(tmpdir):
+    indir = tmpdir.mkdir("extracttree")
+    indir.join("foo").write("foo\n")
+    indir.mkdir("dir1").mkdir("dir2").join("bar.txt").write("bar"*400)
+
+    fat = pyfat.PyFat()
+    fat.new()
+    fat.sync_from(str(indir))
+
+    outdir = tmpdir.join("extracted")
+    fat.extract_tree("/", str(outdir))
+    assert(outdir.join("FOO").read() == "foo\n")
+    assert(outdir.join("DIR1").join("DIR2").join("BAR.TXT").read() == "bar"*400)
+
+    # A host copy with the same size and time is left alone in incremental
+    # mode, but is overwritten otherwise.
+    stale = outdir.join("FOO")
+    mtime = os.stat(str(stale)).st_mtime
+    stale.write("bad\n")
+    os.utime(str(stale), (mtime, mtime))
+    fat.extract_tree("/", str(outdir))
+    assert(stale.read() == "bad\n")
+    fat.extract_tree("/", str(outdir), incremental=False)
+    assert(stale.read() == "foo\n")
+
+    subdir = tmpdir.join("subdir")
+    fat.extract_tree("/DIR1", str(subdir))
+    assert(subdir.join("DIR2").join("BAR.TXT").read() == "bar"*400)
+
+    fat.close()
+
+def test_new_extract_all(tmpdir):
+    indir = tmpdir.mkdir("extractall")
+    for i in range(1, 20):
+        indir.join("file%d" % (i)).write(str(i)*(i*100))
+    indir.mkdir("dir1").join("foo").write("foo\n")
+
+    fat = pyfat.PyFat()
+    fat.new()
+    fat.sync_from(str(indir))
+    testout = tmpdir.join("extractall.img")
+    fat.write(str(testout))
+    fat.close()
+
+    fat2 = pyfat.PyFat()
+    fat2.open(str(testout))
+    outdir = tmpdir.join("extracted")
+    fat2.extract_all(str(outdir), workers=4)
+    for i in range(1, 20):
+        assert(outdir.join("FILE%d" % (i)).read() == str(i)*(i*100))
+    assert(outdir.join("DIR1").join("FOO").read() == "foo\n")
+    fat2.close()
+
+def test_new_write_parallel(tmpdir):
+    indir = tmpdir.mkdir("writeparallel")
+    for i in range(1, 20):
+        indir.join("file%d" % (i)).write(str(i)*(i*100))
+    indir.mkdir("dir1").join("foo").write("foo\n")
+
+    fat = pyfat.PyFat()
+    fat.new()
+    fat.sync_from(str(indir))
+    fat.rm_file("/FILE3")
+    indir.join("big").write("big"*1000)
+    fat.add_file("/BIG", str(indir.join("big")))
+
+    serial = tmpdir.join("serial.img")
+    fat.write(str(serial))
+    parallel = tmpdir.join("parallel.img")
+    fat.write(str(parallel), workers=4)
+    fat.close()
+
+    assert(serial.read_binary() == parallel.read_binary())
+
+    # Round-trip the data from the original image as well.
+    fat2 = pyfat.PyFat()
+    fat2.open(str(parallel))
+    rewritten = tmpdir.join("rewritten.img")
+    fat2.write(str(rewritten), workers=4)
+    fat2.close()
+
+    assert(rewritten.read_binary() == parallel.read_binary())
+
+def test_new_build_many(tmpdir):
+    indir = tmpdir.mkdir("buildmany")
+    indir.join("foo").write("foo\n")
+
+    manifests = []
+    for i in range(0, 3):
+        manifests.append({
+            'output': str(tmpdir.join("build%d.img" % (i))),
+            'new': {'deterministic': True},
+            'dirs': ['/DIR1'],
+            'files': [('/DIR1/FOO', str(indir.join("foo")))],
+            'attributes': {'/DIR1/FOO': ['hidden', 'system']},
+        })
+
+    results = pyfat.build_many(manifests, processes=2)
+    assert([output for output, elapsed in results] == [manifest['output'] for manifest in manifests])
+
+    fat = pyfat.PyFat()
+    fat.open(manifests[2]['output'])
+    internal_check_directory_entry(fat.root.children[0].children[2], "FOO     ", "   ", 3, 4, 0x26)
+    fat.close()
+
+    assert(tmpdir.join("build0.img").read_binary() == tmpdir.join("build1.img").read_binary())
+
+def test_new_build_many_bad_attribute(tmpdir):
+    manifests = [{'output': str(tmpdir.join("bad.img")), 'dirs': ['/DIR1'],
+                  'attributes': {'/DIR1': ['purple']}}]
+
+    with pytest.raises(pyfat.PyFatException):
+        pyfat.build_many(manifests, processes=1)
+
+def test_new_async(tmpdir):
+    indir = tmpdir.mkdir("async")
+    for i in range(1, 10):
+        indir.join("file%d" % (i)).write(str(i)*(i*100))
+
+    fat = pyfat.PyFat()
+    fat.new()
+    fat.sync_from(str(indir))
+    testout = tmpdir.join("async.img")
+    fat.write(str(testout))
+    fat.close()
+
+    async def run():
+        asyncfat = pyfat.AsyncPyFat()
+        await asyncfat.open(str(testout))
+        names = [child.full_name() for child in await asyncfat.list_dir('/')]
+        datas = await asyncio.gather(*[asyncfat.read_file('/' + name) for name in names])
+        with pytest.raises(pyfat.PyFatException):
+            await asyncfat.read_file('/NOTHERE')
+        await asyncfat.extract('/FILE9', str(tmpdir.join("file9")))
+        await asyncfat.close()
+        return names, datas
+
+    names, datas = asyncio.run(run())
+    assert(len(names) == 9)
+    for name, data in zip(names, datas):
+        i = int(name[4:])
+        assert(data == (str(i)*(i*100)).encode('ascii'))
+    assert(tmpdir.join("file9").read() == "9"*900)
+
+def test_new_async_errors(tmpdir):
+    indir = tmpdir.mkdir("asyncerrors")
+    indir.join("foo").write("foo\n")
+    indir.join("bar").write("bar\n")
+
+    fat = pyfat.PyFat()
+    fat.new()
+    fat.sync_from(str(indir))
+    testout = tmpdir.join("asyncerrors.img")
+    fat.write(str(testout))
+    fat.close()
+
+    async def run():
+        asyncfat = pyfat.AsyncPyFat()
+        await asyncfat.open(str(testout))
+
+        # An unexpected error in one read only fails that read.
+        read_data = asyncfat.fat._read_data
+        def bad_read(child):
+            if child.full_name() == "FOO":
+                raise ValueError("bad read")
+            return read_data(child)
+        asyncfat.fat._read_data = bad_read
+        results = await asyncio.gather(asyncfat.read_file('/FOO'), asyncfat.read_file('/BAR'),
+                                       return_exceptions=True)
+        assert(isinstance(results[0], ValueError))
+        assert(results[1] == b"bar\n")
+
+        # An error in the batch as a whole fails every read in it.
+        def bad_batch(requests):
+            raise RuntimeError("bad batch")
+        asyncfat._do_batch = bad_batch
+        results = await asyncio.gather(asyncfat.read_file('/FOO'), asyncfat.read_file('/BAR'),
+                                       return_exceptions=True)
+        assert([type(result) for result in results] == [RuntimeError, RuntimeError])
+
+        await asyncfat.close()
+
+    asyncio.run(run())
+
+def test_new_concurrent_readers(tmpdir):
+    indir = tmpdir.mkdir("concurrent")
+    for i in range(1, 10):
+        indir.join("file%d" % (i)).write(str(i)*(i*300))
+
+    fat = pyfat.PyFat()
+    fat.new()
+    fat.sync_from(str(indir))
+    testout = tmpdir.join("concurrent.img")
+    fat.write(str(testout))
+    fat.close()
+
+    fat2 = pyfat.PyFat()
+    fat2.open(str(testout))
+
+    errors = []
+    def reader(num):
+        try:
+            for rep in range(0, 5):
+                for i in range(1, 10):
+                    out = tmpdir.join("out%d_%d" % (num, i))
+                    fat2.get_and_write_file("/FILE%d" % (i), str(out))
+                    assert(out.read() == str(i)*(i*300))
+                    names = [child.full_name() for child in fat2.list_dir('/')]
+                    assert("FILE%d" % (i) in names)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=reader, args=(num,)) for num in range(0, 8)]
+    for thread in threads:
+        thread.start()
+    indir.join("extra").write("extra\n")
+    for i in range(0, 10):
+        fat2.add_file("/EXTRA%d" % (i), str(indir.join("extra")))
+        fat2.rm_file("/EXTRA%d" % (i))
+    for thread in threads:
+        thread.join()
+
+    assert(errors == [])
+    fat2.close()
+
+def test_new_share_metadata(tmpdir):
+    indir = tmpdir.mkdir("shared")
+    indir.join("file1").write("file1\n")
+    indir.mkdir("dir1").join("file2").write("2"*3000)
+
+    fat = pyfat.PyFat()
+    fat.new()
+    fat.sync_from(str(indir))
+    testout = tmpdir.join("shared.img")
+    fat.write(str(testout))
+    fat.close()
+
+    owner = pyfat.PyFat()
+    owner.open(str(testout))
+    name = owner.share_metadata()
+
+    fat2 = pyfat.PyFat()
+    fat2.attach(str(testout), name)
+    assert([child.full_name() for child in fat2.list_dir('/DIR1')] == ['.', '..', 'FILE2'])
+    out = tmpdir.join("file2")
+    fat2.get_and_write_file("/DIR1/FILE2", str(out))
+    assert(out.read() == "2"*3000)
+
+    with pytest.raises(pyfat.PyFatException):
+        fat2.add_dir("/DIR2")
+
+    fat2.close()
+
+    # A worker that isn't related to the owner must leave the segment alone
+    # when it exits.
+    subprocess.check_call([sys.executable, '-c',
+                           'import pyfat; fat = pyfat.PyFat(); fat.attach(%r, %r); fat.list_dir("/DIR1"); fat.close()' % (str(testout), name)],
+                          cwd=os.path.dirname(os.path.abspath(pyfat.__file__)))
+
+    fat2 = pyfat.PyFat()
+    fat2.attach(str(testout), name)
+    assert([child.full_name() for child in fat2.list_dir('/')] == ['DIR1', 'FILE1'])
+    fat2.close()
+
+    owner.close()
+
+    fat2 = pyfat.PyFat()
+    with pytest.raises(Exception):
+        fat2.attach(str(testout), name)
+
+def test_new_share_metadata_clean_exit(tmpdir):
+    fat = pyfat.PyFat()
+    fat.new()
+    testout = tmpdir.join("sharedexit.img")
+    fat.write(str(testout))
+    fat.close()
+
+    # Sharing, attaching and closing must leave the resource tracker with
+    # nothing to complain about.
+    script = """
+import pyfat
+owner = pyfat.PyFat()
+owner.open(%r)
+name = owner.share_metadata()
+fat = pyfat.PyFat()
+fat.attach(%r, name)
+fat.close()
+owner.close()
+""" % (str(testout), str(testout))
+    proc = subprocess.Popen([sys.executable, '-c', script],
+                            cwd=os.path.dirname(os.path.abspath(pyfat.__file__)),
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    assert(proc.returncode == 0)
+    assert(err == b'')
+
+def test_new_open_cache(tmpdir):
+    indir = tmpdir.mkdir("cache")
+    indir.join("file1").write("file1\n")
+    indir.mkdir("dir1").join("file2").write("2"*3000)
+
+    fat = pyfat.PyFat()
+    fat.new()
+    fat.sync_from(str(indir))
+    testout = tmpdir.join("cache.img")
+    fat.write(str(testout))
+    fat.close()
+
+    cachedir = tmpdir.join("cachedir")
+    for i in range(0, 2):
+        fat2 = pyfat.PyFat()
+        fat2.open(str(testout), cache_dir=str(cachedir))
+        assert(len(cachedir.listdir()) == 1)
+        assert([child.full_name() for child in fat2.list_dir('/DIR1')] == ['.', '..', 'FILE2'])
+        out = tmpdir.join("file2")
+        fat2.get_and_write_file("/DIR1/FILE2", str(out))
+        assert(out.read() == "2"*3000)
+        fat2.add_file("/FILE3", str(indir.join("file1")))
+        fat2.close()
+
+def test_new_fat16_large(tmpdir):
+    indir = tmpdir.mkdir("fat16")
+    indir.join("file1").write("1"*5000)
+    indir.mkdir("dir1").join("file2").write("2"*3000)
+
+    fat = pyfat.PyFat()
+    fat.new(size_in_kb=65536, sectors_per_cluster=4)
+    assert(fat.total_sector_count_32 == 131072)
+    fat.sync_from(str(indir))
+    testout = tmpdir.join("fat16.img")
+    fat.write(str(testout))
+    fat.close()
+
+    fat2 = pyfat.PyFat()
+    fat2.open(str(testout))
+    assert(isinstance(fat2.fat, pyfat.FAT16))
+    assert(fat2.sector_count == 0)
+    out = tmpdir.join("file1")
+    fat2.get_and_write_file("/FILE1", str(out))
+    assert(out.read() == "1"*5000)
+    out = tmpdir.join("file2")
+    fat2.get_and_write_file("/DIR1/FILE2", str(out))
+    assert(out.read() == "2"*3000)
+    fat2.close()
+
+def make_fat32_image(path):
+    # A 64MB FAT32 volume laid out the way mkfs.fat would; 32 reserved
+    # sectors, two FATs of 1010 sectors, one sector per cluster, and the root
+    # directory in cluster 2.
+    total_sectors = 131072
+    fat_size = 1010
+    clusters = total_sectors - 32 - 2 * fat_size
+    boot = struct.pack("=3s8sHBHBHHBHHHLL", b'\xeb\x58\x90', b'mkfs.fat',
+                       512, 1, 32, 2, 0, 0, 0xf8, 0, 32, 64, 0, total_sectors)
+    boot += struct.pack("=LHHLHH12sBBBL11s8s420sH", fat_size, 0, 0, 2, 1, 6,
+                        b'', 0x80, 0, 0x29, 0x1234, b'NO NAME    ',
+                        b'FAT32   ', b'', 0xaa55)
+    fsinfo = struct.pack("=L480sLLL12sL", 0x41615252, b'', 0x61417272,
+                         clusters - 1, 2, b'', 0xaa550000)
+    fat = struct.pack("=LLL", 0x0ffffff8, 0x0fffffff, 0x0fffffff)
+    with open(path, 'wb') as outfp:
+        outfp.truncate(total_sectors * 512)
+        for sector, data in [(0, boot), (1, fsinfo), (6, boot), (7, fsinfo),
+                             (32, fat), (32 + fat_size, fat)]:
+            outfp.seek(sector * 512)
+            outfp.write(data)
+
+    return clusters
+
+def test_new_fat32(tmpdir):
+    indir = tmpdir.mkdir("fat32")
+    indir.join("file1").write("1"*5000)
+
+    testin = tmpdir.join("fat32.img")
+    clusters = make_fat32_image(str(testin))
+
+    fat = pyfat.PyFat()
+    fat.open(str(testin))
+    assert(isinstance(fat.fat, pyfat.FAT32))
+    assert(fat.free_space() == (clusters - 1) * 512)
+    fat.add_dir("/DIR1")
+    for i in range(0, 20):
+        fat.add_file("/FILE%d" % (i), str(indir.join("file1")))
+    # 20 files and a directory need two clusters of root directory.
+    assert(len(fat.fat.get_cluster_list(fat.root_cluster)) == 2)
+    free = fat.free_space()
+    assert(free == (clusters - 1 - 1 - 1 - 20*10) * 512)
+    testout = tmpdir.join("fat32out.img")
+    fat.write(str(testout))
+    fat.close()
+
+    fat2 = pyfat.PyFat()
+    fat2.open(str(testout))
+    assert(fat2.fat.free_count is not None)
+    assert(fat2.free_space() == free)
+    assert(len(list(fat2.list_dir('/'))) == 21)
+    out = tmpdir.join("file19")
+    fat2.get_and_write_file("/FILE19", str(out))
+    assert(out.read() == "1"*5000)
+    fat2.close()
+
+def test_new_fat32_high_cluster(tmpdir):
+    indir = tmpdir.mkdir("high")
+    indir.join("file1").write("1"*5000)
+    # A sparse host file that is big enough to push the next allocation
+    # above cluster 65535.
+    with open(str(indir.join("big")), 'wb') as outfp:
+        outfp.truncate(70000 * 512)
+
+    testin = tmpdir.join("high.img")
+    make_fat32_image(str(testin))
+
+    fat = pyfat.PyFat()
+    fat.open(str(testin))
+    fat.add_file("/BIG", str(indir.join("big")))
+    fat.add_file("/FILE1", str(indir.join("file1")))
+    assert(fat._find_record("/FILE1")[0].first_logical_cluster > 0xffff)
+    testout = tmpdir.join("highout.img")
+    fat.write(str(testout))
+    fat.close()
+
+    fat2 = pyfat.PyFat()
+    fat2.open(str(testout))
+    assert(fat2._find_record("/FILE1")[0].first_logical_cluster > 0xffff)
+    out = tmpdir.join("file1")
+    fat2.get_and_write_file("/FILE1", str(out))
+    assert(out.read() == "1"*5000)
+    fat2.close()
+
+def test_new_geometry(tmpdir):
+    for size_in_kb, fat_type, sectors_per_cluster, fat_size in [(1440, pyfat.PyFat.FAT12, 1, 9),
+                                                                (32768, pyfat.PyFat.FAT16, 4, 64),
+                                                                (1048576, pyfat.PyFat.FAT32, 8, 2048)]:
+        fat = pyfat.PyFat()
+        fat.new(size_in_kb=size_in_kb)
+        assert(fat.fat_type == fat_type)
+        assert(fat.sectors_per_cluster == sectors_per_cluster)
+        assert(fat.fat_size == fat_size)
+        fat.close()
+
+    with pytest.raises(pyfat.PyFatException):
+        pyfat.PyFat().new(size_in_kb=8192, fat_type=pyfat.PyFat.FAT32)
+
+    with pytest.raises(pyfat.PyFatException, match="Drive number"):
+        pyfat.PyFat().new(drive_num=0x81)
+
+def test_new_fat32_sparse(tmpdir):
+    indir = tmpdir.mkdir("sparse")
+    indir.join("file1").write("1"*5000)
+
+    fat = pyfat.PyFat()
+    fat.new(size_in_kb=32*1024*1024)
+    assert(fat.fat_type == pyfat.PyFat.FAT32)
+    fat.add_file("/FILE1", str(indir.join("file1")))
+    testout = tmpdir.join("sparse.img")
+    fat.write(str(testout))
+    fat.close()
+
+    st = os.stat(str(testout))
+    assert(st.st_size == 32*1024*1024*1024)
+    assert(st.st_blocks * 512 < 1024*1024)
+
+    fat2 = pyfat.PyFat()
+    fat2.open(str(testout))
+    out = tmpdir.join("file1")
+    fat2.get_and_write_file("/FILE1", str(out))
+    assert(out.read() == "1"*5000)
+    fat2.close()
+
+def test_new_large_clusters(tmpdir):
+    indir = tmpdir.mkdir("clusters")
+    indir.join("file1").write("1"*70000)
+    for i in range(0, 70):
+        indir.join("f%d" % (i)).write(str(i))
+
+    for bytes_per_sector, sectors_per_cluster in [(512, 64), (4096, 8)]:
+        fat = pyfat.PyFat()
+        fat.new(size_in_kb=262144, bytes_per_sector=bytes_per_sector,
+                sectors_per_cluster=sectors_per_cluster)
+        assert(fat.bytes_per_cluster == 32768)
+        free = fat.free_space()
+        fat.add_dir("/DIR1")
+        for i in range(0, 70):
+            fat.add_file("/DIR1/F%d" % (i), str(indir.join("f%d" % (i))))
+        fat.add_file("/FILE1", str(indir.join("file1")))
+        # 72 entries of 32 bytes fit in one cluster, 70 one-byte files take
+        # one cluster each, and 70000 bytes take three.
+        assert(len(fat.fat.get_cluster_list(fat._find_record("/DIR1")[0].first_logical_cluster)) == 1)
+        assert(fat.free_space() == free - (1 + 70 + 3) * 32768)
+        testout = tmpdir.join("clusters.img")
+        fat.write(str(testout))
+        fat.close()
+
+        fat2 = pyfat.PyFat()
+        fat2.open(str(testout))
+        assert(len(list(fat2.list_dir("/DIR1"))) == 72)
+        out = tmpdir.join("file1")
+        fat2.get_and_write_file("/FILE1", str(out))
+        assert(out.read() == "1"*70000)
+        fat2.get_and_write_file("/DIR1/F69", str(out))
+        assert(out.read() == "69")
+        fat2.close()
+
+def test_new_dir_growth(tmpdir):
+    indir = tmpdir.mkdir("growth")
+    indir.join("empty").write("")
+
+    fat = pyfat.PyFat()
+    fat.new(size_in_kb=65536, sectors_per_cluster=4)
+    fat.dir_growth_clusters = 8
+    free = fat.free_space()
+    fat.add_dir("/DIR1")
+    for i in range(0, 3000):
+        fat.add_file("/DIR1/F%d" % (i), str(indir.join("empty")))
+    # 3002 entries of 32 bytes need 47 clusters of 2048 bytes; the directory
+    # started with one and grew eight at a time.
+    dir1 = fat._find_record("/DIR1")[0]
+    assert(len(fat.fat.get_cluster_list(dir1.first_logical_cluster)) == 49)
+    assert(fat.free_space() == free - 49 * 2048)
+    testout = tmpdir.join("growth.img")
+    fat.write(str(testout))
+    fat.close()
+
+    fat2 = pyfat.PyFat()
+    fat2.open(str(testout))
+    assert(len(list(fat2.list_dir("/DIR1"))) == 3002)
+    fat2.add_file("/DIR1/LAST", str(indir.join("empty")))
+    fat2.close()
+
+def test_new_batch(tmpdir):
+    indir = tmpdir.mkdir("batch")
+    for i in range(0, 40):
+        indir.join("f%d" % (i)).write("%02d" % (i) * 300)
+
+    fat = pyfat.PyFat()
+    fat.new()
+    fat.add_file("/OLD", str(indir.join("f0")))
+    free = fat.free_space()
+    with fat.batch():
+        fat.rm_file("/OLD")
+        fat.add_dir("/DIR1")
+        for i in range(0, 40):
+            fat.add_file("/DIR1/F%d" % (i), str(indir.join("f%d" % (i))))
+        fat.add_file("/GONE", str(indir.join("f1")))
+        fat.rm_file("/GONE")
+        # Nothing is allocated or freed until the batch ends.
+        assert(fat.free_space() == free)
+    # The directory is sized once for all 42 entries (3 clusters), and the
+    # files follow it one after the other, 2 clusters each.
+    dir1 = fat._find_record("/DIR1")[0]
+    assert(fat.fat.get_cluster_list(dir1.first_logical_cluster) == [2, 3, 4])
+    clusters = []
+    for i in range(0, 40):
+        clusters += fat.fat.get_cluster_list(fat._find_record("/DIR1/F%d" % (i))[0].first_logical_cluster)
+    assert(clusters == list(range(5, 85)))
+    assert(fat.free_space() == free + 2 * 512 - 83 * 512)
+    testout = tmpdir.join("batch.img")
+    fat.write(str(testout))
+    fat.close()
+
+    fat2 = pyfat.PyFat()
+    fat2.open(str(testout))
+    assert(len(list(fat2.list_dir("/DIR1"))) == 42)
+    out = tmpdir.join("out")
+    fat2.get_and_write_file("/DIR1/F39", str(out))
+    assert(out.read() == "39" * 300)
+    with pytest.raises(pyfat.PyFatException):
+        fat2._find_record("/OLD")
+    fat2.close()
+
+def test_new_batch_rollback(tmpdir):
+    indir = tmpdir.mkdir("batchrollback")
+    indir.join("old").write("old"*300)
+    for i in range(0, 40):
+        indir.join("f%d" % (i)).write("%02d" % (i) * 300)
+    with open(str(indir.join("huge")), 'wb') as outfp:
+        outfp.truncate(2 * 1024 * 1024)
+
+    fat = pyfat.PyFat()
+    fat.new()
+    fat.add_file("/OLD", str(indir.join("old")))
+    fat.add_dir("/DIR1")
+    dir1 = fat._find_record("/DIR1")[0]
+    dir1_clusters = fat.fat.get_cluster_list(dir1.first_logical_cluster)
+    free = fat.free_space()
+
+    # An exception in the body throws the whole batch away.
+    with pytest.raises(ValueError):
+        with fat.batch():
+            fat.rm_file("/OLD")
+            fat.add_file("/DIR1/F0", str(indir.join("f0")))
+            fat.rename("/DIR1", "/DIR2")
+            fat.set_hidden("/DIR2")
+            raise ValueError("stop")
+    assert([child.full_name() for child in fat.list_dir('/')] == ["OLD", "DIR1"])
+    assert(len(dir1.children) == 2)
+    assert(not dir1.attributes & 0x2)
+    assert(fat.free_space() == free)
+
+    # Running out of space at the end undoes the frees and the directory
+    # growth that were already done.
+    with pytest.raises(pyfat.PyFatException):
+        with fat.batch():
+            fat.rm_file("/OLD")
+            for i in range(0, 40):
+                fat.add_file("/DIR1/F%d" % (i), str(indir.join("f%d" % (i))))
+            fat.add_file("/HUGE", str(indir.join("huge")))
+    assert([child.full_name() for child in fat.list_dir('/')] == ["OLD", "DIR1"])
+    assert(fat.fat.get_cluster_list(dir1.first_logical_cluster) == dir1_clusters)
+    assert(fat.free_space() == free)
+
+    testout = tmpdir.join("batchrollback.img")
+    fat.write(str(testout))
+    fat.close()
+
+    fat2 = pyfat.PyFat()
+    fat2.open(str(testout))
+    out = tmpdir.join("out")
+    fat2.get_and_write_file("/OLD", str(out))
+    assert(out.read() == "old"*300)
+    fat2.close()
+
+def test_new_batch_threads(tmpdir):
+    indir = tmpdir.mkdir("batchthreads")
+    indir.join("foo").write("foo"*300)
+
+    fat = pyfat.PyFat()
+    fat.new()
+    thread = threading.Thread(target=fat.add_file, args=("/OTHER", str(indir.join("foo"))))
+    with fat.batch():
+        fat.add_file("/FOO", str(indir.join("foo")))
+        thread.start()
+        # The other thread's add waits for the batch rather than joining it.
+        thread.join(0.2)
+        assert(thread.is_alive())
+    thread.join()
+    foo = fat._find_record("/FOO")[0]
+    other = fat._find_record("/OTHER")[0]
+    assert(foo.first_logical_cluster == 2)
+    assert(other.first_logical_cluster == 4)
+    fat.close()
+
+def test_new_add_tree(tmpdir):
+    indir = tmpdir.mkdir("tree")
+    indir.join("file1").write("1"*600)
+    sub = indir.mkdir("sub1")
+    for i in range(0, 20):
+        sub.join("f%d" % (i)).write(str(i))
+    sub.mkdir("sub2").join("deep").write("deep")
+
+    fat = pyfat.PyFat()
+    fat.new()
+    fat.add_dir("/DIR1")
+    free = fat.free_space()
+    fat.add_tree(str(indir), "/DIR1")
+    # FILE1 comes first, then SUB1, sized once for 23 entries (two
+    # clusters), followed by its files, then SUB2 and its file.
+    assert(fat._find_record("/DIR1/FILE1")[0].first_logical_cluster == 3)
+    sub1 = fat._find_record("/DIR1/SUB1")[0]
+    assert(fat.fat.get_cluster_list(sub1.first_logical_cluster) == [5, 6])
+    assert(fat._find_record("/DIR1/SUB1/F0")[0].first_logical_cluster == 7)
+    assert(fat.free_space() == free - (2 + 2 + 20 + 1 + 1) * 512)
+    with pytest.raises(pyfat.PyFatException):
+        fat.add_tree(str(indir), "/DIR1")
+    testout = tmpdir.join("tree.img")
+    fat.write(str(testout))
+    fat.close()
+
+    fat2 = pyfat.PyFat()
+    fat2.open(str(testout))
+    assert(len(list(fat2.list_dir("/DIR1/SUB1"))) == 23)
+    out = tmpdir.join("out")
+    fat2.get_and_write_file("/DIR1/SUB1/SUB2/DEEP", str(out))
+    assert(out.read() == "deep")
+    fat2.get_and_write_file("/DIR1/FILE1", str(out))
+    assert(out.read() == "1"*600)
+    fat2.close()
+
+def test_new_add_tree_failures(tmpdir):
+    fat = pyfat.PyFat()
+    fat.new()
+    fat.add_dir("/DIR1")
+    dir1 = fat._find_record("/DIR1")[0]
+    dir1_clusters = fat.fat.get_cluster_list(dir1.first_logical_cluster)
+    free = fat.free_space()
+
+    # Two host names that become the same 8.3 name in a subdirectory.
+    indir = tmpdir.mkdir("treeclash")
+    sub = indir.mkdir("sub1")
+    sub.join("a.txt").write("foo")
+    sub.join("A.TXT").write("bar")
+    with pytest.raises(pyfat.PyFatException):
+        fat.add_tree(str(indir), "/DIR1")
+    assert(len(dir1.children) == 2)
+
+    # Enough entries to grow DIR1, and a file that doesn't fit.
+    indir = tmpdir.mkdir("treefull")
+    for i in range(0, 40):
+        indir.join("f%d" % (i)).write(str(i))
+    with open(str(indir.join("huge")), 'wb') as outfp:
+        outfp.truncate(2 * 1024 * 1024)
+    with pytest.raises(pyfat.PyFatException):
+        fat.add_tree(str(indir), "/DIR1")
+    assert(len(dir1.children) == 2)
+    assert(fat.fat.get_cluster_list(dir1.first_logical_cluster) == dir1_clusters)
+    assert(fat.free_space() == free)
+    fat.close()
+
+def test_new_rm_tree(tmpdir):
+    indir = tmpdir.mkdir("rmtree")
+    indir.join("file1").write("1"*600)
+    sub = indir.mkdir("sub1")
+    for i in range(0, 20):
+        sub.join("f%d" % (i)).write(str(i))
+    sub.mkdir("sub2").join("deep").write("deep")
+
+    fat = pyfat.PyFat()
+    fat.new()
+    fat.add_file("/KEEP", str(indir.join("file1")))
+    free = fat.free_space()
+    fat.add_dir("/DIR1")
+    fat.add_tree(str(indir), "/DIR1")
+    fat.rm_tree("/DIR1")
+    assert(fat.free_space() == free)
+    assert(fat.fat.first_free == 4)
+    with pytest.raises(pyfat.PyFatException):
+        fat.rm_tree("/")
+    testout = tmpdir.join("rmtree.img")
+    fat.write(str(testout))
+    fat.close()
+
+    fat2 = pyfat.PyFat()
+    fat2.open(str(testout))
+    assert([c.full_name() for c in fat2.list_dir("/")] == ["KEEP"])
+    fat2.close()
+
+def test_new_rename_move(tmpdir):
+    indir = tmpdir.mkdir("rename")
+    indir.join("file1").write("1"*5000)
+
+    fat = pyfat.PyFat()
+    fat.new()
+    fat.add_dir("/DIR1")
+    fat.add_dir("/DIR2")
+    fat.add_dir("/DIR1/SUB1")
+    fat.add_file("/DIR1/SUB1/FILE1", str(indir.join("file1")))
+    first = fat._find_record("/DIR1/SUB1/FILE1")[0].first_logical_cluster
+    free = fat.free_space()
+    fat.rename("/DIR1/SUB1/FILE1", "/DIR1/SUB1/DATA.BIN")
+    fat.move("/DIR1/SUB1", "/DIR2")
+    fat.rename("/DIR2/SUB1", "/SUB2")
+    assert(fat._find_record("/SUB2/DATA.BIN")[0].first_logical_cluster == first)
+    assert(fat.free_space() == free)
+    fat.move("/SUB2", "/DIR1")
+    with pytest.raises(pyfat.PyFatException):
+        fat.move("/DIR1", "/DIR1/SUB2")
+    with pytest.raises(pyfat.PyFatException):
+        fat.rename("/DIR2", "/DIR1")
+    # Over-long names are rejected, not truncated when written out.
+    with pytest.raises(pyfat.PyFatException):
+        fat.rename("/DIR2", "/TOOLONGNAME")
+    with pytest.raises(pyfat.PyFatException):
+        fat.rename("/DIR2", "/DIR2.LONG")
+    assert(fat._find_record("/DIR2")[0].full_name() == "DIR2")
+    testout = tmpdir.join("rename.img")
+    fat.write(str(testout))
+    fat.close()
+
+    fat2 = pyfat.PyFat()
+    fat2.open(str(testout))
+    assert([c.full_name() for c in fat2.list_dir("/DIR1/SUB2")] == [".", "..", "DATA.BIN"])
+    dotdot = fat2._find_record("/DIR1/SUB2/..")[0]
+    assert(dotdot.first_logical_cluster == fat2._find_record("/DIR1")[0].first_logical_cluster)
+    out = tmpdir.join("out")
+    fat2.get_and_write_file("/DIR1/SUB2/DATA.BIN", str(out))
+    assert(out.read() == "1"*5000)
+    fat2.close()
+
+def test_new_write_append_truncate(tmpdir):
+    indir = tmpdir.mkdir("inplace")
+    indir.join("file1").write("1"*1500)
+    indir.join("file2").write("2"*100)
+
+    fat = pyfat.PyFat()
+    fat.new()
+    fat.add_file("/FILE1", str(indir.join("file1")))
+    fat.add_file("/FILE2", str(indir.join("file2")))
+    testout = tmpdir.join("inplace.img")
+    fat.write(str(testout))
+    fat.close()
+
+    fat2 = pyfat.PyFat()
+    fat2.open(str(testout))
+    first = fat2._find_record("/FILE1")[0].first_logical_cluster
+    free = fat2.free_space()
+    fat2.write_file("/FILE1", b"abc", 510)
+    assert(fat2.free_space() == free)
+    # 1600 bytes need a fourth cluster, and 2103 bytes a fifth.
+    fat2.append("/FILE1", b"x"*100)
+    assert(fat2.free_space() == free - 512)
+    fat2.write_file("/FILE1", b"end", 2100)
+    assert(fat2.free_space() == free - 1024)
+    fat2.truncate("/FILE2", 0)
+    assert(fat2.free_space() == free - 512)
+    fat2.append("/FILE2", b"new")
+    assert(fat2._find_record("/FILE1")[0].first_logical_cluster == first)
+    testout2 = tmpdir.join("inplace2.img")
+    fat2.write(str(testout2))
+    fat2.close()
+
+    fat3 = pyfat.PyFat()
+    fat3.open(str(testout2))
+    out = tmpdir.join("out")
+    fat3.get_and_write_file("/FILE1", str(out))
+    assert(out.read() == "1"*510 + "abc" + "1"*987 + "x"*100 + "\0"*500 + "end")
+    fat3.get_and_write_file("/FILE2", str(out))
+    assert(out.read() == "new")
+    fat3.truncate("/FILE1", 511)
+    fat3.truncate("/FILE1", 600)
+    fat3.get_and_write_file("/FILE1", str(out))
+    assert(out.read() == "1"*510 + "a" + "\0"*89)
+    fat3.close()
+
+def count_preads(monkeypatch):
+    reads = []
+    pread = os.pread
+    def counting_pread(fd, size, offset):
+        reads.append((offset, size))
+        return pread(fd, size, offset)
+    monkeypatch.setattr(os, "pread", counting_pread)
+    return reads
+
+def test_new_copy_from(tmpdir, monkeypatch):
+    indir = tmpdir.mkdir("copyfrom")
+    indir.join("file1").write("1"*5000)
+    indir.join("file2").write("2"*700)
+
+    fat = pyfat.PyFat()
+    fat.new()
+    fat.add_dir("/DIR1")
+    fat.add_dir("/DIR1/SUB1")
+    fat.add_file("/DIR1/FILE1", str(indir.join("file1")))
+    fat.add_file("/DIR1/SUB1/FILE2", str(indir.join("file2")))
+    fat.set_hidden("/DIR1/FILE1")
+    testin = tmpdir.join("copyfrom.img")
+    fat.write(str(testin))
+    fat.close()
+
+    src = pyfat.PyFat()
+    src.open(str(testin))
+    src.append("/DIR1/SUB1/FILE2", b"x"*10)
+
+    dst = pyfat.PyFat()
+    dst.new()
+    free = dst.free_space()
+    dst.copy_from(src, "/DIR1", "/COPY")
+    dst.copy_from(src, "/DIR1/FILE1", "/ONE.BIN")
+    # Two directories, 10 clusters for FILE1 twice, and 2 for FILE2.
+    assert(dst.free_space() == free - (2 + 10 + 10 + 2) * 512)
+    with pytest.raises(pyfat.PyFatException):
+        dst.copy_from(src, "/DIR1", "/COPY")
+    testout = tmpdir.join("copyto.img")
+    reads = count_preads(monkeypatch)
+    dst.write(str(testout))
+    monkeypatch.undo()
+    dst.close()
+    src.close()
+
+    # Each file is read in one go: FILE1 is contiguous in the source, and the
+    # changed last cluster of FILE2 comes from memory.
+    assert(sorted([size for offset, size in reads]) == [512, 5000, 5000])
+
+    fat2 = pyfat.PyFat()
+    fat2.open(str(testout))
+    out = tmpdir.join("out")
+    fat2.get_and_write_file("/COPY/FILE1", str(out))
+    assert(out.read() == "1"*5000)
+    assert(fat2._find_record("/COPY/FILE1")[0].attributes & 0x2)
+    fat2.get_and_write_file("/COPY/SUB1/FILE2", str(out))
+    assert(out.read() == "2"*700 + "x"*10)
+    fat2.get_and_write_file("/ONE.BIN", str(out))
+    assert(out.read() == "1"*5000)
+    fat2.close()
+
+def test_new_convert(tmpdir, monkeypatch):
+    indir = tmpdir.mkdir("convert")
+    indir.join("file1").write("1"*5000)
+    sub = indir.mkdir("sub1")
+    for i in range(0, 20):
+        sub.join("f%d" % (i)).write(str(i) * 100)
+
+    fat = pyfat.PyFat()
+    fat.new()
+    fat.add_tree(str(indir))
+    testin = tmpdir.join("floppy.img")
+    fat.write(str(testin))
+    fat.close()
+
+    for fat_type, size, cluster_size in [(pyfat.PyFat.FAT16, 32768, 2048),
+                                         (pyfat.PyFat.FAT32, 262144, None)]:
+        testout = tmpdir.join("converted.img")
+        reads = count_preads(monkeypatch)
+        pyfat.convert(str(testin), str(testout), fat_type=fat_type,
+                      cluster_size=cluster_size, size=size)
+        monkeypatch.undo()
+        # One read for each file, however many clusters it has.
+        assert(len(reads) == 21)
+
+        fat2 = pyfat.PyFat()
+        fat2.open(str(testout))
+        assert(fat2.fat_type == fat_type)
+        if cluster_size is not None:
+            assert(fat2.bytes_per_cluster == cluster_size)
+        assert(len(list(fat2.list_dir("/SUB1"))) == 22)
+        out = tmpdir.join("out")
+        fat2.get_and_write_file("/FILE1", str(out))
+        assert(out.read() == "1"*5000)
+        fat2.get_and_write_file("/SUB1/F19", str(out))
+        assert(out.read() == "19"*100)
+        fat2.close()
+
+    with pytest.raises(pyfat.PyFatException):
+        pyfat.convert(str(testin), str(tmpdir.join("bad.img")), cluster_size=1000)
+
+def test_new_resize(tmpdir):
+    indir = tmpdir.mkdir("resize")
+    indir.join("file1").write("1"*5000)
+    indir.join("file2").write("2"*70000)
+
+    fat = pyfat.PyFat()
+    fat.new(size_in_kb=8192)
+    assert(fat.fat_type == pyfat.PyFat.FAT16)
+    fat.add_dir("/DIR1")
+    fat.add_file("/DIR1/FILE1", str(indir.join("file1")))
+    fat.add_file("/FILE2", str(indir.join("file2")))
+    # Put a file near the end of the volume, so shrinking has to move it.
+    fat.fat.first_free = fat.fat.max_cluster - 5
+    fat.add_file("/FILE3", str(indir.join("file1")))
+    testout = tmpdir.join("resize.img")
+    fat.write(str(testout))
+    fat.close()
+
+    # Growing by less than the FATs have room for leaves the data in place.
+    fat5 = pyfat.PyFat()
+    fat5.open(str(testout))
+    fat_size = fat5.fat_size
+    data_offset = fat5.layout.cluster_offset(2)
+    fat5.resize(8192 + 40)
+    assert(fat5.fat_size == fat_size)
+    assert(fat5.layout.cluster_offset(2) == data_offset)
+    testout4 = tmpdir.join("resize4.img")
+    fat5.write(str(testout4))
+    fat5.close()
+    with open(str(testout), "rb") as infp:
+        before = infp.read()[data_offset:]
+    with open(str(testout4), "rb") as infp:
+        after = infp.read()[data_offset:data_offset + len(before)]
+    assert(after == before)
+
+    fat2 = pyfat.PyFat()
+    fat2.open(str(testout))
+    with pytest.raises(pyfat.PyFatException):
+        fat2.resize(1440)
+    fat2.resize()
+    assert(fat2.fat_type == pyfat.PyFat.FAT16)
+    first = fat2._find_record("/DIR1/FILE1")[0].first_logical_cluster
+    assert(fat2._find_record("/FILE3")[0].first_logical_cluster <= fat2.count_of_clusters + 1)
+    testout2 = tmpdir.join("resize2.img")
+    fat2.write(str(testout2))
+    fat2.close()
+    assert(os.stat(str(testout2)).st_size < 8192*1024)
+
+    fat3 = pyfat.PyFat()
+    fat3.open(str(testout2))
+    assert(fat3._find_record("/DIR1/FILE1")[0].first_logical_cluster == first)
+    out = tmpdir.join("out")
+    for path, data in [("/DIR1/FILE1", "1"*5000), ("/FILE2", "2"*70000), ("/FILE3", "1"*5000)]:
+        fat3.get_and_write_file(path, str(out))
+        assert(out.read() == data)
+    fat3.resize(16384)
+    free = fat3.free_space()
+    assert(free > 8 * 1024 * 1024)
+    fat3.add_file("/FILE4", str(indir.join("file2")))
+    testout3 = tmpdir.join("resize3.img")
+    fat3.write(str(testout3))
+    fat3.close()
+    assert(os.stat(str(testout3)).st_size == 16384*1024)
+
+    fat4 = pyfat.PyFat()
+    fat4.open(str(testout3))
+    for path, data in [("/FILE3", "1"*5000), ("/FILE4", "2"*70000)]:
+        fat4.get_and_write_file(path, str(out))
+        assert(out.read() == data)
+    fat4.close()
+
+def test_new_defragment(tmpdir):
+    indir = tmpdir.mkdir("defrag")
+    indir.join("small").write("s"*600)
+    indir.join("big").write("b"*5000)
+
+    fat = pyfat.PyFat()
+    fat.new()
+    fat.add_dir("/DIR1")
+    for i in range(0, 10):
+        fat.add_file("/DIR1/F%d" % (i), str(indir.join("small")))
+    for i in range(0, 10, 2):
+        fat.rm_file("/DIR1/F%d" % (i))
+    # BIG ends up spread over the holes left behind.
+    fat.add_file("/BIG", str(indir.join("big")))
+    assert(fat.fat.get_cluster_list(fat._find_record("/BIG")[0].first_logical_cluster)[:2] == [3, 4])
+    testin = tmpdir.join("frag.img")
+    fat.write(str(testin))
+    fat.close()
+
+    fat2 = pyfat.PyFat()
+    fat2.open(str(testin))
+    free = fat2.free_space()
+    testout = tmpdir.join("defrag.img")
+    fat2.write(str(testout), defragment=True)
+    fat2.close()
+
+    fat3 = pyfat.PyFat()
+    fat3.open(str(testout))
+    assert(fat3.free_space() == free)
+    # BIG comes first, right after the root, then DIR1 and its files.
+    clusters = []
+    for path in ["/BIG", "/DIR1", "/DIR1/F1", "/DIR1/F3", "/DIR1/F5", "/DIR1/F7", "/DIR1/F9"]:
+        clusters += fat3.fat.get_cluster_list(fat3._find_record(path)[0].first_logical_cluster)
+    assert(clusters == list(range(2, 2 + 10 + 1 + 5 * 2)))
+    out = tmpdir.join("out")
+    fat3.get_and_write_file("/BIG", str(out))
+    assert(out.read() == "b"*5000)
+    fat3.get_and_write_file("/DIR1/F9", str(out))
+    assert(out.read() == "s"*600)
+    fat3.close()
@@ -43,7 +43,7 @@ def test_parse_onefile(tmpdir):
     outfile = str(indir) + ".img"
     subprocess.call(["mkfs.msdos", "-C", str(outfile), "1440"])
     foofile = os.path.join(str(indir), "foo")
-    with open(foofile, "wb") as outfp:
+    with open(foofile, "w") as outfp:
         outfp.write("foo\n")
     subprocess.call(["mcopy", "-n", "-o", "-i", str(outfile), foofile, "::FOO"])
 
@@ -62,7 +62,7 @@ def test_parse_onefile_system(tmpdir):
     outfile = str(indir) + ".img"
     subprocess.call(["mkfs.msdos", "-C", str(outfile), "1440"])
     foofile = os.path.join(str(indir), "foo")
-    with open(foofile, "wb") as outfp:
+    with open(foofile, "w") as outfp:
         outfp.write("foo\n")
     subprocess.call(["mcopy", "-n", "-o", "-i", str(outfile), foofile, "::FOO"])
     subprocess.call(["mattrib", "+s", "-i", str(outfile), "::FOO"])
@@ -74,7 +74,7 @@ def test_parse_onefile_archive(tmpdir):
     outfile = str(indir) + ".img"
     subprocess.call(["mkfs.msdos", "-C", str(outfile), "1440"])
     foofile = os.path.join(str(indir), "foo")
-    with open(foofile, "wb") as outfp:
+    with open(foofile, "w") as outfp:
         outfp.write("foo\n")
     subprocess.call(["mcopy", "-n", "-o", "-i", str(outfile), foofile, "::FOO"])
     subprocess.call(["mattrib", "+a", "-i", str(outfile), "::FOO"])
@@ -86,7 +86,7 @@ def test_parse_onefile_hidden(tmpdir):
     outfile = str(indir) + ".img"
     subprocess.call(["mkfs.msdos", "-C", str(outfile), "1440"])
     foofile = os.path.join(str(indir), "foo")
-    with open(foofile, "wb") as outfp:
+    with open(foofile, "w") as outfp:
         outfp.write("foo\n")
     subprocess.call(["mcopy", "-n", "-o", "-i", str(outfile), foofile, "::FOO"])
     subprocess.call(["mattrib", "+h", "-i", str(outfile), "::FOO"])
@@ -98,7 +98,7 @@ def test_parse_onefile_read_only(tmpdir):
     outfile = str(indir) + ".img"
     subprocess.call(["mkfs.msdos", "-C", str(outfile), "1440"])
     foofile = os.path.join(str(indir), "foo")
-    with open(foofile, "wb") as outfp:
+    with open(foofile, "w") as outfp:
         outfp.write("foo\n")
     subprocess.call(["mcopy", "-n", "-o", "-i", str(outfile), foofile, "::FOO"])
     subprocess.call(["mattrib", "+r", "-i", str(outfile), "::FOO"])
@@ -110,7 +110,7 @@ def test_parse_onefile_all_attr(tmpdir):
     outfile = str(indir) + ".img"
     subprocess.call(["mkfs.msdos", "-C", str(outfile), "1440"])
     foofile = os.path.join(str(indir), "foo")
-    with open(foofile, "wb") as outfp:
+    with open(foofile, "w") as outfp:
         outfp.write("foo\n")
     subprocess.call(["mcopy", "-n", "-o", "-i", str(outfile), foofile, "::FOO"])
     subprocess.call(["mattrib", "+r", "-i", str(outfile), "::FOO"])
@@ -125,7 +125,7 @@ def test_parse_onefile_no_attr(tmpdir):
     outfile = str(indir) + ".img"
     subprocess.call(["mkfs.msdos", "-C", str(outfile), "1440"])
     foofile = os.path.join(str(indir), "foo")
-    with open(foofile, "wb") as outfp:
+    with open(foofile, "w") as outfp:
         outfp.write("foo\n")
     subprocess.call(["mcopy", "-n", "-o", "-i", str(outfile), foofile, "::FOO"])
     subprocess.call(["mattrib", "-r", "-i", str(outfile), "::FOO"])
@@ -142,7 +142,7 @@ def test_parse_manyfiles(tmpdir):
     for i in range(1, 18):
         num = "{:0>2}".format(str(i))
         numfile = os.path.join(str(indir), "file"+num)
-        with open(numfile, "wb") as outfp:
+        with open(numfile, "w") as outfp:
             outfp.write("file" + num + "\n")
         subprocess.call(["mcopy", "-n", "-o", "-i", str(outfile), numfile, "::FILE"+num])
 
@@ -156,7 +156,7 @@ def test_parse_manyfiles_subdir(tmpdir):
     for i in range(1, 18):
         num = "{:0>2}".format(str(i))
         numfile = os.path.join(str(indir), "file"+num)
-        with open(numfile, "wb") as outfp:
+        with open(numfile, "w") as outfp:
             outfp.write("file" + num + "\n")
         subprocess.call(["mcopy", "-n", "-o", "-i", str(outfile), numfile, "::DIR1/FILE"+num])
 
@@ -188,7 +188,7 @@ def test_parse_multiple_cluster_file(tmpdir):
     outfile = str(indir) + ".img"
     subprocess.call(["mkfs.msdos", "-C", str(outfile), "1440"])
     foofile = os.path.join(str(indir), "foo")
-    with open(foofile, "wb") as outfp:
+    with open(foofile, "w") as outfp:
         outfp.write("0"*513)
     subprocess.call(["mcopy", "-n", "-o", "-i", str(outfile), foofile, "::FOO"])
 
@@ -202,7 +202,7 @@ def test_parse_manyfiles2_subdir(tmpdir):
     for i in range(1, 32):
         num = "{:0>2}".format(str(i))
         numfile = os.path.join(str(indir), "file"+num)
-        with open(numfile, "wb") as outfp:
+        with open(numfile, "w") as outfp:
             outfp.write("file" + num + "\n")
         subprocess.call(["mcopy", "-n", "-o", "-i", str(outfile), numfile, "::DIR1/FILE"+num])
 
@@ -215,7 +215,7 @@ def test_parse_deep_subdir(tmpdir):
     subprocess.call(["mmd", "-i", str(outfile), "DIR1"])
     subprocess.call(["mmd", "-i", str(outfile), "DIR1/DIR2"])
     foofile = os.path.join(str(indir), "foo")
-    with open(foofile, "wb") as outfp:
+    with open(foofile, "w") as outfp:
         outfp.write("foo\n")
     subprocess.call(["mcopy", "-n", "-o", "-i", str(outfile), foofile, "::DIR1/DIR2/FOO"])
 